@@ -0,0 +1,251 @@
+"""Buffer of the rollup buckets of the consumer across batches"""
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+from rollup import aggregations, granularities
+
+
+class BufferedBucket(object):
+    """A bucket held in the buffer, with the first batch whose points it has and the first
+    segment of the log with its deltas"""
+
+    def __init__(self, entry_id, granularity, bucket, time_converted, batch, buffered_at):
+        self.entry_id = entry_id
+        self.granularity = granularity
+        self.bucket = bucket
+        self.time_converted = time_converted
+        self.batch = batch
+        self.buffered_at = buffered_at
+        self.segment = None
+
+
+class BucketBuffer(object):
+    """Keeps the merged buckets of the fine granularities (minutes and hours) in memory across
+    batches, so the buckets of a serie with a point per second are written once per flush
+    interval instead of once per batch.
+
+    A bucket is written when it was buffered a flush interval ago, when a point of a later
+    bucket of the same serie arrives (the bucket is closed) or when the buffer is full, which
+    evicts the least recently updated buckets first.
+
+    The points of a buffered bucket are not in DynamoDB yet, so the checkpoints of the shards
+    are held until all the buckets of their batches are written. With a write-ahead log
+    (wal.BucketLog) the deltas of the buckets are logged instead, and a checkpoint only waits
+    for the log to be synced"""
+
+    def __init__(self, flush_interval=5.0, max_buckets=100000,
+                 buffered_granularities=(granularities.MINUTE, granularities.HOUR), log=None):
+        self.flush_interval = flush_interval
+        self.max_buckets = max_buckets
+        self.buffered_granularities = set(buffered_granularities)
+        self.logger = logging.getLogger("BucketBuffer")
+        self.lock = threading.Lock()
+        # (granularity, timeserie, time, aggregation, cascade) -> BufferedBucket, the least
+        # recently updated first
+        self.buckets = OrderedDict()
+        # Keys of the buffered buckets of each (granularity, timeserie) and time of the latest
+        # one, to find the closed buckets
+        self.open = {}
+        self.latest = {}
+        self.batches = itertools.count(1)
+        self.batch = 0
+        # Number of buffered buckets by their first batch
+        self.pending = {}
+        # Writes taken from the buffer and not done yet: token -> first batch of their buckets
+        self.tokens = itertools.count(1)
+        self.in_flight = {}
+        # Checkpoints waiting for their batches to be written: shard -> deque of (batch,
+        # sequence number)
+        self.checkpoints = OrderedDict()
+        self.log = log
+        self.entries = itertools.count(1)
+        # Number of buffered buckets by the first segment of the log with their deltas, and
+        # the ids of the buckets and first segment of the writes in flight
+        self.pending_segments = {}
+        self.taken = {}
+        # Writes that failed, retried with the next due buckets: (write, first batch, id and
+        # first segment of its deltas in the log)
+        self.failed = []
+
+    @staticmethod
+    def bucket_key(granularity, bucket, time_converted):
+        # The bucket of a cascade carries its changes to the upper granularities, so it's
+        # never merged with a bucket of the fanout
+        return (granularity, bucket.seriename, time_converted, bucket.aggregation_method,
+                bucket.parent_times is not None)
+
+    def add(self, writes, buffer_all=False):
+        """Buffer the bucket writes of a batch. Returns (writes, token): the writes to do now,
+        which are the ones of the granularities that are not buffered and the buckets that
+        are closed or evicted, and the token to pass to done once they are written"""
+        now = time.time()
+        with self.lock:
+            self.batch = next(self.batches)
+            direct = []
+            taken = []
+            for granularity, bucket, time_converted, aggregation in writes:
+                if not buffer_all and granularity not in self.buffered_granularities:
+                    direct.append((granularity, bucket, time_converted, aggregation))
+                    continue
+                key = self.bucket_key(granularity, bucket, time_converted)
+                buffered = self.buckets.pop(key, None)
+                if buffered is None:
+                    buffered = BufferedBucket(next(self.entries), granularity, bucket,
+                                              time_converted, self.batch, now)
+                    self.pending[self.batch] = self.pending.get(self.batch, 0) + 1
+                    self.open.setdefault((granularity, bucket.seriename), set()).add(key)
+                else:
+                    buffered.bucket.merge(bucket)
+                if self.log is not None:
+                    # The bucket of the batch is the delta, it's pickled as it is now
+                    segment = self.log.append_delta(buffered.entry_id, granularity, bucket,
+                                                    time_converted)
+                    if buffered.segment is None:
+                        buffered.segment = segment
+                        self.pending_segments[segment] = \
+                            self.pending_segments.get(segment, 0) + 1
+                # The last updated at the end
+                self.buckets[key] = buffered
+
+                serie_key = (granularity, bucket.seriename)
+                latest = self.latest.get(serie_key, None)
+                if latest is None or time_converted > latest:
+                    self.latest[serie_key] = time_converted
+                    if latest is not None:
+                        # The points of the serie are in a later bucket now
+                        taken.extend(self._remove(key) for key in list(self.open[serie_key])
+                                     if key[2] < time_converted)
+
+            while len(self.buckets) > self.max_buckets:
+                taken.append(self._remove(next(iter(self.buckets))))
+            return self._take(direct, taken)
+
+    def due(self, force=False):
+        """Take the buckets buffered a flush interval ago, or all of them if force, and the
+        writes that failed. Returns (writes, token) like add"""
+        limit = time.time() - self.flush_interval
+        with self.lock:
+            keys = [key for key, buffered in self.buckets.iteritems()
+                    if force or buffered.buffered_at <= limit]
+            failed, self.failed = self.failed, []
+            return self._take([], [self._remove(key) for key in keys], failed)
+
+    def _remove(self, key):
+        buffered = self.buckets.pop(key)
+        self.pending[buffered.batch] -= 1
+        if not self.pending[buffered.batch]:
+            del self.pending[buffered.batch]
+        if buffered.segment is not None:
+            self.pending_segments[buffered.segment] -= 1
+            if not self.pending_segments[buffered.segment]:
+                del self.pending_segments[buffered.segment]
+        serie_key = (key[0], key[1])
+        keys = self.open[serie_key]
+        keys.discard(key)
+        if not keys:
+            del self.open[serie_key]
+            del self.latest[serie_key]
+        return buffered
+
+    def _take(self, direct, taken, failed=()):
+        writes = list(direct)
+        # Id and first segment of the deltas in the log of the bucket of each write
+        entries = {}
+        for buffered in taken:
+            write = aggregations.bucket_write(buffered.granularity, buffered.bucket,
+                                              buffered.time_converted)
+            if write is not None:
+                writes.append(write)
+            entries[id(buffered.bucket)] = (buffered.entry_id, buffered.segment)
+        batches = [buffered.batch for buffered in taken]
+        for write, batch, entry_id, segment in failed:
+            writes.append(write)
+            batches.append(batch)
+            if entry_id is not None:
+                entries[id(write[1])] = (entry_id, segment)
+        if direct:
+            # The writes that are not buffered are of the current batch
+            batches.append(self.batch)
+        token = next(self.tokens)
+        if batches:
+            self.in_flight[token] = min(batches)
+        if self.log is not None and entries:
+            self.taken[token] = (entries, min(segment for __, segment in entries.itervalues()))
+        return writes, token
+
+    def done(self, token, failed=()):
+        """The writes of a token are done, except the failed ones, which are kept and written
+        again with the next due buckets. Returns the checkpoints [(shard, sequence number)] that
+        can be stored now"""
+        with self.lock:
+            batch = self.in_flight.pop(token, None)
+            entries, __ = self.taken.pop(token, ({}, None))
+            for write in failed:
+                entry_id, segment = entries.pop(id(write[1]), (None, None))
+                if self.log is not None and entry_id is None:
+                    # A write that was not buffered (of a granularity that is not buffered or
+                    # the parent of a cascade), its bucket is logged now
+                    entry_id = next(self.entries)
+                    segment = self.log.append_delta(entry_id, *write[:3])
+                self.failed.append((write, batch if batch is not None else self.batch, entry_id,
+                                    segment))
+            if self.log is not None and (entries or failed):
+                if entries:
+                    self.log.append_done([entry_id for entry_id, __ in entries.itervalues()])
+                # The segments before the first one with deltas of buffered buckets, writes in
+                # flight or failed writes are not needed anymore
+                needed = self.pending_segments.keys() + \
+                    [segment for __, segment in self.taken.itervalues()] + \
+                    [segment for __, __, __, segment in self.failed if segment is not None]
+                self.log.release(min(needed) if needed else self.log.segment)
+            checkpoints = self._ready_checkpoints()
+        if self.log is not None and (entries or failed):
+            self.log.sync()
+        return checkpoints
+
+    def checkpoint(self, shard_id, sequence_number):
+        """Hold the checkpoint of a shard until the batches added so far are written. Returns
+        the checkpoints that can be stored now"""
+        if self.log is not None:
+            # The deltas of the batches are in the log
+            self.log.sync()
+            return [(shard_id, sequence_number)]
+        with self.lock:
+            self.checkpoints.setdefault(shard_id, deque()).append((self.batch, sequence_number))
+            return self._ready_checkpoints()
+
+    def replay(self):
+        """Buffer the deltas of the log of a previous run. They are logged again, so the
+        segments of that run are deleted"""
+        replayed = self.log.replay()
+        # The new buckets don't reuse the ids of the previous runs
+        self.entries = itertools.count(self.log.last_entry_id + 1)
+        first_segment = (self.log.segments[-1] + 1) if self.log.segments else 1
+        writes, token = self.add([(granularity, bucket, time_converted, None)
+                                  for granularity, bucket, time_converted in replayed],
+                                 buffer_all=True)
+        self.log.sync()
+        self.log.release(first_segment)
+        return writes, token
+
+    def _ready_checkpoints(self):
+        # First batch that is not written completely
+        pending = self.pending.keys() + self.in_flight.values() + \
+            [batch for __, batch, __, __ in self.failed]
+        first_pending = min(pending) if pending else self.batch + 1
+        ready = []
+        for shard_id, held in self.checkpoints.items():
+            sequence_number = None
+            while held and held[0][0] < first_pending:
+                sequence_number = held.popleft()[1]
+            if sequence_number is not None:
+                ready.append((shard_id, sequence_number))
+            if not held:
+                del self.checkpoints[shard_id]
+        return ready
+
+    def __len__(self):
+        return len(self.buckets)
@@ -0,0 +1,61 @@
+"""Checkpoints of the last record processed in each shard"""
+import json
+import logging
+import os
+import threading
+import time
+
+# Checkpoints that are not sequence numbers: the shard is finished, or it has to be read from
+# its start (a child shard after a reshard)
+SHARD_END = 'SHARD_END'
+TRIM_HORIZON = 'TRIM_HORIZON'
+
+
+class FileCheckpointer(object):
+    """Keeps the sequence number of the last record written from each shard in a local JSON
+    file, so a restarted consumer resumes where it stopped"""
+
+    def __init__(self, path, save_interval=5.0):
+        self.path = path
+        self.save_interval = save_interval
+        self.logger = logging.getLogger("FileCheckpointer")
+        self.lock = threading.Lock()
+        self.last_save = 0
+        self.dirty = False
+        self.sequences = {}
+        if os.path.exists(path):
+            with open(path, "r") as checkpoint_file:
+                self.sequences = json.load(checkpoint_file)
+
+    def get(self, shard_id):
+        """Sequence number of the last record processed in the shard, or None"""
+        with self.lock:
+            return self.sequences.get(shard_id, None)
+
+    def checkpoint(self, shard_id, sequence_number):
+        """Record that the shard is processed up to the sequence number. The file is saved at
+        most once per save interval"""
+        with self.lock:
+            self.sequences[shard_id] = sequence_number
+            self.dirty = True
+            if time.time() - self.last_save >= self.save_interval:
+                self._save()
+        return True
+
+    def flush(self):
+        """Save the pending checkpoints"""
+        with self.lock:
+            if self.dirty:
+                self._save()
+
+    def _save(self):
+        # Write to a temporary file and rename it, so a crash never leaves a partial file
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as checkpoint_file:
+                json.dump(self.sequences, checkpoint_file)
+            os.rename(tmp_path, self.path)
+            self.dirty = False
+        except (IOError, OSError), err:
+            self.logger.error("Cannot save the checkpoints: %s", err)
+        self.last_save = time.time()
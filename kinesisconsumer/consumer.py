@@ -1,59 +1,140 @@
 """This is the implementation of the consumer"""
 import time
 import os
+import signal
 import threading
 import logging
-import json
+from collections import OrderedDict
 
-from rollup.lambda_database import InsertItem, configure_kinesis, configure_dynamodb
-from rollup.timeserie_configuration import Configuration
-from rollup import aggregations, granularities, constants
+from rollup.lambda_database import configure_kinesis, configure_dynamodb
+from rollup import aggregations, blocks, constants
+from buffer import BucketBuffer
+from checkpoint import FileCheckpointer, SHARD_END, TRIM_HORIZON
+from lanes import LaneScheduler
+from leases import LeaseManager
+from pipeline import ShardPipeline
+from prepare import DecoderPool, prepare_items
+from ratecontrol import RateBounds, UpdateThrottling
+from wal import BucketLog
+from writer import BatchWriter, WriteError
+
+
+# Sleep before processing again a shard whose pipeline failed
+FAILED_SHARD_SLEEP_TIME = 5
+# Seconds that stop waits for the pipelines to write the records already fetched. ECS kills
+# the container 30 seconds after the SIGTERM by default
+STOP_TIMEOUT = 20
 
 
 class KinesisDynamoConsumer(object):
     """Consumer Application that consume messages from Kinesis and insert them onto DynamoDB Tables"""
     DYNAMO_DB_MAX_BATCH = 25
 
-    def __init__(self, stream_name, batch_size=10, sleep_time=0.2):
+    def __init__(self, stream_name, batch_size=10, sleep_time=0.2, write_workers=8,
+                 max_in_flight_batches=32, start_position='LATEST', start_timestamp=None,
+                 checkpointer=None, catch_up_workers=None, leases=None, lease_interval=10,
+                 shard_sync_interval=60, decode_processes=0, rollup_lanes=8, flush_interval=0,
+                 max_buffered_buckets=100000, wal_directory=None):
+        # The processes are forked before any thread is started
+        self.decoder = DecoderPool(decode_processes) if decode_processes else None
         self.stream_name = stream_name
+        # Where to start reading a shard without checkpoint: LATEST, TRIM_HORIZON or
+        # AT_TIMESTAMP (start_timestamp)
+        self.start_position = start_position
+        self.start_timestamp = start_timestamp
+        self.checkpointer = checkpointer
+        # With a lease manager the shards are split between several consumers, and the
+        # checkpoints are kept in the leases
+        self.leases = leases
+        self.lease_interval = lease_interval
+        self.shard_sync_interval = shard_sync_interval
+        if leases is not None:
+            self.checkpointer = leases
         self.run = True
+        # Threads that run the pipelines of the shards
+        self.shard_threads = []
         self.kinesis = configure_kinesis()
         self.dynamodb = configure_dynamodb()
         self.logger = logging.getLogger("KinesisDynamoDB")
+        # Pool of threads shared by all the shards to write the batches concurrently
+        self.writer = BatchWriter(self.dynamodb, workers=write_workers,
+                                  max_in_flight=max_in_flight_batches)
+        # Lanes that run the rollups of different series in parallel, keeping the order of the
+        # updates of each serie
+        self.lanes = LaneScheduler(rollup_lanes) if rollup_lanes > 1 else None
+        # The minute and hour buckets are kept in memory and written once per flush interval.
+        # With a write-ahead log they survive a restart
+        self.buffer = None
+        if flush_interval:
+            self.buffer = BucketBuffer(flush_interval, max_buffered_buckets,
+                                       log=BucketLog(wal_directory) if wal_directory else None)
+            if self.buffer.log is not None:
+                self.write_buffered(*self.buffer.replay())
+            flusher = threading.Thread(target=self.flush_buffer_periodically)
+            flusher.daemon = True
+            flusher.start()
+        # Number of writer threads while a shard is catching up a backlog
+        self.write_workers = write_workers
+        self.catch_up_workers = max(catch_up_workers or max_in_flight_batches, write_workers)
+        self.catching_up = set()
+        self.catching_up_lock = threading.Lock()
+        # Initial GetRecords Limit and delay between polls, adjusted later on each shard
         self.batch_size = batch_size
         self.sleep_time = sleep_time
-        reload_thread = threading.Thread(target=self.reload_parameters)
-        reload_thread.daemon = True
-        reload_thread.start()
-
-    def reload_parameters(self):
-        while True:
-            time.sleep(10)
-            self.read_set_parameters()
+        self.rate_bounds = RateBounds()
+        # Throttled UpdateItem calls of the rollups, which also slow down the shards
+        self.update_throttling = UpdateThrottling(self.dynamodb)
+        self.read_set_parameters()
 
     def read_set_parameters(self):
-        """Read an external configuration file"""
-        self.logger.debug('**** Reading and setting parameters ****')
+        """Read an external configuration file with the bounds of the rate of the shards"""
         parameter_file = os.path.dirname(os.path.realpath(__file__)) + "/parameters.json"
-        with open(parameter_file, "r") as parameters:
-            parameters_json = json.load(parameters)
-            batch_size = int(parameters_json["BATCH_SIZE"])
-            sleep_time = float(parameters_json["SLEEP_TIME"])
-
-            if batch_size != self.batch_size:
-                self.logger.info('**** New batch size: %s ****', batch_size)
-                self.batch_size = batch_size
-            if sleep_time != self.sleep_time:
-                self.logger.info('**** New sleep time: %s ****', sleep_time)
-                self.sleep_time = sleep_time
-
-    def stop(self):
+        if os.path.exists(parameter_file):
+            self.rate_bounds = RateBounds.from_file(parameter_file)
+        self.logger.info('**** Rate bounds: %s ****', self.rate_bounds)
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """Stop consuming. The pipelines write the records that they already fetched before the
+        buffered buckets are written and the leases released"""
+        if not self.run:
+            return
         self.logger.info("Stop KinesisDynamoDB consumer")
         self.run = False
+        deadline = time.time() + timeout
+        for thread in list(self.shard_threads):
+            if thread is not threading.current_thread():
+                thread.join(max(deadline - time.time(), 0))
+        if self.buffer is not None:
+            self.flush_buffer(force=True)
+            if self.buffer.log is not None:
+                self.buffer.log.close()
+        self.writer.stop()
+        if self.lanes is not None:
+            self.lanes.stop()
+        if self.decoder is not None:
+            self.decoder.stop()
+        if self.checkpointer is not None:
+            self.checkpointer.flush()
+        if self.leases is not None:
+            self.leases.release()
+
+    def list_shards(self):
+        """All the shards of the stream"""
+        shards = []
+        kwargs = {'StreamName': self.stream_name}
+        while True:
+            description = self.kinesis.describe_stream(**kwargs)['StreamDescription']
+            shards.extend(description['Shards'])
+            if not description.get('HasMoreShards', False) or not description['Shards']:
+                return shards
+            kwargs['ExclusiveStartShardId'] = description['Shards'][-1]['ShardId']
 
     def start(self):
         """Start consuming messages"""
         self.logger.info("Start KinesisDynamoDB consumer")
+        if self.leases is not None:
+            self.process_leased_shards()
+            return
 
         # Create one thread per shard. The data is partitioned in the stream by its table,
         # so all the data inside a shard will be stored into the same dynamo DB table
@@ -69,67 +150,103 @@ class KinesisDynamoConsumer(object):
 
         for shard_thread in shard_threads:
             shard_thread.start()
+        self.shard_threads = shard_threads
 
         while self.run:
             time.sleep(1)
 
-    def process_shard(self, shard_id):
-        """Function that process a shard"""
-        shard_it = self.kinesis.get_shard_iterator(StreamName=self.stream_name,
-                                                   ShardId=shard_id,
-                                                   ShardIteratorType='LATEST')['ShardIterator']
-        iterations = 0
+    def process_leased_shards(self):
+        """Process the shards whose lease is held by this consumer. The leases are renewed and
+        rebalanced with the other consumers periodically, and the new shards of the stream
+        (after a reshard) get their lease"""
+        self.logger.info("Consumer %s using leases", self.leases.worker_id)
+        pipelines = {}
+        # Positions to process again the shards whose pipeline failed
+        positions = {}
+        last_sync = 0
         while self.run:
             try:
-                iterations += 1
-                # Obtain the records from the Kinesis stream shard
-                time_get_records_1 = time.time()
-                out = self.kinesis.get_records(ShardIterator=shard_it, Limit=self.batch_size)
-                records = out["Records"]
-                time_get_records_2 = time.time()
-                gather_time = time_get_records_2 - time_get_records_1
-                # Process the data
-                items = []
-                tjson1 = time.time()
-                for record in records:
-                    items.append(json.loads(record['Data']))
-                tjson2 = time.time()
-                tjson = tjson2 - tjson1
-
-                # Store the obtained data in DynamoDB by batches (one thread per batch for max performance)
-                dynamo_time_1 = time.time()
-                table = self.process_ts_items(items, threaded=True, shard_id=shard_id)
-                dynamo_time_2 = time.time()
-                dynamo_time = dynamo_time_2 - dynamo_time_1
-
-                # Get next shard iterator
-                shard_it = out.get('NextShardIterator', None)
-                if not shard_it:
-                    self.logger.info("No next shard iterator, closing")
-                    break
-
-                # Print debugging info
-                loop_time = self.sleep_time + gather_time + +tjson + dynamo_time
-                wcu_output = len(records) / loop_time
-                if records and table:
-                    self.logger.info("[Table %s] Insert %d records in %s seconds. WCU = %f",
-                                     table, len(records), loop_time, wcu_output)
-                    time.sleep(self.sleep_time)
-                else:
-                    # Make sure to sleep even when there are no records,
-                    # otherwise the provisioned throughput of the shard
-                    # will be consumed instantaneously
-                    # self.logger.info("[Table %s] Insert %d records in %s seconds. WCU = %f", info_tup)
-                    time.sleep(0.5)
-
-                # TODO: Implement dynamic change of BATCH_SIZE and SLEEP_TIME
-                """
-                if iterations % 10 == 0:
-                    set_parameters()
-                """
+                if time.time() - last_sync >= self.shard_sync_interval:
+                    self.leases.sync_shards(self.list_shards())
+                    last_sync = time.time()
+                owned = self.leases.refresh()
             except Exception, err:
-                print err
-                pass
+                self.logger.error("Cannot refresh the leases: %s", err)
+                time.sleep(self.lease_interval)
+                continue
+
+            for shard_id, (pipeline, thread) in pipelines.items():
+                if not thread.is_alive():
+                    if pipeline.failed:
+                        positions[shard_id] = pipeline.resume_position()
+                    del pipelines[shard_id]
+                elif shard_id not in owned:
+                    self.logger.info("Stopping worker for shard %s ...", shard_id)
+                    pipeline.stop()
+                    del pipelines[shard_id]
+
+            for shard_id in positions.keys():
+                if shard_id not in owned:
+                    # The new owner starts after the checkpoint in the lease
+                    del positions[shard_id]
+            for shard_id in owned:
+                if shard_id not in pipelines and self.run:
+                    self.logger.info("Creating worker for shard %s ...", shard_id)
+                    pipeline = ShardPipeline(self, shard_id, positions.pop(shard_id, None))
+                    thread = threading.Thread(target=pipeline.run)
+                    thread.daemon = True
+                    thread.start()
+                    pipelines[shard_id] = (pipeline, thread)
+            self.shard_threads = [thread for __, thread in pipelines.itervalues()]
+
+            time.sleep(self.lease_interval)
+
+    def get_shard_iterator(self, shard_id, after_sequence=None,
+                           iterator_type='AFTER_SEQUENCE_NUMBER'):
+        """Iterator to start reading the shard after a sequence number (or at it, with the
+        AT_SEQUENCE_NUMBER type), after its checkpoint or at the start position"""
+        if after_sequence is None and self.checkpointer is not None:
+            after_sequence = self.checkpointer.get(shard_id)
+        kwargs = {'StreamName': self.stream_name, 'ShardId': shard_id}
+        if after_sequence == TRIM_HORIZON:
+            kwargs['ShardIteratorType'] = TRIM_HORIZON
+        elif after_sequence is not None:
+            kwargs['ShardIteratorType'] = iterator_type
+            kwargs['StartingSequenceNumber'] = after_sequence
+        else:
+            kwargs['ShardIteratorType'] = self.start_position
+            if self.start_position == 'AT_TIMESTAMP':
+                kwargs['Timestamp'] = self.start_timestamp
+        self.logger.info("[Shard %s] Start reading %s %s", shard_id, kwargs['ShardIteratorType'],
+                         kwargs.get('StartingSequenceNumber', kwargs.get('Timestamp', '')))
+        return self.kinesis.get_shard_iterator(**kwargs)['ShardIterator']
+
+    def set_catching_up(self, shard_id, catching_up):
+        """Widen the write concurrency while any shard is catching up a backlog"""
+        with self.catching_up_lock:
+            if catching_up:
+                self.catching_up.add(shard_id)
+            else:
+                self.catching_up.discard(shard_id)
+            workers = self.catch_up_workers if self.catching_up else self.write_workers
+            if workers != self.writer.workers:
+                self.logger.info("Using %d writer threads", workers)
+                self.writer.resize(workers)
+
+    def process_shard(self, shard_id):
+        """Function that process a shard. Fetching the records, decoding them and writing
+        them to DynamoDB run in a pipeline, so they overlap"""
+        if self.checkpointer is not None and self.checkpointer.get(shard_id) == SHARD_END:
+            self.logger.info("Shard %s is finished", shard_id)
+            return
+        position = None
+        while self.run:
+            pipeline = ShardPipeline(self, shard_id, position)
+            if pipeline.run():
+                return
+            # Process the shard again from the first record that was not written
+            position = pipeline.resume_position()
+            time.sleep(FAILED_SHARD_SLEEP_TIME)
 
     def split_into_batches(self, items):
         grouped = list(zip(*[iter(items)] * self.DYNAMO_DB_MAX_BATCH))
@@ -139,78 +256,244 @@ class KinesisDynamoConsumer(object):
         return grouped
 
     def process_ts_items(self, items, threaded=True, shard_id=None):
-        """Split the user list into batches of 25, later insert them sequentially.
+        """Store and aggregate the points decoded from the stream"""
+        return self.write_prepared(prepare_items(items), threaded, shard_id)
+
+    def write_prepared(self, batch, threaded=True, shard_id=None):
+        """Split the raw points into batches of 25, later insert them sequentially.
 
-        If more performance is required, each batch can be inserted in a separate thread
+        If more performance is required, the batches are inserted concurrently by the pool of
+        writer threads. The rollups are written once the raw points are written. Raises an
+        exception if some points could not be written, then the records of the batch must not
+        be checkpointed
 
         """
 
-        def sequential_insert(batches):
-            """Insert the batches one after the other"""
-            for batch in batches:
-                try:
-                    response = self.dynamodb.batch_write_item(RequestItems=batch)
-                    self.logger.debug(response)
-                    while response['UnprocessedItems']:
-                        response = self.dynamodb.batch_write_item(RequestItems=response['UnprocessedItems'])
-                        self.logger.debug(response)
-                except Exception, err:
-                    self.logger.error(err)
-                    pass
-
-        def threaded_insert(batches):
-            """Insert the batches simultaneously (one thread per batch)"""
-            threads = []
-            for batch in batches:
-                th = threading.Thread(target=sequential_insert, args=([batch],))
-                threads.append(th)
-            for thread in threads:
-                thread.start()
-                thread.join()
-
-        if items:
+        if batch.points:
+            # The records of a shard are not bound to a table: the stream can be partitioned by
+            # timeserie, so the items to store are grouped by their own table
             batch_list = []
-            table = None
-            for item_batch in self.split_into_batches(items):
-                items_db = []
-                for item in item_batch:
-
-                    # The assumption that all records belonging to the same shard belongs to the same table is false.
-                    # Two tables with two different hashes can be put into the same shard.
-
-                    # If we want to enable one stream / table, we have to manually set the correspondence
-                    # table - partition key
-
-                    granularity = item['granularity']
-
-                    # Check if item has to be stored or aggregated
-                    if 'aggregation' in item:
-                        insert_item = InsertItem.from_dict(item['data'])
-                        ts_conf = Configuration.from_dict(item['aggregation'])
-                        aggregations.rollup(self.dynamodb, granularity, insert_item, ts_conf)
-                    else:
-                        # Here we can make the assumption, since all the non aggregated values will share the same
-                        # hash, so the same shard
-                        if not table:
-                            table = granularities.get_granularity_table_text(granularity)
-                        insert_item = InsertItem.from_dict(item['data'])
-                        dyn_batch_item = {'PutRequest': {'Item': insert_item.to_dynamo_db()}}
-                        items_db.append(dyn_batch_item)
-                if items_db:
-                    batch_list.append({table: items_db})
-
-            if batch_list:
-                if threaded:
-                    threaded_insert(batch_list)
+            for table, items_db in batch.table_items.iteritems():
+                for item_batch in self.split_into_batches(items_db.values()):
+                    batch_list.append({table: list(item_batch)})
+            table = ", ".join(batch.table_items.keys() +
+                              [block_table for block_table, __ in batch.block_items]) or None
+
+            # The raw points are written first. When they cannot be written the shard reads the
+            # batch again, and the rollups that add to their buckets (sum, count and average)
+            # must not be written twice
+            tasks = self.write_blocks(batch.block_items)
+            if threaded:
+                written = self.writer.write(batch_list)
+            else:
+                written = self.writer.write_sequential(batch_list)
+            if tasks:
+                # All the blocks are done before the error of any of them is raised
+                self.lanes.wait(tasks)
+            if not written:
+                raise WriteError("Cannot write the points of %s" % table)
+
+            # Rollups of the batch that fall into the same bucket are merged before writing
+            points = batch.combiner.points + batch.cascade.points
+            writes = batch.combiner.bucket_writes() + batch.cascade.bucket_writes()
+            token = None
+            if self.buffer is not None:
+                writes, token = self.buffer.add(writes)
+            # If the writes cannot be waited for, all of them are written again
+            failed = writes
+            try:
+                failed_writes = []
+                if self.lanes is None:
+                    results = self.run_rollups(batch.rollups, writes, failed_writes)
                 else:
-                    sequential_insert(batch_list)
+                    results = self.wait_rollups(self.submit_rollups(batch.rollups, writes,
+                                                                    failed_writes))
+                failed = failed_writes
+            finally:
+                # Otherwise the buffer holds the checkpoints of all the shards forever. The
+                # buckets that failed are kept in the buffer
+                if token is not None:
+                    self.store_checkpoints(self.buffer.done(token, failed))
+
+            # The failed bucket writes are kept by the buffer, otherwise they are written again
+            # here. The rollups that cannot be merged are not kept
+            failures = self.log_rollups(points, results) - len(failed_writes)
+            if self.buffer is None:
+                failures += len(self.rewrite_rollups(failed_writes))
+            if failures:
+                raise WriteError("Cannot write %d rollups" % failures)
 
             return table
 
+    def write_blocks(self, block_items):
+        """Merge the points stored in blocks into the blocks of their timeseries. With lanes
+        the blocks of each timeserie are written in its lane and the tasks are returned"""
+        tasks = []
+        for (table, granularity), items in block_items.iteritems():
+            if self.lanes is None:
+                blocks.write_points(self.dynamodb, table, granularity, items.values())
+                continue
+            series = OrderedDict()
+            for item in items.itervalues():
+                series.setdefault(item['timeserie'], []).append(item)
+            for timeserie, serie_items in series.iteritems():
+                tasks.append(self.lanes.submit((timeserie, granularity), blocks.write_points,
+                                               self.dynamodb, table, granularity, serie_items))
+        return tasks
+
+    def log_rollups(self, points, results):
+        """Log the results of the rollup writes: True if the bucket was written, False if it
+        already had a better value (a max, min or last that did not change) and None if it
+        failed. Returns the number of failed writes"""
+        if results:
+            self.logger.info("Combined %d rollups into %d writes, %d unchanged, %d failed",
+                             points, results.count(True), results.count(False),
+                             results.count(None))
+        return results.count(None)
+
+    def rewrite_rollups(self, failed):
+        """Write again the bucket writes that failed, with the backoff of the writer. Returns the
+        ones that still fail after as many retries as a batch of the writer"""
+        for attempt in range(self.writer.max_retries):
+            if not failed:
+                break
+            self.writer.backoff(attempt)
+            retried, failed = failed, []
+            if self.lanes is None:
+                self.run_rollups([], retried, failed)
+            else:
+                self.wait_rollups(self.submit_rollups([], retried, failed))
+        return failed
+
+    def run_rollups(self, rollups, writes, failed=None):
+        """Run the rollups that cannot be merged and the writes of the merged buckets in this
+        thread. Returns the results of the writes and appends the bucket writes that failed
+        to failed"""
+        results = [aggregations.rollup(self.dynamodb, granularity, insert_item, ts_conf)
+                   for granularity, insert_item, ts_conf in rollups]
+        # A bucket without parents is a cascade that stops at its own granularity
+        results.extend(aggregations.write_cascade(self.dynamodb, writes, failed))
+        return results
+
+    def submit_rollups(self, rollups, writes, failed=None):
+        """Run the rollups in the lanes of their (timeserie, granularity), so different series
+        are written in parallel. The cascade of a timeserie goes up through all the
+        granularities, so it runs as a single task in the lane of its minutes. The bucket
+        writes that failed are appended to failed"""
+        tasks = []
+        for granularity, insert_item, ts_conf in rollups:
+            tasks.append(self.lanes.submit((insert_item.seriename, granularity),
+                                           aggregations.rollup, self.dynamodb, granularity,
+                                           insert_item, ts_conf))
+        cascades = OrderedDict()
+        for write in writes:
+            granularity, bucket = write[0], write[1]
+            if bucket.parent_times is None:
+                tasks.append(self.lanes.submit((bucket.seriename, granularity),
+                                               aggregations.write_cascade, self.dynamodb,
+                                               [write], failed))
+            else:
+                cascades.setdefault((bucket.seriename, granularity), []).append(write)
+        for key, cascade in cascades.iteritems():
+            tasks.append(self.lanes.submit(key, aggregations.write_cascade, self.dynamodb,
+                                           cascade, failed))
+        return tasks
+
+    def wait_rollups(self, tasks):
+        """Wait for the rollups submitted to the lanes and return the results of the writes"""
+        return self.rollup_results(self.lanes.wait(tasks))
+
+    @staticmethod
+    def rollup_results(task_results):
+        """Results of the writes of the rollup tasks"""
+        results = []
+        for result in task_results:
+            # A cascade returns the results of all its writes
+            if isinstance(result, list):
+                results.extend(result)
+            else:
+                results.append(result)
+        return results
+
+    def flush_buffer(self, force=False):
+        """Write the buffered buckets that are due, or all of them if force"""
+        self.write_buffered(*self.buffer.due(force))
+
+    def write_buffered(self, writes, token):
+        """Write the buckets taken from the buffer. The ones that fail are kept in the buffer
+        and written again with the next due buckets"""
+        # If the writes cannot be waited for, all of them are written again
+        failed = writes
+        try:
+            if writes:
+                failed_writes = []
+                if self.lanes is None:
+                    results = self.run_rollups([], writes, failed_writes)
+                else:
+                    results = self.wait_rollups(self.submit_rollups([], writes,
+                                                                    failed_writes))
+                self.log_rollups(len(writes), results)
+                failed = failed_writes
+        finally:
+            self.store_checkpoints(self.buffer.done(token, failed))
+
+    def flush_buffer_periodically(self):
+        """Flusher thread of the buffer"""
+        while self.run:
+            time.sleep(min(self.buffer.flush_interval, 1.0))
+            try:
+                self.flush_buffer()
+            except Exception, err:
+                self.logger.error("Cannot flush the buffered buckets: %s", err)
+
+    def checkpoint(self, shard_id, sequence_number):
+        """Checkpoint a shard once the batch of the sequence number is written. Returns False
+        if the lease of the shard was lost. With a buffer the checkpoint is held until the
+        buffered buckets of the batch are written"""
+        if self.checkpointer is None:
+            return True
+        if self.buffer is None:
+            return self.checkpointer.checkpoint(shard_id, sequence_number)
+        self.store_checkpoints(self.buffer.checkpoint(shard_id, sequence_number))
+        return True
+
+    def store_checkpoints(self, checkpoints):
+        """Store the checkpoints released by the buffer"""
+        if self.checkpointer is None:
+            return
+        for shard_id, sequence_number in checkpoints:
+            if not self.checkpointer.checkpoint(shard_id, sequence_number):
+                # The lease refresh stops the pipeline of the shard
+                self.logger.info("[Shard %s] Lease lost, checkpoint not stored", shard_id)
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
     logging.getLogger('boto3').setLevel(logging.CRITICAL)
     logging.getLogger('botocore').setLevel(logging.CRITICAL)
     stream_name = constants.get_kinesis_stream()
-    KinesisDynamoConsumer(stream_name).start()
+    checkpoint_file = os.environ.get('CHECKPOINT_FILE', None)
+    start_timestamp = os.environ.get('START_TIMESTAMP', None)
+    start_position = os.environ.get('START_POSITION', 'LATEST')
+    lease_table = os.environ.get('LEASE_TABLE', None)
+    consumer = KinesisDynamoConsumer(
+        stream_name,
+        write_workers=int(os.environ.get('WRITE_WORKERS', '8')),
+        max_in_flight_batches=int(os.environ.get('MAX_IN_FLIGHT_BATCHES', '32')),
+        start_position=start_position,
+        start_timestamp=float(start_timestamp) if start_timestamp else None,
+        checkpointer=FileCheckpointer(checkpoint_file) if checkpoint_file else None,
+        catch_up_workers=int(os.environ.get('CATCH_UP_WORKERS', '0')) or None,
+        leases=LeaseManager(configure_dynamodb(), lease_table,
+                            start_position=start_position) if lease_table
+        else None,
+        decode_processes=int(os.environ.get('DECODE_PROCESSES', '0')),
+        rollup_lanes=int(os.environ.get('ROLLUP_LANES', '8')),
+        flush_interval=float(os.environ.get('ROLLUP_FLUSH_INTERVAL', '0')),
+        max_buffered_buckets=int(os.environ.get('MAX_BUFFERED_BUCKETS', '100000')),
+        wal_directory=os.environ.get('ROLLUP_WAL_DIRECTORY', None))
+    # ECS stops the container with SIGTERM: the fetched records and the buffered buckets are
+    # written and the leases released before exiting
+    signal.signal(signal.SIGTERM, lambda __signum, __frame: consumer.stop())
+    signal.signal(signal.SIGINT, lambda __signum, __frame: consumer.stop())
+    consumer.start()
@@ -0,0 +1,74 @@
+"""Ordered parallel execution of the rollups"""
+import logging
+import threading
+import zlib
+from Queue import Queue
+
+
+class LaneTask(object):
+    """A function to run in a lane and its result"""
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class LaneScheduler(object):
+    """Runs the tasks on a fixed number of lanes, each one a thread with its own queue.
+
+    The tasks of the same key, e.g. (timeserie, granularity), always go to the same lane and run
+    in the order they were submitted, so two updates of a bucket never race. The tasks of
+    different keys run in parallel"""
+
+    def __init__(self, lanes=8):
+        self.logger = logging.getLogger("LaneScheduler")
+        self.queues = []
+        for __ in range(lanes):
+            queue = Queue()
+            thread = threading.Thread(target=self.work, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            self.queues.append(queue)
+
+    def lane(self, key):
+        """Queue of the lane of a key, stable across processes"""
+        return self.queues[zlib.crc32('|'.join(key).encode('utf-8')) % len(self.queues)]
+
+    def submit(self, key, func, *args):
+        """Run func(*args) in the lane of the key"""
+        task = LaneTask(func, args)
+        self.lane(key).put(task)
+        return task
+
+    def work(self, queue):
+        """Lane thread loop"""
+        while True:
+            task = queue.get()
+            if task is None:
+                break
+            try:
+                task.result = task.func(*task.args)
+            except Exception, err:
+                self.logger.error(err)
+                task.error = err
+            finally:
+                task.done.set()
+
+    @staticmethod
+    def wait(tasks):
+        """Wait until the tasks are done and return their results. If a task raised an
+        exception, the first one is raised once all of them are done"""
+        for task in tasks:
+            task.done.wait()
+        for task in tasks:
+            if task.error is not None:
+                raise task.error
+        return [task.result for task in tasks]
+
+    def stop(self):
+        """Stop the lanes once the queued tasks are done"""
+        for queue in self.queues:
+            queue.put(None)
@@ -0,0 +1,242 @@
+"""Leases of the shards of the stream, shared by several consumer processes through a DynamoDB
+table. The lease of a shard also holds its checkpoint"""
+import logging
+import math
+import os
+import socket
+import threading
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+
+from checkpoint import SHARD_END, TRIM_HORIZON
+
+
+def new_worker_id():
+    """Unique id of a consumer process"""
+    return "%s-%d-%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+def is_conditional_check_failed(err):
+    return err.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException'
+
+
+class LeaseManager(object):
+    """Splits the shards between the workers that share the lease table.
+
+    A lease item looks like:
+    {
+        'shard_id': shard id (hash key),
+        'owner': worker id, missing if nobody holds the lease,
+        'expires': epoch when the lease expires if the owner doesn't renew it,
+        'counter': incremented on each change of owner or renewal,
+        'checkpoint': sequence number of the last processed record, TRIM_HORIZON or SHARD_END,
+        'parent_shard_ids': shards that have to be processed before this one
+    }
+    Each worker renews its leases, takes the expired ones and steals from the most loaded
+    worker until every worker has its share. All the changes of a lease are conditional
+    updates, so a lease has one owner at a time"""
+
+    def __init__(self, dynamodb, table_name, worker_id=None, lease_duration=30,
+                 start_position='LATEST'):
+        self.table = dynamodb.Table(table_name)
+        self.worker_id = worker_id or new_worker_id()
+        self.lease_duration = lease_duration
+        self.start_position = start_position
+        self.logger = logging.getLogger("LeaseManager")
+        self.lock = threading.Lock()
+        # Shards whose lease is held by this worker
+        self.owned = set()
+
+    def list_leases(self):
+        """All the leases of the table"""
+        leases = []
+        kwargs = {'ConsistentRead': True}
+        while True:
+            response = self.table.scan(**kwargs)
+            leases.extend(response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                return leases
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def sync_shards(self, shards):
+        """Create the leases of the new shards of the stream and delete the leases of the
+        finished shards that are no longer in the stream (trimmed)"""
+        leases = dict((lease['shard_id'], lease) for lease in self.list_leases())
+        shard_ids = set(shard['ShardId'] for shard in shards)
+
+        for shard in shards:
+            shard_id = shard['ShardId']
+            if shard_id in leases:
+                continue
+            closed = 'EndingSequenceNumber' in shard.get('SequenceNumberRange', {})
+            parents = [parent for parent in (shard.get('ParentShardId'),
+                                             shard.get('AdjacentParentShardId'))
+                       if parent and parent in shard_ids]
+            followed = [parent for parent in parents if parent in leases]
+            if closed and not followed and self.start_position == 'LATEST':
+                # Nothing new will be written to it
+                continue
+            lease = {'shard_id': shard_id, 'counter': 0, 'expires': 0,
+                     'parent_shard_ids': parents}
+            if followed:
+                # A child is read from its start once its parents are finished
+                lease['checkpoint'] = TRIM_HORIZON
+            try:
+                self.table.put_item(Item=lease,
+                                    ConditionExpression='attribute_not_exists(shard_id)')
+                self.logger.info("Created lease of shard %s (parents %s)", shard_id, parents)
+            except ClientError, err:
+                if not is_conditional_check_failed(err):
+                    raise
+            leases[shard_id] = lease
+
+        for shard_id, lease in leases.iteritems():
+            if shard_id not in shard_ids and lease.get('checkpoint') == SHARD_END:
+                try:
+                    self.table.delete_item(
+                        Key={'shard_id': shard_id},
+                        ConditionExpression='#checkpoint = :end',
+                        ExpressionAttributeNames={'#checkpoint': 'checkpoint'},
+                        ExpressionAttributeValues={':end': SHARD_END})
+                    self.logger.info("Deleted lease of finished shard %s", shard_id)
+                except ClientError, err:
+                    if not is_conditional_check_failed(err):
+                        raise
+
+    def refresh(self):
+        """Renew the leases of this worker, take or steal leases until it has its share and
+        return the shards it holds"""
+        now = time.time()
+        leases = dict((lease['shard_id'], lease) for lease in self.list_leases())
+
+        # A shard can be processed once the shards it comes from are finished
+        available = {}
+        for shard_id, lease in leases.iteritems():
+            if lease.get('checkpoint') == SHARD_END:
+                continue
+            if all(leases[parent].get('checkpoint') == SHARD_END
+                   for parent in lease.get('parent_shard_ids', []) if parent in leases):
+                available[shard_id] = lease
+
+        with self.lock:
+            for shard_id in list(self.owned):
+                lease = available.get(shard_id, None)
+                if lease is None or lease.get('owner') != self.worker_id or \
+                        not self._renew(lease, now):
+                    self._lose(shard_id)
+
+            workers = {self.worker_id: 0}
+            expired = []
+            for shard_id, lease in available.iteritems():
+                if shard_id in self.owned:
+                    continue
+                owner = lease.get('owner', None)
+                if owner is None or lease.get('expires', 0) < now:
+                    expired.append(lease)
+                elif owner != self.worker_id:
+                    workers[owner] = workers.get(owner, 0) + 1
+            workers[self.worker_id] = len(self.owned)
+            target = int(math.ceil(len(available) / float(len(workers))))
+
+            for lease in expired:
+                if len(self.owned) >= target:
+                    break
+                self._take(lease, now)
+
+            if not expired and len(self.owned) < target:
+                # Steal one lease per round from the most loaded worker
+                victim, victim_leases = max(workers.iteritems(), key=lambda worker: worker[1])
+                if victim != self.worker_id and victim_leases > target:
+                    for lease in available.itervalues():
+                        if lease.get('owner') == victim:
+                            self.logger.info("Stealing shard %s from %s", lease['shard_id'],
+                                             victim)
+                            self._take(lease, now)
+                            break
+            return set(self.owned)
+
+    def _lose(self, shard_id):
+        self.logger.info("Lost lease of shard %s", shard_id)
+        self.owned.discard(shard_id)
+
+    def _renew(self, lease, now):
+        try:
+            self.table.update_item(
+                Key={'shard_id': lease['shard_id']},
+                UpdateExpression='SET #expires = :expires ADD #counter :one',
+                ConditionExpression='#owner = :owner',
+                ExpressionAttributeNames={'#owner': 'owner', '#counter': 'counter',
+                                          '#expires': 'expires'},
+                ExpressionAttributeValues={':owner': self.worker_id, ':one': 1,
+                                           ':expires': int(now + self.lease_duration)})
+            return True
+        except ClientError, err:
+            if not is_conditional_check_failed(err):
+                self.logger.error("Cannot renew lease of shard %s: %s", lease['shard_id'], err)
+            return False
+
+    def _take(self, lease, now):
+        """Take a lease if nobody changed it since it was read"""
+        try:
+            self.table.update_item(
+                Key={'shard_id': lease['shard_id']},
+                UpdateExpression='SET #owner = :owner, #expires = :expires, #counter = :next',
+                ConditionExpression='#counter = :counter',
+                ExpressionAttributeNames={'#owner': 'owner', '#counter': 'counter',
+                                          '#expires': 'expires'},
+                ExpressionAttributeValues={':owner': self.worker_id, ':counter': lease['counter'],
+                                           ':next': lease['counter'] + 1,
+                                           ':expires': int(now + self.lease_duration)})
+            self.logger.info("Took lease of shard %s", lease['shard_id'])
+            self.owned.add(lease['shard_id'])
+            return True
+        except ClientError, err:
+            if not is_conditional_check_failed(err):
+                self.logger.error("Cannot take lease of shard %s: %s", lease['shard_id'], err)
+            return False
+
+    def get(self, shard_id):
+        """Checkpoint of the shard, or None"""
+        item = self.table.get_item(Key={'shard_id': shard_id}, ConsistentRead=True).get('Item')
+        return item.get('checkpoint', None) if item else None
+
+    def checkpoint(self, shard_id, sequence_number):
+        """Store the checkpoint of a shard held by this worker. Returns False if the lease was
+        lost, then the shard must not be processed anymore"""
+        try:
+            self.table.update_item(
+                Key={'shard_id': shard_id},
+                UpdateExpression='SET #checkpoint = :checkpoint',
+                ConditionExpression='#owner = :owner',
+                ExpressionAttributeNames={'#owner': 'owner', '#checkpoint': 'checkpoint'},
+                ExpressionAttributeValues={':owner': self.worker_id,
+                                           ':checkpoint': sequence_number})
+            return True
+        except ClientError, err:
+            if not is_conditional_check_failed(err):
+                raise
+            with self.lock:
+                self._lose(shard_id)
+            return False
+
+    def flush(self):
+        """The checkpoints are stored as soon as they are made"""
+        pass
+
+    def release(self):
+        """Give up the leases of this worker, so the others take them without waiting for
+        them to expire"""
+        with self.lock:
+            for shard_id in list(self.owned):
+                try:
+                    self.table.update_item(
+                        Key={'shard_id': shard_id},
+                        UpdateExpression='SET #expires = :zero REMOVE #owner',
+                        ConditionExpression='#owner = :owner',
+                        ExpressionAttributeNames={'#owner': 'owner', '#expires': 'expires'},
+                        ExpressionAttributeValues={':owner': self.worker_id, ':zero': 0})
+                except ClientError, err:
+                    self.logger.error("Cannot release lease of shard %s: %s", shard_id, err)
+                self.owned.discard(shard_id)
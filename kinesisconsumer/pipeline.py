@@ -0,0 +1,237 @@
+"""Pipelined processing of a Kinesis shard"""
+import logging
+import threading
+import time
+from Queue import Queue
+
+from botocore.exceptions import ClientError
+
+from checkpoint import SHARD_END
+from prepare import decode_records
+from ratecontrol import RateController, WriterThrottling, KINESIS_THROTTLING_ERRORS
+
+# Sleep when the shard has no records, otherwise the provisioned throughput of the shard
+# will be consumed instantaneously
+EMPTY_SLEEP_TIME = 0.5
+
+
+class StageTimer(object):
+    """Accumulates the time spent by a stage of the pipeline"""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.seconds = 0.0
+        self.batches = 0
+        self.records = 0
+
+    def add(self, seconds, records):
+        """Add the time spent to process a batch of records"""
+        with self.lock:
+            self.seconds += seconds
+            self.batches += 1
+            self.records += records
+
+    def __str__(self):
+        with self.lock:
+            return "%s %.3fs/%d" % (self.name, self.seconds, self.batches)
+
+
+class ShardPipeline(object):
+    """Processes a shard in three stages joined by bounded queues: fetch (GetRecords),
+    decode (unpack the records) and write (DynamoDB). The next GetRecords is sent while the
+    current batch is being written, and a slow stage blocks the previous ones.
+
+    A batch that cannot be decoded or written is not checkpointed: the pipeline stops, and
+    the shard is processed again from the first record that was not written (resume_position)
+    """
+
+    def __init__(self, consumer, shard_id, position=None, queue_size=2):
+        self.consumer = consumer
+        self.shard_id = shard_id
+        # (iterator type, sequence number) to start reading, None to start after the
+        # checkpoint of the shard
+        self.position = position
+        self.logger = logging.getLogger("ShardPipeline")
+        self.fetched = Queue(maxsize=queue_size)
+        self.decoded = Queue(maxsize=queue_size)
+        self.timers = {
+            'fetch': StageTimer('fetch'),
+            'decode': StageTimer('decode'),
+            'write': StageTimer('write'),
+        }
+        self.stopped = False
+        # Set when a batch cannot be written, the batches after it are discarded
+        self.failed = False
+        self.first_sequence = None
+        self.last_written = None
+        # Set once all the records of a closed shard are fetched
+        self.shard_ended = False
+        self.rate = RateController(consumer.rate_bounds, consumer.batch_size,
+                                   consumer.sleep_time,
+                                   WriterThrottling(consumer.writer, consumer.update_throttling))
+
+    def run(self):
+        """Run the pipeline until the consumer stops or the shard is closed. Returns False if
+        it stopped because a batch could not be written"""
+        stages = [threading.Thread(target=self.fetch), threading.Thread(target=self.decode)]
+        for stage in stages:
+            stage.daemon = True
+            stage.start()
+        self.write()
+        return not self.failed
+
+    def stop(self):
+        """Stop fetching records, the ones already fetched are still written"""
+        self.stopped = True
+
+    def fail(self):
+        """Stop after a batch that cannot be written"""
+        self.failed = True
+        self.stop()
+
+    def resume_position(self):
+        """Position to process the shard again after a failure: after the last written record
+        or at the first fetched one"""
+        if self.last_written is not None:
+            return 'AFTER_SEQUENCE_NUMBER', self.last_written
+        if self.first_sequence is not None:
+            return 'AT_SEQUENCE_NUMBER', self.first_sequence
+        return self.position
+
+    def fetch(self):
+        """Fetch stage: read the records from the shard"""
+        consumer = self.consumer
+        if self.position is None:
+            shard_it = consumer.get_shard_iterator(self.shard_id)
+        else:
+            shard_it = consumer.get_shard_iterator(self.shard_id, self.position[1],
+                                                   self.position[0])
+        last_sequence = None
+        while consumer.run and not self.stopped:
+            if shard_it is None:
+                shard_it = self.refresh_iterator(last_sequence)
+                if shard_it is None:
+                    time.sleep(self.rate.error_sleep_time())
+                    continue
+            try:
+                start = time.time()
+                out = consumer.kinesis.get_records(ShardIterator=shard_it,
+                                                   Limit=self.rate.batch_size)
+                records = out["Records"]
+                self.timers['fetch'].add(time.time() - start, len(records))
+            except ClientError, err:
+                code = err.response.get('Error', {}).get('Code')
+                if code in KINESIS_THROTTLING_ERRORS:
+                    self.rate.on_throttled()
+                elif code == 'ExpiredIteratorException':
+                    # The write stage took too long, continue after the last fetched record
+                    shard_it = None
+                else:
+                    self.logger.error("[Shard %s] Cannot get records: %s", self.shard_id, err)
+                time.sleep(self.rate.error_sleep_time())
+                continue
+            except Exception, err:
+                self.logger.error("[Shard %s] Cannot get records: %s", self.shard_id, err)
+                time.sleep(self.rate.error_sleep_time())
+                continue
+
+            catching_up = self.rate.catching_up
+            self.rate.on_records(len(records), out.get('MillisBehindLatest', 0))
+            if self.rate.catching_up != catching_up:
+                consumer.set_catching_up(self.shard_id, self.rate.catching_up)
+
+            if records:
+                if self.first_sequence is None:
+                    self.first_sequence = records[0]['SequenceNumber']
+                last_sequence = records[-1]['SequenceNumber']
+                self.fetched.put(records)
+
+            # Get next shard iterator
+            shard_it = out.get('NextShardIterator', None)
+            if not shard_it:
+                self.logger.info("No next shard iterator, closing")
+                self.shard_ended = True
+                break
+
+            if records:
+                if self.rate.sleep_time > 0:
+                    time.sleep(self.rate.sleep_time)
+            else:
+                time.sleep(self.rate.idle_sleep_time(EMPTY_SLEEP_TIME))
+        if self.rate.catching_up:
+            consumer.set_catching_up(self.shard_id, False)
+        self.fetched.put(None)
+
+    def refresh_iterator(self, last_sequence):
+        """New iterator after the last fetched record, or None to retry later"""
+        try:
+            if last_sequence is None and self.position is not None:
+                return self.consumer.get_shard_iterator(self.shard_id, self.position[1],
+                                                        self.position[0])
+            return self.consumer.get_shard_iterator(self.shard_id, last_sequence)
+        except Exception, err:
+            self.logger.error("[Shard %s] Cannot get a shard iterator: %s", self.shard_id, err)
+            return None
+
+    def decode(self):
+        """Decode stage: unpack the points of the records and prepare their writes, in the pool
+        of processes of the consumer if it has one"""
+        decoder = self.consumer.decoder
+        while True:
+            records = self.fetched.get()
+            if records is None:
+                break
+            start = time.time()
+            datas = [record['Data'] for record in records]
+            try:
+                batch = decoder.decode(datas) if decoder is not None else decode_records(datas)
+            except Exception, err:
+                # The write stage stops at this batch
+                self.logger.error("[Shard %s] Cannot decode records: %s", self.shard_id, err)
+                batch = None
+            self.timers['decode'].add(time.time() - start, len(records))
+            self.decoded.put((records, batch))
+        self.decoded.put(None)
+
+    def write(self):
+        """Write stage: store and aggregate the points in DynamoDB"""
+        while True:
+            batch = self.decoded.get()
+            if batch is None:
+                if self.shard_ended and not self.failed:
+                    # The children of the shard can be processed now
+                    self.consumer.checkpoint(self.shard_id, SHARD_END)
+                break
+            if self.failed:
+                # They are fetched again when the shard is processed again
+                continue
+            records, prepared = batch
+            if prepared is None:
+                self.logger.error("[Shard %s] Records not decoded, stopping", self.shard_id)
+                self.fail()
+                continue
+            start = time.time()
+            try:
+                table = self.consumer.write_prepared(prepared, threaded=True,
+                                                     shard_id=self.shard_id)
+            except Exception, err:
+                self.logger.error("[Shard %s] Cannot write items, stopping: %s", self.shard_id,
+                                  err)
+                self.fail()
+                continue
+            self.last_written = records[-1]['SequenceNumber']
+            if not self.consumer.checkpoint(self.shard_id, self.last_written):
+                self.logger.info("[Shard %s] Lease lost, stopping", self.shard_id)
+                self.stop()
+            write_time = time.time() - start
+            self.timers['write'].add(write_time, len(records))
+
+            if table:
+                self.logger.info("[Table %s] Insert %d points from %d records in %s seconds. "
+                                 "WCU = %f (%s, %s, %s, limit %d, sleep %.2fs)", table,
+                                 prepared.points, len(records), write_time,
+                                 prepared.points / max(write_time, 0.001), self.timers['fetch'],
+                                 self.timers['decode'], self.timers['write'],
+                                 self.rate.batch_size, self.rate.sleep_time)
+                self.logger.debug("Batch writer stats: %s", self.consumer.writer.stats())
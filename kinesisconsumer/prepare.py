@@ -0,0 +1,177 @@
+"""Decoding of the records of a shard into the writes to send to DynamoDB. It can run in a pool
+of processes, so the CPU work of the shards is not serialized by the GIL"""
+import logging
+import math
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+
+from rollup.lambda_database import InsertItem, configure_dynamodb
+from rollup.timeserie_configuration import Configuration, is_reference, resolve_configurations
+from rollup import aggregations, blocks, granularities, stream_records
+
+LOGGER = logging.getLogger("PreparedBatch")
+
+
+class PreparedBatch(object):
+    """Writes of a batch of points: the raw points grouped by table and the rollups merged by
+    bucket"""
+
+    def __init__(self):
+        # Table -> {(timeserie, time): PutRequest}, a batch cannot contain the same key twice
+        self.table_items = OrderedDict()
+        # (table, granularity) -> {(timeserie, time): item} of the points stored in blocks
+        self.block_items = OrderedDict()
+        self.combiner = aggregations.RollupCombiner()
+        # Rollups of the minutes whose changes are carried to the upper granularities
+        self.cascade = aggregations.RollupCombiner(cascade=True)
+        # Rollups that cannot be merged: (granularity, insert_item, ts_conf)
+        self.rollups = []
+        self.points = 0
+
+    def add(self, item, ts_conf=None, time_converted=None):
+        """Add a point decoded from the stream, with its configuration and the time of its
+        bucket if it has to be aggregated"""
+        granularity = item['granularity']
+        insert_item = InsertItem.from_dict(item['data'])
+        self.points += 1
+
+        # Check if item has to be stored or aggregated
+        if 'aggregation' in item:
+            if ts_conf is None:
+                LOGGER.debug("No configuration for %s, it's not aggregated", insert_item)
+                return
+            if not item['aggregation'].get('cascade', False):
+                if not self.combiner.add(granularity, insert_item, ts_conf, time_converted):
+                    self.rollups.append((granularity, insert_item, ts_conf))
+            elif not self.cascade.add(granularity, insert_item, ts_conf, time_converted):
+                # It cannot be carried, so it's rolled up in every granularity
+                for upper_granularity, __ in aggregations.parent_times(
+                        granularity, insert_item.timestamp, ts_conf.timezone):
+                    self.rollups.append((upper_granularity, insert_item, ts_conf))
+                self.rollups.append((granularity, insert_item, ts_conf))
+        else:
+            table = granularities.get_granularity_table_text(granularity)
+            if blocks.is_blocked(granularity):
+                self.block_items.setdefault((table, granularity), OrderedDict())[
+                    (insert_item.seriename, str(insert_item.timestamp))] = \
+                    insert_item.to_dynamo_db()
+                return
+            dyn_batch_item = {'PutRequest': {'Item': insert_item.to_dynamo_db()}}
+            # The last value wins
+            self.table_items.setdefault(table, OrderedDict())[
+                (insert_item.seriename, str(insert_item.timestamp))] = dyn_batch_item
+
+    def merge(self, other):
+        """Merge the batch of the points that follow the ones of this batch"""
+        for table, items in other.table_items.iteritems():
+            self.table_items.setdefault(table, OrderedDict()).update(items)
+        for key, items in other.block_items.iteritems():
+            self.block_items.setdefault(key, OrderedDict()).update(items)
+        self.combiner.merge(other.combiner)
+        self.cascade.merge(other.cascade)
+        self.rollups.extend(other.rollups)
+        self.points += other.points
+
+
+def item_configurations(items):
+    """Configuration of each point, None for the ones that are not aggregated. The records
+    carry the whole configuration or a reference (timeserie, version) that is read from the
+    configuration table once per version. If they cannot be read the error is raised, so the
+    whole batch fails and it's not checkpointed"""
+    references = set()
+    for item in items:
+        conf_dict = item.get('aggregation', None)
+        if conf_dict is not None and is_reference(conf_dict):
+            references.add((conf_dict['timeserie'], conf_dict['version']))
+    resolved = resolve_configurations(configure_dynamodb(), references) if references else {}
+
+    configurations = []
+    for item in items:
+        conf_dict = item.get('aggregation', None)
+        if conf_dict is None:
+            configurations.append(None)
+        elif not is_reference(conf_dict):
+            configurations.append(Configuration.from_dict(conf_dict))
+        else:
+            key = (conf_dict['timeserie'], conf_dict['version'], conf_dict.get('aggregation'))
+            configuration = resolved.get(key, None)
+            if configuration is None:
+                configuration = resolved[key[:2]]
+                if configuration is not None and key[2] is not None:
+                    # The aggregation is overridden by the timeserie name
+                    configuration = configuration.with_aggregation(key[2])
+                resolved[key] = configuration
+            configurations.append(configuration)
+    return configurations
+
+
+def bucket_times(items, configurations):
+    """Time of the bucket of each aggregated point, None for the other points. The times of
+    the points of the same granularity and timezone are converted together"""
+    indexes = OrderedDict()
+    for index, (item, configuration) in enumerate(zip(items, configurations)):
+        if 'aggregation' in item and configuration is not None:
+            indexes.setdefault((item['granularity'], configuration.timezone), []).append(index)
+
+    times = [None] * len(items)
+    for (granularity, timezone), group in indexes.iteritems():
+        try:
+            converted = granularities.convert_times([items[index]['data']['time'] for index in
+                                                     group], timezone, [granularity])
+        except Exception, err:
+            # The points are converted one by one, which logs the ones that fail
+            LOGGER.warning('Cannot convert the times of %s in %s: %s', granularity, timezone,
+                           err)
+            continue
+        for index, time_converted in zip(group, converted[granularity]):
+            times[index] = time_converted
+    return times
+
+
+def prepare_items(items):
+    """Prepare the writes of the points decoded from the stream"""
+    batch = PreparedBatch()
+    configurations = item_configurations(items)
+    for item, configuration, time_converted in zip(items, configurations,
+                                                   bucket_times(items, configurations)):
+        batch.add(item, configuration, time_converted)
+    return batch
+
+
+def decode_records(datas):
+    """Unpack the data of Kinesis records and prepare the writes of their points"""
+    items = []
+    for data in datas:
+        try:
+            # A record can hold many points
+            items.extend(stream_records.unpack(data))
+        except Exception, err:
+            LOGGER.error("Cannot decode record: %s", err)
+    return prepare_items(items)
+
+
+class DecoderPool(object):
+    """Pool of processes that decode the records. Each process gets a contiguous chunk of the
+    raw record data and returns its writes already merged, so little is sent back"""
+
+    def __init__(self, processes=None, min_chunk_records=16):
+        self.processes = processes or cpu_count()
+        self.min_chunk_records = min_chunk_records
+        self.pool = Pool(self.processes)
+
+    def decode(self, datas):
+        """Decode the data of the records in the pool. Can be called from several threads"""
+        chunk_size = max(int(math.ceil(len(datas) / float(self.processes))),
+                         self.min_chunk_records)
+        chunks = [datas[start:start + chunk_size] for start in range(0, len(datas), chunk_size)]
+        if len(chunks) <= 1:
+            return decode_records(datas)
+
+        batch = PreparedBatch()
+        # The chunks are merged in order, so the last value of a key still wins
+        for prepared in self.pool.map(decode_records, chunks):
+            batch.merge(prepared)
+        return batch
+
+    def stop(self):
+        self.pool.close()
@@ -0,0 +1,201 @@
+"""Adaptive control of the rate at which a shard is read"""
+import json
+import logging
+import threading
+
+# Limits of Kinesis: a GetRecords call returns up to 10000 records, and a shard serves up to
+# 5 GetRecords calls per second
+MAX_GET_RECORDS = 10000
+MIN_POLL_DELAY = 0.2
+
+# Errors of Kinesis that mean that the shard is being read too fast
+KINESIS_THROTTLING_ERRORS = ('ProvisionedThroughputExceededException', 'LimitExceededException')
+# Errors of DynamoDB that mean that a table is written too fast
+DYNAMODB_THROTTLING_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException',
+                              'RequestLimitExceeded')
+
+
+class RateBounds(object):
+    """Floor and ceiling of the GetRecords Limit and of the delay between polls"""
+
+    def __init__(self, min_batch_size=1, max_batch_size=MAX_GET_RECORDS,
+                 min_sleep_time=MIN_POLL_DELAY, max_sleep_time=5.0):
+        self.min_batch_size = max(1, min(min_batch_size, max_batch_size))
+        self.max_batch_size = max(self.min_batch_size, min(max_batch_size, MAX_GET_RECORDS))
+        self.min_sleep_time = max(0.0, min(min_sleep_time, max_sleep_time))
+        self.max_sleep_time = max(self.min_sleep_time, max_sleep_time)
+
+    @classmethod
+    def from_file(cls, parameter_file):
+        """Read the bounds of a parameters file. The files of the fixed rate consumer have
+        BATCH_SIZE and SLEEP_TIME instead, which are both bounds when the new keys are missing.
+        Otherwise the missing keys keep the default bounds"""
+        with open(parameter_file, "r") as parameters:
+            parameters_json = json.load(parameters)
+        defaults = cls()
+        fixed = dict((key, parameters_json[key]) for key in ("BATCH_SIZE", "SLEEP_TIME")
+                     if key in parameters_json)
+        if fixed:
+            logging.getLogger("RateBounds").warning(
+                "%s has the deprecated keys %s, they're used as the bounds that are missing",
+                parameter_file, ", ".join(sorted(fixed)))
+
+        def bound(key, fixed_key, default):
+            return parameters_json.get(key, fixed.get(fixed_key, default))
+
+        return cls(int(bound("MIN_BATCH_SIZE", "BATCH_SIZE", defaults.min_batch_size)),
+                   int(bound("MAX_BATCH_SIZE", "BATCH_SIZE", defaults.max_batch_size)),
+                   float(bound("MIN_SLEEP_TIME", "SLEEP_TIME", defaults.min_sleep_time)),
+                   float(bound("MAX_SLEEP_TIME", "SLEEP_TIME", defaults.max_sleep_time)))
+
+    def __str__(self):
+        return "batch size [%d, %d], sleep time [%.2f, %.2f]" % (
+            self.min_batch_size, self.max_batch_size, self.min_sleep_time, self.max_sleep_time)
+
+
+class UpdateThrottling(object):
+    """Counts the UpdateItem calls of the rollups and the ones that DynamoDB throttled, with the
+    events of the botocore client. botocore retries them, so they only show up as retries"""
+
+    def __init__(self, dynamodb):
+        self.lock = threading.Lock()
+        self.updates = 0
+        self.throttles = 0
+        events = dynamodb.meta.client.meta.events
+        events.register('before-parameter-build.dynamodb.UpdateItem', self.on_call)
+        events.register('needs-retry.dynamodb.UpdateItem', self.on_response)
+
+    def on_call(self, **kwargs):
+        with self.lock:
+            self.updates += 1
+
+    def on_response(self, response=None, **kwargs):
+        if response is None:
+            return None
+        code = response[1].get('Error', {}).get('Code')
+        if code in DYNAMODB_THROTTLING_ERRORS:
+            with self.lock:
+                self.throttles += 1
+        # Let the retry handler of botocore decide
+        return None
+
+    def counters(self):
+        """UpdateItem calls and throttled attempts so far"""
+        with self.lock:
+            return self.updates, self.throttles
+
+
+class WriterThrottling(object):
+    """Rate of the DynamoDB writes that were throttled since the last check of a controller.
+    The counters of the writer and the rollups are cumulative and shared by all the shards, so
+    each controller keeps its own snapshot of them"""
+
+    def __init__(self, writer, updates=None):
+        self.writer = writer
+        self.updates = updates
+        self.snapshot = self.counters()
+
+    def counters(self):
+        """Written batches, their retries and failures, rollup updates and their throttles"""
+        batches, retries, failures = self.writer.counters()
+        updates, throttles = self.updates.counters() if self.updates is not None else (0, 0)
+        return batches, retries + failures, updates, throttles
+
+    def rate(self):
+        """Highest rate of retries per written batch or of throttles per rollup update since
+        the last call"""
+        counters = self.counters()
+        batches, retries, updates, throttles = [
+            current - previous for current, previous in zip(counters, self.snapshot)]
+        self.snapshot = counters
+        batch_rate = retries / float(batches) if batches > 0 else 0.0
+        update_rate = throttles / float(updates) if updates > 0 else 0.0
+        return max(batch_rate, update_rate)
+
+
+class RateController(object):
+    """AIMD controller of the GetRecords Limit and the delay between polls of a shard.
+
+    While the shard is behind and the batches are full the Limit grows and the delay shrinks
+    additively. When Kinesis or DynamoDB throttle, the Limit is halved and the delay doubled.
+
+    When the shard is far behind (a backlog after a deploy or an outage) the controller switches
+    to catch-up mode: maximum Limit and no delay, until the shard is caught up and the previous
+    rate is restored"""
+
+    def __init__(self, bounds, batch_size, sleep_time, throttling=None, behind_threshold=5000,
+                 max_retry_rate=0.1, batch_step=100, sleep_step=0.05, decrease_factor=0.5,
+                 catch_up_threshold=60000):
+        self.bounds = bounds
+        self.batch_size = min(max(batch_size, bounds.min_batch_size), bounds.max_batch_size)
+        self.sleep_time = min(max(sleep_time, bounds.min_sleep_time), bounds.max_sleep_time)
+        self.throttling = throttling
+        self.behind_threshold = behind_threshold
+        self.max_retry_rate = max_retry_rate
+        self.batch_step = batch_step
+        self.sleep_step = sleep_step
+        self.decrease_factor = decrease_factor
+        self.catch_up_threshold = catch_up_threshold
+        self.catching_up = False
+        self.steady_rate = None
+        self.logger = logging.getLogger("RateController")
+
+    def on_records(self, records, millis_behind):
+        """Adjust the rate after a GetRecords call that returned a number of records"""
+        if self.catching_up:
+            if millis_behind <= self.behind_threshold:
+                self.leave_catch_up(millis_behind)
+            return
+        if self.catch_up_threshold is not None and millis_behind > self.catch_up_threshold:
+            self.enter_catch_up(millis_behind)
+        elif self.throttling is not None and self.throttling.rate() > self.max_retry_rate:
+            self.decrease("DynamoDB throttling")
+        elif millis_behind > self.behind_threshold and records >= self.batch_size:
+            self.increase()
+
+    def on_throttled(self):
+        """Adjust the rate after Kinesis throttled a GetRecords call. While catching up the rate
+        is kept, the caller waits error_sleep_time before the next call"""
+        if not self.catching_up:
+            self.decrease("Kinesis throttling")
+
+    def enter_catch_up(self, millis_behind):
+        self.logger.info("Catching up, %d ms behind the stream", millis_behind)
+        self.catching_up = True
+        self.steady_rate = (self.batch_size, self.sleep_time)
+        self.batch_size = self.bounds.max_batch_size
+        self.sleep_time = 0.0
+
+    def leave_catch_up(self, millis_behind):
+        self.logger.info("Caught up, %d ms behind the stream", millis_behind)
+        self.catching_up = False
+        self.batch_size, self.sleep_time = self.steady_rate
+        self.steady_rate = None
+
+    def increase(self):
+        """Additive increase"""
+        batch_size = min(self.batch_size + self.batch_step, self.bounds.max_batch_size)
+        sleep_time = max(self.sleep_time - self.sleep_step, self.bounds.min_sleep_time)
+        self.set_rate(batch_size, sleep_time, "behind the stream")
+
+    def decrease(self, reason):
+        """Multiplicative decrease"""
+        batch_size = max(int(self.batch_size * self.decrease_factor), self.bounds.min_batch_size)
+        sleep_time = min(max(self.sleep_time / self.decrease_factor, self.sleep_step),
+                         self.bounds.max_sleep_time)
+        self.set_rate(batch_size, sleep_time, reason)
+
+    def set_rate(self, batch_size, sleep_time, reason):
+        if batch_size != self.batch_size or sleep_time != self.sleep_time:
+            self.logger.debug("New batch size %d and sleep time %.2f (%s)", batch_size,
+                              sleep_time, reason)
+        self.batch_size = batch_size
+        self.sleep_time = sleep_time
+
+    def error_sleep_time(self):
+        """Delay before retrying a failed GetRecords call"""
+        return max(self.sleep_time, self.bounds.min_sleep_time, MIN_POLL_DELAY)
+
+    def idle_sleep_time(self, empty_sleep_time):
+        """Delay before polling again a shard that returned no records"""
+        return min(max(self.sleep_time, empty_sleep_time), self.bounds.max_sleep_time)
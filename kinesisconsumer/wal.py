@@ -0,0 +1,159 @@
+"""Write-ahead log of the buckets buffered by the consumer"""
+import cPickle
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+# Kinds of records: a point delta merged into a buffered bucket, or the buffered buckets that
+# were written to DynamoDB
+RECORD_DELTA = 1
+RECORD_DONE = 2
+# Length and CRC32 of the payload and kind of record. A zero length is the end of a segment
+HEADER = struct.Struct('>IIB')
+SEGMENT_SUFFIX = '.wal'
+# Max number of bucket ids of a done record
+MAX_DONE_IDS = 1024
+
+
+class BucketLog(object):
+    """Append-only log of the deltas of the buffered buckets, in memory-mapped segment files
+    of a local directory.
+
+    Each delta is logged with the id of the buffered bucket it's merged into, and once a
+    bucket is written to DynamoDB its id is logged as done. The log is synced by the callers
+    that need durability, so all the records appended since the last sync are flushed
+    together. The segments whose buckets are all done are deleted.
+
+    After a restart the deltas of the buckets that are not done are replayed into the buffer.
+    A bucket written just before a crash, whose done record was not synced yet, is written
+    again: like the records of Kinesis processed after the last checkpoint"""
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.logger = logging.getLogger("BucketLog")
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                               if name.endswith(SEGMENT_SUFFIX))
+        self.segment = None
+        self.map = None
+        self.offset = 0
+        self.appended = 0
+        self.synced = 0
+        # Highest bucket id of the segments of the previous runs, set by replay. The ids of a
+        # run continue after it, so the done records of a run never match the buckets of the
+        # segments of a previous run that were not deleted
+        self.last_entry_id = 0
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, '%020d%s' % (number, SEGMENT_SUFFIX))
+
+    def replay(self):
+        """Deltas of the segments of a previous run whose buckets are not done, in the order
+        they were logged, as [(granularity, bucket, time_converted)]"""
+        deltas = OrderedDict()
+        done = set()
+        for number in self.segments:
+            with open(self.segment_path(number), 'rb') as segment_file:
+                data = segment_file.read()
+            for kind, payload in self._records(data, number):
+                if kind == RECORD_DELTA:
+                    entry_id, granularity, bucket, time_converted = cPickle.loads(payload)
+                    deltas.setdefault(entry_id, []).append((granularity, bucket, time_converted))
+                    self.last_entry_id = max(self.last_entry_id, entry_id)
+                elif kind == RECORD_DONE:
+                    entry_ids = struct.unpack('>%dQ' % (len(payload) / 8), payload)
+                    done.update(entry_ids)
+                    self.last_entry_id = max((self.last_entry_id, ) + entry_ids)
+        replayed = [delta for entry_id, entry_deltas in deltas.iteritems()
+                    if entry_id not in done for delta in entry_deltas]
+        self.logger.info("Replaying %d deltas of %d segments", len(replayed), len(self.segments))
+        return replayed
+
+    def _records(self, data, number):
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            length, crc, kind = HEADER.unpack_from(data, offset)
+            if not length:
+                break
+            payload = data[offset + HEADER.size:offset + HEADER.size + length]
+            if len(payload) != length or zlib.crc32(payload) & 0xFFFFFFFF != crc:
+                # A record that was being written when the process stopped
+                self.logger.warning("Truncated record in segment %d at %d", number, offset)
+                break
+            yield kind, payload
+            offset += HEADER.size + length
+
+    def append_delta(self, entry_id, granularity, bucket, time_converted):
+        """Log a delta merged into the buffered bucket entry_id. Returns the segment number"""
+        payload = cPickle.dumps((entry_id, granularity, bucket, time_converted),
+                                cPickle.HIGHEST_PROTOCOL)
+        return self._append(RECORD_DELTA, payload)
+
+    def append_done(self, entry_ids):
+        """Log that the buffered buckets are written"""
+        for start in range(0, len(entry_ids), MAX_DONE_IDS):
+            chunk = entry_ids[start:start + MAX_DONE_IDS]
+            self._append(RECORD_DONE, struct.pack('>%dQ' % len(chunk), *chunk))
+
+    def _append(self, kind, payload):
+        size = HEADER.size + len(payload)
+        with self.lock:
+            if self.map is None or self.offset + size + HEADER.size > self.segment_size:
+                self._rotate(size)
+            self.map[self.offset:self.offset + size] = \
+                HEADER.pack(len(payload), zlib.crc32(payload) & 0xFFFFFFFF, kind) + payload
+            self.offset += size
+            self.appended += 1
+            return self.segment
+
+    def _rotate(self, size):
+        """Close the current segment and start a new one"""
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+        self.segment = self.segments[-1] + 1 if self.segments else 1
+        self.segments.append(self.segment)
+        with open(self.segment_path(self.segment), 'w+b') as segment_file:
+            # Preallocated, so the appends don't change the size of the file
+            segment_file.truncate(max(self.segment_size, size + HEADER.size))
+            self.map = mmap.mmap(segment_file.fileno(), 0)
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.offset = 0
+
+    def sync(self):
+        """Flush the records appended so far to the disk. The records appended by other threads
+        while a sync is running are flushed by the same sync"""
+        with self.lock:
+            if self.map is not None and self.synced < self.appended:
+                self.map.flush()
+                self.synced = self.appended
+
+    def release(self, first_needed):
+        """Delete the segments before first_needed, but never the current one"""
+        with self.lock:
+            for number in list(self.segments):
+                if number >= first_needed or number == self.segment:
+                    break
+                try:
+                    os.remove(self.segment_path(number))
+                except OSError, err:
+                    self.logger.error("Cannot delete segment %d: %s", number, err)
+                self.segments.remove(number)
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.flush()
+                self.map.close()
+                self.map = None
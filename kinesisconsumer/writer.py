@@ -0,0 +1,163 @@
+"""Pool of threads that write the batches to DynamoDB"""
+import logging
+import random
+import threading
+import time
+from collections import deque
+from Queue import Queue
+
+from botocore.exceptions import ClientError
+
+# Errors of DynamoDB that mean that the request has to be retried later
+THROTTLING_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException',
+                     'RequestLimitExceeded')
+
+
+class WriteError(Exception):
+    """Some points of a batch could not be written, its records must not be checkpointed"""
+
+
+class WriteTask(object):
+    """A batch queued in the writer and whether it was written"""
+
+    def __init__(self, request_items):
+        self.request_items = request_items
+        self.written = False
+        self.done = threading.Event()
+
+
+class BatchWriter(object):
+    """Long lived and bounded pool of threads that write BatchWriteItem batches concurrently.
+
+    The unprocessed items are retried with exponential backoff and jitter"""
+
+    def __init__(self, dynamodb, workers=8, max_in_flight=32, max_retries=10,
+                 base_backoff=0.05, max_backoff=5.0, latency_window=1000):
+        self.dynamodb = dynamodb
+        self.logger = logging.getLogger("BatchWriter")
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        # Max number of batches queued or being written, submit blocks when it's reached
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.queue = Queue()
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=latency_window)
+        self.batches = 0
+        self.retries = 0
+        self.failures = 0
+        self.workers = 0
+        self.threads = []
+        self.resize(workers)
+
+    def resize(self, workers):
+        """Change the number of worker threads. The extra ones stop once the batches queued
+        before them are written"""
+        with self.lock:
+            for __ in range(workers - self.workers):
+                thread = threading.Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            for __ in range(self.workers - workers):
+                self.queue.put(None)
+            self.workers = workers
+            self.threads = [thread for thread in self.threads if thread.is_alive()]
+
+    def submit(self, request_items):
+        """Queue a batch to be written. Returns its task, whose event is set once it's done"""
+        self.in_flight.acquire()
+        task = WriteTask(request_items)
+        self.queue.put(task)
+        return task
+
+    def write(self, batches):
+        """Write the batches concurrently and wait until all of them are done. Returns True if
+        all of them were written"""
+        pending = [self.submit(batch) for batch in batches]
+        for task in pending:
+            task.done.wait()
+        return all(task.written for task in pending)
+
+    def write_sequential(self, batches):
+        """Write the batches one after the other in the calling thread. Returns True if all of
+        them were written"""
+        written = True
+        for batch in batches:
+            written = self.write_batch(batch) and written
+        return written
+
+    def work(self):
+        """Worker thread loop"""
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            try:
+                task.written = self.write_batch(task.request_items)
+            except Exception, err:
+                self.logger.error(err)
+            finally:
+                self.in_flight.release()
+                task.done.set()
+
+    def backoff(self, attempt):
+        """Sleep with exponential backoff and full jitter"""
+        time.sleep(random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt)))
+
+    def write_batch(self, request_items):
+        """Write a batch retrying the unprocessed items. Returns True if everything is written"""
+        start = time.time()
+        attempt = 0
+        written = False
+        while request_items:
+            try:
+                response = self.dynamodb.batch_write_item(RequestItems=request_items)
+                self.logger.debug(response)
+                request_items = response['UnprocessedItems']
+            except ClientError, err:
+                if err.response.get('Error', {}).get('Code') not in THROTTLING_ERRORS:
+                    self.logger.error(err)
+                    break
+            except Exception, err:
+                self.logger.error(err)
+                break
+
+            if not request_items:
+                written = True
+                break
+            if attempt >= self.max_retries:
+                self.logger.error('Dropping %d unprocessed items after %d retries',
+                                  sum(len(items) for items in request_items.values()), attempt)
+                break
+            self.backoff(attempt)
+            attempt += 1
+
+        with self.lock:
+            self.latencies.append(time.time() - start)
+            self.batches += 1
+            self.retries += attempt
+            if not written:
+                self.failures += 1
+        return written
+
+    def counters(self):
+        """Written batches, retries and failures so far"""
+        with self.lock:
+            return self.batches, self.retries, self.failures
+
+    def stats(self):
+        """Latency percentiles (seconds) of the last batches and counters"""
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = {'batches': self.batches, 'retries': self.retries,
+                     'failures': self.failures}
+        if latencies:
+            stats['p50'] = latencies[len(latencies) / 2]
+            stats['p99'] = latencies[int(len(latencies) * 0.99)]
+            stats['max'] = latencies[-1]
+        return stats
+
+    def stop(self):
+        """Stop the threads once the queued batches are written"""
+        self.resize(0)
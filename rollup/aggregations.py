@@ -1,9 +1,11 @@
 """Module that performs aggregations"""
 import logging
+from collections import OrderedDict
 from decimal import Decimal
-from granularities import convert_time, GRANULARITY_TEXT_VALUE, get_granularity_table, get_interval, \
-    get_granularity_table_text
+import granularities
+from granularities import convert_time, get_granularity_table_text
 from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
 
 AGGREGATION_AVG = 'average'
 AGGREGATION_SUM = 'sum'
@@ -20,6 +22,18 @@ AGGREGATION_COUNT = "count"
 
 DEFAULT_AGGREGATION = AGGREGATION_SUM
 
+# Rollup modes: every point is aggregated in every granularity, or in the minutes and the
+# changes of each granularity are carried to the next one
+ROLLUP_FANOUT = 'fanout'
+ROLLUP_CASCADE = 'cascade'
+
+# Attributes that keep the running sum and count of the average aggregations
+AVG_SUM_ATTR = 'sum'
+AVG_COUNT_ATTR = 'count'
+# Attribute that keeps the absolute value of the abs_max and abs_min aggregations, DynamoDB
+# cannot compare absolute values in a condition
+ABS_VALUE_ATTR = 'abs_value'
+
 LOGGER = logging.getLogger(__name__)
 
 
@@ -38,14 +52,45 @@ class Aggregation(object):
         self.old_value = None
         self.time_original = None
         self.timezone = timezone
+        # Number of points already merged into the value (only for the averages)
+        self.count = None
+
+
+def is_conditional_check_failed(err):
+    return err.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException'
+
+
+def conditional_update(aggregation, **kwargs):
+    """Update the bucket of the aggregation if its condition holds. Returns False if the
+    condition does not hold, the bucket already has a better value and nothing changes"""
+    try:
+        response = aggregation.table.update_item(
+            Key={
+                'timeserie': aggregation.timeserie,
+                'time': str(aggregation.item_time),
+            },
+            ReturnValues="UPDATED_NEW",
+            **kwargs
+        )
+    except ClientError, err:
+        if not is_conditional_check_failed(err):
+            raise
+        LOGGER.debug('No change in item %s-%s with value %s', aggregation.timeserie,
+                     aggregation.item_time, aggregation.value)
+        return False
+    LOGGER.debug('Updating item %s-%s setting value %s', aggregation.timeserie,
+                 aggregation.item_time, aggregation.value)
+    LOGGER.debug('Response : %s', response)
+    return True
 
 
 def add_increment_ddb(aggregation):
     """Add value directly in the dynamo DB query"""
 
     if aggregation.old_value is not None:
-        # Subtract the values and sum this difference to the result
-        aggregation.value = float(aggregation.value) - float(aggregation.old_value)
+        # Subtract the values and sum this difference to the result. In decimal, the
+        # difference of two floats is not exact
+        aggregation.value = Decimal(str(aggregation.value)) - Decimal(str(aggregation.old_value))
 
     response = aggregation.table.update_item(
         Key={
@@ -98,11 +143,8 @@ def set_last_value(aggregation):
     """Perform the aggregation last. The higher resolution always keep the last value
     inserted"""
 
-    response = aggregation.table.update_item(
-        Key={
-            'timeserie': aggregation.timeserie,
-            'time': str(aggregation.item_time),
-        },
+    return conditional_update(
+        aggregation,
         UpdateExpression="SET #value = :cur_value, #ttl = :ttl, #last_time = :last_time",
         ConditionExpression=':last_time >= #last_time or attribute_not_exists('
                             '#last_time)',
@@ -111,210 +153,170 @@ def set_last_value(aggregation):
         ExpressionAttributeValues={':cur_value': Decimal(aggregation.value),
                                    ':ttl': long(aggregation.ttl),
                                    ':last_time': str(aggregation.time_original)
-                                   },
-
-        ReturnValues="UPDATED_NEW"
+                                   }
     )
-    LOGGER.debug('Updating item %s-%s setting value %s', aggregation.timeserie,
-                 aggregation.item_time, aggregation.value)
-    LOGGER.debug('Response : %s', response)
-    return True
 
 
 def set_max_value(aggregation):
     """Updates the value only if the value is greater than the consolidated value"""
-    response = aggregation.table.update_item(
-        Key={
-            'timeserie': aggregation.timeserie,
-            'time': str(aggregation.item_time),
-        },
+    return conditional_update(
+        aggregation,
         UpdateExpression="SET #value = :cur_value, #ttl = :ttl",
         ConditionExpression=':cur_value > #value or attribute_not_exists(#value)',
         ExpressionAttributeNames={'#value': 'value', '#ttl': 'ttl'},
         ExpressionAttributeValues={':cur_value': Decimal(aggregation.value),
-                                   ':ttl': long(aggregation.ttl)},
-        ReturnValues="UPDATED_NEW"
+                                   ':ttl': long(aggregation.ttl)}
     )
-    LOGGER.debug('Updating item %s-%s setting value %s', aggregation.timeserie,
-                 aggregation.item_time, aggregation.value)
-    LOGGER.debug('Response : %s', response)
-    return True
 
 
 def set_min_value(aggregation):
     """Updates the value only if the value is lower than the consolidated value"""
-    response = aggregation.table.update_item(
-        Key={
-            'timeserie': aggregation.timeserie,
-            'time': str(aggregation.item_time),
-        },
+    return conditional_update(
+        aggregation,
         UpdateExpression="SET #value = :cur_value, #ttl = :ttl",
         ConditionExpression=':cur_value < #value or attribute_not_exists(#value)',
         ExpressionAttributeNames={'#value': 'value', '#ttl': 'ttl'},
         ExpressionAttributeValues={':cur_value': Decimal(aggregation.value),
-                                   ':ttl': long(aggregation.ttl)},
-        ReturnValues="UPDATED_NEW"
+                                   ':ttl': long(aggregation.ttl)}
     )
-    LOGGER.debug('Updating item %s-%s adding value %s', aggregation.timeserie,
-                 aggregation.item_time, aggregation.value)
-    LOGGER.debug('Response : %s', response)
-    return True
-
-
-def set_max_value_abs(aggregation):
-    """Same as set_max_value but with absolute numbers"""
 
-    # DynamoDB does not provide support for abs numbers, so we need to gather the data
-    # for database and perform abs transformation
 
-    response = aggregation.table.query(
-        KeyConditionExpression=Key('timeserie').eq(str(aggregation.timeserie)) & Key(
-            'time').eq(str(aggregation.item_time))
+def set_abs_value(aggregation, condition):
+    """Updates the value and its absolute value if the condition between the absolute value
+    of the point (:abs, :neg_abs for its opposite) and the consolidated one holds.
+
+    The buckets written before the absolute value was kept only have the value, the condition
+    compares it with the range of values whose absolute value is lower than :abs"""
+    value = Decimal(aggregation.value)
+    return conditional_update(
+        aggregation,
+        UpdateExpression="SET #value = :cur_value, #abs = :abs, #ttl = :ttl",
+        ConditionExpression=condition,
+        ExpressionAttributeNames={'#value': 'value', '#abs': ABS_VALUE_ATTR, '#ttl': 'ttl'},
+        ExpressionAttributeValues={':cur_value': value, ':abs': abs(value),
+                                   ':neg_abs': -abs(value), ':ttl': long(aggregation.ttl)}
     )
-    items = response['Items']
-    if not items:
-        cur_value = None
-    else:
-        cur_value = float(items[0]['value'])
 
-    if cur_value:
-        LOGGER.debug('New value %s vs Current value %s Result: %s', aggregation.value,
-                     cur_value,
-                     abs(float(aggregation.value)) > abs(float(cur_value)))
-
-    if cur_value is None or abs(float(aggregation.value)) > abs(float(cur_value)):
-        LOGGER.debug('Setting current value to %s', aggregation.value)
-        response = aggregation.table.update_item(
-            Key={
-                'timeserie': aggregation.timeserie,
-                'time': str(aggregation.item_time),
-            },
-            UpdateExpression="SET #value = :cur_value, #ttl = :ttl",
-            ExpressionAttributeNames={'#value': 'value', '#ttl': 'ttl'},
-            ExpressionAttributeValues={':cur_value': Decimal(aggregation.value),
-                                       ':ttl': long(aggregation.ttl)},
 
-            ReturnValues="UPDATED_NEW"
-        )
-        LOGGER.debug('Updating item %s-%s setting value %s', aggregation.timeserie,
-                     aggregation.item_time, aggregation.value)
-        LOGGER.debug('Response : %s', response)
+def set_max_value_abs(aggregation):
+    """Same as set_max_value but with absolute numbers"""
+    return set_abs_value(aggregation,
+                         'attribute_not_exists(#value) or :abs > #abs or '
+                         '(attribute_not_exists(#abs) and #value > :neg_abs and '
+                         '#value < :abs)')
 
 
 def set_min_value_abs(aggregation):
     """Same as set_min_value but with absolute numbers"""
-
-    # DynamoDB does not provide support for abs numbers, so we need to gather the data
-    # for database and perform abs transformation
-
-    response = aggregation.table.query(
-        KeyConditionExpression=Key('timeserie').eq(str(aggregation.timeserie)) & Key(
-            'time').eq(str(aggregation.item_time))
-    )
-    items = response['Items']
-    if not items:
-        cur_value = None
-    else:
-        cur_value = float(items[0]['value'])
-
-    if cur_value:
-        LOGGER.debug('New value %s vs Current value %s Result: %s', aggregation.value,
-                     cur_value, abs(float(aggregation.value)) < abs(float(cur_value)))
-
-    if cur_value is None or abs(float(aggregation.value)) < abs(float(cur_value)):
-        LOGGER.debug('Setting current value to %s', aggregation.value)
-        response = aggregation.table.update_item(
-            Key={
-                'timeserie': aggregation.timeserie,
-                'time': str(aggregation.item_time),
-            },
-            UpdateExpression="SET #value = :cur_value, #ttl = :ttl",
-            ExpressionAttributeNames={'#value': 'value', '#ttl': 'ttl'},
-            ExpressionAttributeValues={':cur_value': Decimal(aggregation.value),
-                                       ':ttl': long(aggregation.ttl)},
-
-            ReturnValues="UPDATED_NEW"
-        )
-        LOGGER.debug('Updating item %s-%s setting value %s', aggregation.timeserie,
-                     aggregation.item_time, aggregation.value)
-        LOGGER.debug('Response : %s', response)
+    return set_abs_value(aggregation,
+                         'attribute_not_exists(#value) or :abs < #abs or '
+                         '(attribute_not_exists(#abs) and (#value > :abs or '
+                         '#value < :neg_abs))')
+
+
+def get_item_value(item):
+    """Get the value of a stored item. The averages are stored as a running sum and count,
+    so their value is computed at read time (the ones not updated since then still have the
+    average in the value). Returns None if there is no value"""
+    if AVG_COUNT_ATTR in item:
+        avg_count = item[AVG_COUNT_ATTR]
+        if not avg_count:
+            return None
+        return float(item[AVG_SUM_ATTR]) / float(avg_count)
+    return float(item['value'])
+
+
+def query_pages(table, timeserie, start, end, page_size=None):
+    """Generator that queries the items of a timeserie in [start, end] following the
+    DynamoDB pagination. Yields the items page by page; if page_size is set no more than
+    page_size items are read in each page"""
+    query_args = {
+        'KeyConditionExpression': Key('timeserie').eq(timeserie) & Key('time').between(
+            str(start), str(end))
+    }
+    if page_size is not None:
+        query_args['Limit'] = page_size
+
+    while True:
+        response = table.query(**query_args)
+        items = response['Items']
+        LOGGER.debug('Page of %d items for %s', len(items), timeserie)
+        yield items
+
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
 
 
 def get_data_from_table(tbl_name, aggregation, start, end):
     """Performs the query to extract the data from the given table"""
-    low_gran_count = None
-    low_gran_values = None
     LOGGER.debug('Querying table %s [%s,%s]', tbl_name, start, end)
-    response = aggregation.dynamo_cli.Table(tbl_name).query(
-        KeyConditionExpression=Key('timeserie').eq(aggregation.timeserie) & Key(
-            'time').between(str(start), str(end))
-    )
-    low_gran_times = None
-    if response:
-        low_gran_count = response['Count']
-        low_gran_values = [float(item['value']) for item in response['Items']]
-        low_gran_times = [float(item['time']) for item in response['Items']]
+    low_gran_values = []
+    low_gran_times = []
+    for items in query_pages(aggregation.dynamo_cli.Table(tbl_name), aggregation.timeserie,
+                             start, end):
+        low_gran_values.extend(get_item_value(item) for item in items)
+        low_gran_times.extend(float(item['time']) for item in items)
+    low_gran_count = len(low_gran_values)
     LOGGER.debug('%s Results: %s', low_gran_count, low_gran_values)
     return low_gran_count, low_gran_values, low_gran_times
 
 
-def average(aggregation, discard_zeros=False):
-    """Perform the average aggregation"""
+def average_increments(value, old_value, discard_zeros=False):
+    """Compute how a point changes the running sum and count of an average"""
+    value = Decimal(str(value))
+    if old_value is None:
+        if discard_zeros and value == 0:
+            return Decimal(0), 0
+        return value, 1
 
-    # This method take the data from the inmediate lower granularity and computes the
-    # average, then it insert the new average
-    try:
-        # Calculate the inmediate lower granularity:
-        LOGGER.debug('Requested granularity is %s', aggregation.granularity)
-        gran_value = GRANULARITY_TEXT_VALUE[aggregation.granularity]
-        LOGGER.debug('Converted to granularity with value %s', gran_value)
-        tbl_lower_gran_name = get_granularity_table(gran_value - 1)
-        LOGGER.debug('Will query table %s', tbl_lower_gran_name)
-
-        # Need to compute the period to query
-        start, end = get_interval(gran_value, aggregation.item_time, aggregation.timezone)
-        LOGGER.debug('Compute period: %s %s', start, end)
-
-    except KeyError, e:
-        LOGGER.error('Exception configuring tables: %s', e)
-        raise e
-
-    low_gran_count, low_gran_values, __ = get_data_from_table(tbl_lower_gran_name,
-                                                              aggregation, start, end)
+    # Update of an already inserted point, only the difference has to be added
+    old_value = Decimal(str(old_value))
     if discard_zeros:
-        without_zeros = [value for value in low_gran_values if value != 0]
-        low_gran_values = without_zeros
-        low_gran_count = len(without_zeros)
+        if old_value == 0 and value != 0:
+            return value, 1
+        if old_value != 0 and value == 0:
+            return -old_value, -1
+    return value - old_value, 0
 
-    if low_gran_count and low_gran_values:
 
-        LOGGER.debug('Going to perform average on %s', low_gran_values)
-
-        # Compute the average
-        avg_value = sum(low_gran_values) / float(low_gran_count)
+def average(aggregation, discard_zeros=False):
+    """Perform the average aggregation"""
 
-        LOGGER.debug('Average value: %s', avg_value)
+    # The bucket keeps the running sum and count of the points, the average is computed
+    # when the data is read. This way each insertion is a single write without reads
+    if aggregation.count is not None:
+        # The points have already been merged into a sum and a count
+        sum_increment, count_increment = Decimal(aggregation.value), aggregation.count
+    else:
+        sum_increment, count_increment = average_increments(aggregation.value,
+                                                            aggregation.old_value,
+                                                            discard_zeros)
 
-        # Set the computed average
-        response = aggregation.table.update_item(
-            Key={
-                'timeserie': aggregation.timeserie,
-                'time': str(aggregation.item_time),
-            },
-            UpdateExpression="SET #value = :value, #ttl = :ttl",
-            ExpressionAttributeNames={'#value': 'value', '#ttl': 'ttl'},
-            ExpressionAttributeValues={
-                ':value': Decimal(str(avg_value)), ':ttl': long(aggregation.ttl)
-            },
-            ReturnValues="UPDATED_NEW"
-        )
-        LOGGER.debug('Updating item %s-%s adding value %s', aggregation.timeserie,
-                     aggregation.item_time, avg_value)
-        LOGGER.debug('Response : %s', response)
+    if not sum_increment and not count_increment:
+        LOGGER.debug('Nothing to update for %s-%s', aggregation.timeserie,
+                     aggregation.item_time)
         return True
 
-    else:
-        LOGGER.debug('No data from lower granularity')
+    LOGGER.debug('Updating item %s-%s adding sum %s and count %s', aggregation.timeserie,
+                 aggregation.item_time, sum_increment, count_increment)
+    names = {'#sum': AVG_SUM_ATTR, '#count': AVG_COUNT_ATTR, '#value': 'value', '#ttl': 'ttl'}
+    values = {':sum': sum_increment, ':count': count_increment, ':ttl': long(aggregation.ttl)}
+    add = dict(UpdateExpression="ADD #sum :sum, #count :count SET #ttl = :ttl",
+               ConditionExpression='attribute_exists(#count) or attribute_not_exists(#value)',
+               ExpressionAttributeNames=names, ExpressionAttributeValues=values)
+    # The buckets written before the averages kept a sum and a count only have the average in
+    # the value. The first update seeds the sum and the count with it as a single point
+    seed = dict(UpdateExpression="SET #sum = #value + :sum, #count = :one + :count, "
+                                 "#ttl = :ttl REMOVE #value",
+                ConditionExpression='attribute_exists(#value) and attribute_not_exists(#count)',
+                ExpressionAttributeNames=names, ExpressionAttributeValues=dict(values, **{
+                    ':one': 1}))
+    if not conditional_update(aggregation, **add) and \
+            not conditional_update(aggregation, **seed):
+        # Another update seeded the bucket in the meantime
+        conditional_update(aggregation, **add)
+    return True
 
 
 def average_without_zeroes(aggregation):
@@ -323,7 +325,7 @@ def average_without_zeroes(aggregation):
 
 
 def aggregate(dynamo_cli, aggregation, granularity, item, time_converted, ts_conf,
-              time_original, timezone):
+              time_original, timezone, count=None):
     """Perform the aggregation based on the specified dictionary"""
 
     table = get_granularity_table_text(granularity)
@@ -339,9 +341,10 @@ def aggregate(dynamo_cli, aggregation, granularity, item, time_converted, ts_con
     agg = Aggregation(ddb_table, item.seriename, time_converted, item.value, ttl, timezone,
                       granularity=granularity, dynamo_cli=dynamo_cli)
     agg.time_original = time_original
+    agg.count = count
     if item.old_value:
         agg.old_value = item.old_value
-    agg_func(agg)
+    return agg_func(agg)
 
 
 # Define which function execute depending on the aggregation method
@@ -359,7 +362,9 @@ AGG_FUNC_DICT = {
 
 
 def rollup(dynamo_cli, granularity, insert_item, ts_conf):
-    """Perform the rollup aggregation from seconds to all the available granularities"""
+    """Perform the rollup aggregation from seconds to all the available granularities.
+    Returns True if the bucket was written, False if it did not change and None if the
+    aggregation failed"""
     try:
         aggregation = ts_conf.aggregation_method
         timezone = ts_conf.timezone
@@ -370,7 +375,274 @@ def rollup(dynamo_cli, granularity, insert_item, ts_conf):
         insert_item.seriename, aggregation, insert_item.value, time_converted, granularity)
         print debug
         """
-        aggregate(dynamo_cli, aggregation, granularity, insert_item, time_converted,
-                  ts_conf, insert_item.timestamp, timezone)
+        return aggregate(dynamo_cli, aggregation, granularity, insert_item, time_converted,
+                         ts_conf, insert_item.timestamp, timezone)
+    except Exception, ve:
+        LOGGER.error('Aggregation failed. Reason: %s', ve)
+        return None
+
+
+class RollupBucket(object):
+    """Aggregated value of all the points of a batch that fall into the same bucket"""
+
+    def __init__(self, seriename, ts_conf, aggregation_method):
+        self.seriename = seriename
+        self.ts_conf = ts_conf
+        self.aggregation_method = aggregation_method
+        self.value = None
+        self.old_value = None
+        self.time_original = None
+        self.count = None
+        self.points = 0
+        # Cascade only: [(granularity, time), ...] of the buckets of the upper granularities
+        # that contain this one
+        self.parent_times = None
+
+    def merge(self, other):
+        """Merge the bucket of the same key built from later points"""
+        method = self.aggregation_method
+        if method == AGGREGATION_LAST:
+            if long(other.time_original) >= long(self.time_original):
+                self.value = other.value
+                self.time_original = other.time_original
+        elif method in (AGGREGATION_SUM, AGGREGATION_COUNT, AGGREGATION_AVG,
+                        AGGREGATION_AVG_ZERO):
+            self.value += other.value
+            if self.count is not None:
+                self.count += other.count
+        else:
+            # The winner functions only compare the values
+            MERGE_FUNC_DICT[method](self, other)
+        self.points += other.points
+
+
+def _merge_sum(bucket, insert_item):
+    """Accumulate the increments (the difference with the old value for updates)"""
+    increment = Decimal(str(insert_item.value))
+    if insert_item.old_value:
+        increment -= Decimal(str(insert_item.old_value))
+    if bucket.value is None:
+        bucket.value = increment
+    else:
+        bucket.value += increment
+
+
+def _merge_count(bucket, insert_item):
+    """Count the new points (updates are not counted)"""
+    if bucket.value is None:
+        bucket.value = Decimal(0)
+    if not insert_item.old_value:
+        bucket.value += 1
+
+
+def _merge_last(bucket, insert_item):
+    """Keep the value with the newest original time"""
+    if bucket.time_original is None or \
+            long(insert_item.timestamp) >= long(bucket.time_original):
+        bucket.value = insert_item.value
+        bucket.time_original = insert_item.timestamp
+
+
+def _merge_winner(keep_new):
+    """Build a merge function that keeps the value selected by keep_new(new, current)"""
+
+    def merge(bucket, insert_item):
+        if bucket.value is None or keep_new(float(insert_item.value), float(bucket.value)):
+            bucket.value = insert_item.value
+
+    return merge
+
+
+def _merge_average(discard_zeros):
+    """Build a merge function that accumulates the running sum and count of an average"""
+
+    def merge(bucket, insert_item):
+        old_value = insert_item.old_value if insert_item.old_value else None
+        sum_increment, count_increment = average_increments(insert_item.value, old_value,
+                                                            discard_zeros)
+        if bucket.value is None:
+            bucket.value, bucket.count = sum_increment, count_increment
+        else:
+            bucket.value += sum_increment
+            bucket.count += count_increment
+
+    return merge
+
+
+# Define how the points of the same bucket are merged depending on the aggregation method
+MERGE_FUNC_DICT = {
+    AGGREGATION_SUM: _merge_sum,
+    AGGREGATION_COUNT: _merge_count,
+    AGGREGATION_LAST: _merge_last,
+    AGGREGATION_MAX: _merge_winner(lambda new, cur: new > cur),
+    AGGREGATION_MIN: _merge_winner(lambda new, cur: new < cur),
+    AGGREGATION_ABS_MAX: _merge_winner(lambda new, cur: abs(new) > abs(cur)),
+    AGGREGATION_ABS_MIN: _merge_winner(lambda new, cur: abs(new) < abs(cur)),
+    AGGREGATION_AVG: _merge_average(False),
+    AGGREGATION_AVG_ZERO: _merge_average(True),
+}
+
+
+class RollupCombiner(object):
+    """Groups the rollups of a batch by (table, timeserie, bucket time) and merges them
+    locally, so each bucket is written only once per batch.
+
+    A cascade combiner only gets the points of the minutes, the change of each written
+    bucket is carried to the bucket of the next granularity (see write_cascade)"""
+
+    def __init__(self, cascade=False):
+        self.cascade = cascade
+        self.buckets = OrderedDict()
+        self.points = 0
+
+    def add(self, granularity, insert_item, ts_conf, time_converted=None):
+        """Merge the point into its bucket. The time of the bucket can be given when it's
+        already converted (see granularities.convert_times). Returns False if the point cannot
+        be merged and has to be rolled up on its own"""
+        aggregation = ts_conf.aggregation_method
+        merge_func = MERGE_FUNC_DICT.get(aggregation, None)
+        if not merge_func:
+            return False
+        if time_converted is None:
+            try:
+                time_converted = convert_time(granularity, insert_item.timestamp,
+                                              ts_conf.timezone)
+            except Exception, ve:
+                LOGGER.error('Aggregation failed. Reason: %s', ve)
+                return True
+
+        key = (granularity, insert_item.seriename, time_converted)
+        bucket = self.buckets.get(key, None)
+        if bucket is None:
+            bucket = RollupBucket(insert_item.seriename, ts_conf, aggregation)
+            if self.cascade:
+                bucket.parent_times = parent_times(granularity, time_converted,
+                                                   ts_conf.timezone)
+            self.buckets[key] = bucket
+        merge_func(bucket, insert_item)
+        if bucket.time_original is None:
+            bucket.time_original = insert_item.timestamp
+        bucket.points += 1
+        self.points += 1
+        return True
+
+    def merge(self, other):
+        """Merge the buckets of a combiner of later points of the same batch"""
+        for key, bucket in other.buckets.iteritems():
+            current = self.buckets.get(key, None)
+            if current is None:
+                self.buckets[key] = bucket
+            else:
+                current.merge(bucket)
+        self.points += other.points
+
+    def bucket_writes(self):
+        """Empty the combiner and return the writes of its merged buckets as tuples
+        (granularity, bucket, time_converted, aggregation), to be done with write_bucket"""
+        writes = []
+        for (granularity, __, time_converted), bucket in self.buckets.iteritems():
+            write = bucket_write(granularity, bucket, time_converted)
+            if write is not None:
+                writes.append(write)
+        LOGGER.debug('Combined %d rollups into %d writes', self.points, len(writes))
+        self.buckets = OrderedDict()
+        self.points = 0
+        return writes
+
+    def flush(self, dynamo_cli):
+        """Write every merged bucket and empty the combiner. Returns the results of the
+        writes, see write_bucket"""
+        if self.cascade:
+            return write_cascade(dynamo_cli, self.bucket_writes())
+        return [write_bucket(dynamo_cli, granularity, bucket, time_converted, aggregation)
+                for granularity, bucket, time_converted, aggregation in self.bucket_writes()]
+
+
+def parent_times(granularity, time_converted, timezone):
+    """Buckets of the upper granularities that contain a bucket, as [(granularity, time)].
+    They are computed from the start of the minute, which is always inside a single bucket of
+    each granularity (an hour can be in two days of a timezone with a half hour offset)"""
+    upper = granularities.GRANULARITIES[granularities.GRANULARITIES.index(granularity) + 1:]
+    return [(parent, convert_time(parent, time_converted, timezone)) for parent in upper]
+
+
+def is_aligned(granularity, time_converted, parent_granularity, timezone):
+    """True if a bucket is inside a single bucket of the parent granularity. The hours are
+    in UTC, so in a timezone with a half hour offset an hour is split between two days"""
+    if granularity != granularities.HOUR:
+        return True
+    return convert_time(parent_granularity, time_converted, timezone) == \
+        convert_time(parent_granularity, time_converted + granularities.SECONDS_IN_HOUR - 1,
+                     timezone)
+
+
+def bucket_write(granularity, bucket, time_converted):
+    """Write of a merged bucket as a tuple (granularity, bucket, time_converted, aggregation),
+    None if it has nothing to write"""
+    aggregation = bucket.aggregation_method
+    if aggregation == AGGREGATION_COUNT:
+        # A merged count is just the addition of the number of points counted
+        if not bucket.value:
+            return None
+        aggregation = AGGREGATION_SUM
+    elif bucket.count is not None and not bucket.value and not bucket.count:
+        # The points of the average cancel each other
+        return None
+    return granularity, bucket, time_converted, aggregation
+
+
+def write_cascade(dynamo_cli, writes, failed=None):
+    """Write the merged buckets of a granularity and carry the change of each one to the
+    bucket of the next granularity, merging the changes that go to the same bucket, until the
+    last granularity. A bucket that did not change (a max, min or last with a better value)
+    does not change its parent either, so the cascade stops there unless the bucket is split
+    between two parents. Returns the results of the writes, see write_bucket, and appends the
+    writes that failed to failed. Writing them again goes on with the rest of their cascade"""
+    results = []
+    while writes:
+        parents = OrderedDict()
+        for write in writes:
+            granularity, bucket, time_converted, aggregation = write
+            written = write_bucket(dynamo_cli, granularity, bucket, time_converted, aggregation)
+            results.append(written)
+            if written is None and failed is not None:
+                failed.append(write)
+            if written is None or not bucket.parent_times:
+                continue
+            (parent_granularity, parent_time), upper_times = bucket.parent_times[0], \
+                bucket.parent_times[1:]
+            if not written and is_aligned(granularity, time_converted, parent_granularity,
+                                          bucket.ts_conf.timezone):
+                # The better value of the bucket is already in its parent
+                continue
+            # The upper times are in the key, so a parent only merges children that are in
+            # the same buckets of every upper granularity
+            key = (parent_granularity, bucket.seriename, parent_time, tuple(upper_times))
+            parent = parents.get(key, None)
+            if parent is None:
+                parent = RollupBucket(bucket.seriename, bucket.ts_conf, bucket.aggregation_method)
+                parent.value, parent.count = bucket.value, bucket.count
+                parent.time_original = bucket.time_original
+                parent.points = bucket.points
+                parent.parent_times = upper_times
+                parents[key] = parent
+            else:
+                parent.merge(bucket)
+        writes = []
+        for (granularity, __, time_converted, __), parent in parents.iteritems():
+            write = bucket_write(granularity, parent, time_converted)
+            if write is not None:
+                writes.append(write)
+    return results
+
+
+def write_bucket(dynamo_cli, granularity, bucket, time_converted, aggregation):
+    """Write a merged bucket. Returns True if it was written, False if the stored bucket
+    already had a better value and None if the aggregation failed"""
+    try:
+        return aggregate(dynamo_cli, aggregation, granularity, bucket, time_converted,
+                         bucket.ts_conf, bucket.time_original, bucket.ts_conf.timezone,
+                         count=bucket.count)
     except Exception, ve:
         LOGGER.error('Aggregation failed. Reason: %s', ve)
+        return None
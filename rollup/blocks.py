@@ -0,0 +1,187 @@
+"""Block storage of the raw points: an item holds all the points of a timeserie in a period
+(an hour of seconds) in a compressed binary attribute, instead of an item per point.
+
+A block item looks like:
+{
+    'timeserie': timeserie,
+    'time': start of the block,
+    'points': compressed binary with the offsets of the points from the start and the decimal
+        text of their values,
+    'count': number of points,
+    'version': incremented on each write, the writes are conditional on it,
+    'ttl': ttl of the newest point
+}"""
+import base64
+import logging
+import struct
+import zlib
+from collections import OrderedDict
+from decimal import Decimal
+
+from boto3.dynamodb.types import Binary
+from botocore.exceptions import ClientError
+
+import constants
+from granularities import SECOND, SECONDS_IN_HOUR
+
+LOGGER = logging.getLogger(__name__)
+
+POINTS_ATTR = 'points'
+# Format of the binary of the points
+BLOCK_FORMAT = 2
+# Seconds of a block of each granularity that can be stored in blocks. The other tables hold
+# the state of the aggregations, which is updated atomically item by item
+BLOCK_SECONDS = {
+    SECOND: SECONDS_IN_HOUR,
+}
+# Max number of keys of a BatchGetItem request
+MAX_BATCH_GET = 100
+
+
+class BlockWriteError(Exception):
+    """Some blocks could not be written"""
+
+
+def is_blocked(granularity):
+    """True if the points of the granularity are stored in blocks"""
+    return granularity in BLOCK_SECONDS and granularity in constants.BLOCK_STORAGE
+
+
+def block_start(granularity, timestamp):
+    """Start of the block that holds a point"""
+    seconds = BLOCK_SECONDS[granularity]
+    return (long(timestamp) / seconds) * seconds
+
+
+def encode_points(start, points):
+    """Binary of the points (time, value) of the block that starts at start. The values are
+    kept as their decimal text, like the values of the items of a point"""
+    points = sorted((long(timestamp), str(value)) for timestamp, value in points)
+    data = struct.pack('>BI%dI' % len(points), BLOCK_FORMAT, len(points),
+                       *[timestamp - start for timestamp, __ in points])
+    return zlib.compress(data + ','.join(value for __, value in points))
+
+
+def decode_points(start, data):
+    """Points (time, value text) of a binary written by encode_points, sorted by time"""
+    data = zlib.decompress(data)
+    block_format, count = struct.unpack_from('>BI', data, 0)
+    if block_format != BLOCK_FORMAT:
+        raise ValueError('Unknown block format %s' % block_format)
+    offsets = struct.unpack_from('>%dI' % count, data, 5)
+    values = data[5 + 4 * count:].split(',') if count else []
+    return [(start + offset, value) for offset, value in zip(offsets, values)]
+
+
+def item_points(item):
+    """Points of a block item read with boto3"""
+    data = item[POINTS_ATTR]
+    return decode_points(long(item['time']), data.value if isinstance(data, Binary) else data)
+
+
+def image_points(image):
+    """Points of a block in a DynamoDB stream image, which has the types of the attributes
+    and the binaries in base64"""
+    if image is None or POINTS_ATTR not in image:
+        return []
+    return decode_points(long(image['time']['S']),
+                         base64.b64decode(image[POINTS_ATTR]['B']))
+
+
+def changed_points(old_image, new_image):
+    """Points added or changed by a write of a block, as (time, value, old value) with the
+    values as text, the old value is None for the new points"""
+    old_values = dict(image_points(old_image))
+    changed = []
+    for timestamp, value in image_points(new_image):
+        old_value = old_values.get(timestamp, None)
+        if old_value is None or Decimal(old_value) != Decimal(value):
+            changed.append((timestamp, value, old_value))
+    return changed
+
+
+def read_blocks(dynamo_cli, table_name, keys):
+    """Read the block items of the keys (timeserie, block start) with consistent reads.
+    Returns {key: item} of the blocks that exist"""
+    blocks = {}
+    keys = list(keys)
+    for first in range(0, len(keys), MAX_BATCH_GET):
+        request = {table_name: {
+            'Keys': [{'timeserie': timeserie, 'time': str(start)}
+                     for timeserie, start in keys[first:first + MAX_BATCH_GET]],
+            'ConsistentRead': True}}
+        while request:
+            response = dynamo_cli.batch_get_item(RequestItems=request)
+            for item in response['Responses'].get(table_name, []):
+                blocks[(item['timeserie'], long(item['time']))] = item
+            request = response.get('UnprocessedKeys', None)
+    return blocks
+
+
+def write_points(dynamo_cli, table_name, granularity, items, max_retries=10):
+    """Add the points of the items (dicts with timeserie, time, value and ttl) to their
+    blocks. Each block is read, merged with its new points (the last value of a time wins) and
+    written if nobody wrote it in the meantime, otherwise it's read again. Returns the number
+    of blocks written, raises BlockWriteError if some blocks are still in conflict after
+    max_retries reads"""
+    new_points = OrderedDict()
+    for item in items:
+        key = (item['timeserie'], block_start(granularity, item['time']))
+        block = new_points.setdefault(key, OrderedDict())
+        block[long(item['time'])] = (item['value'], long(item['ttl']) if item.get('ttl')
+                                     not in (None, 'None') else None)
+
+    table = dynamo_cli.Table(table_name)
+    pending = new_points.keys()
+    written = 0
+    for __ in range(max_retries):
+        if not pending:
+            break
+        stored = read_blocks(dynamo_cli, table_name, pending)
+        conflicts = []
+        for key in pending:
+            if _write_block(table, key, stored.get(key, None), new_points[key]):
+                written += 1
+            else:
+                conflicts.append(key)
+        pending = conflicts
+    if pending:
+        raise BlockWriteError('Cannot write %d blocks of %s after %d retries' % (
+            len(pending), table_name, max_retries))
+    return written
+
+
+def _write_block(table, key, item, new_points):
+    """Write a block merged with its new points, if its version didn't change since it was
+    read. Returns False on a conflict"""
+    timeserie, start = key
+    points = dict(item_points(item)) if item is not None else {}
+    ttls = [long(item['ttl'])] if item is not None and item.get('ttl') not in (None, 'None') \
+        else []
+    for timestamp, (value, ttl) in new_points.iteritems():
+        points[timestamp] = value
+        if ttl is not None:
+            ttls.append(ttl)
+    version = long(item.get('version', 0)) if item is not None else 0
+    block = {
+        'timeserie': timeserie,
+        'time': str(start),
+        POINTS_ATTR: Binary(encode_points(start, points.items())),
+        'count': len(points),
+        'version': version + 1,
+        'ttl': str(max(ttls)) if ttls else None,
+    }
+    try:
+        if item is None:
+            table.put_item(Item=block, ConditionExpression='attribute_not_exists(#time)',
+                           ExpressionAttributeNames={'#time': 'time'})
+        else:
+            table.put_item(Item=block, ConditionExpression='#version = :version',
+                           ExpressionAttributeNames={'#version': 'version'},
+                           ExpressionAttributeValues={':version': version})
+        return True
+    except ClientError, err:
+        if err.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+            raise
+        LOGGER.debug('Block %s-%s changed, reading it again', timeserie, start)
+        return False
@@ -11,6 +11,27 @@ TABLE_CONFIGURATION = 'timeserie_configuration'
 TABLE_PREFIX_ENV_VAR = 'TABLE_PREFIX'
 KINESIS_STREAM = 'ts_stream'
 BATCH_SIZE = int(os.environ.get("BATCH_SIZE", "100"))
+# Partition key of the stream records: 'serie', 'serie_granularity' or 'granularity' (one
+# shard per granularity, the original behaviour)
+PARTITION_STRATEGY = os.environ.get("PARTITION_STRATEGY", "serie")
+# Format of the stream records written by the producers: 'binary' or 'json'. The consumer
+# reads both
+RECORD_FORMAT = os.environ.get("RECORD_FORMAT", "binary")
+# How the points of the second table are rolled up: 'fanout' sends them to every granularity,
+# 'cascade' only to the minutes, whose changes the consumer carries to the hours and so on
+ROLLUP_MODE = os.environ.get("ROLLUP_MODE", "fanout")
+# Comma separated granularities whose points are stored in blocks, many points per item
+# (only 'second' for now). Empty stores an item per point
+BLOCK_STORAGE = [granularity.strip() for granularity in
+                 os.environ.get("BLOCK_STORAGE", "").split(",") if granularity.strip()]
+# Seconds that a timeserie configuration is kept in memory and max number of them
+CONFIGURATION_CACHE_TTL = int(os.environ.get("CONFIGURATION_CACHE_TTL", "60"))
+CONFIGURATION_CACHE_SIZE = int(os.environ.get("CONFIGURATION_CACHE_SIZE", "10000"))
+# Number of timeseries queried at the same time
+QUERY_CONCURRENCY = int(os.environ.get("QUERY_CONCURRENCY", "10"))
+# Connection pool of the boto3 clients, which are reused across warm invocations
+MAX_POOL_CONNECTIONS = int(os.environ.get("MAX_POOL_CONNECTIONS", "10"))
+TCP_KEEPALIVE = os.environ.get("TCP_KEEPALIVE", "true").lower() == "true"
 
 
 def get_configuration_table():
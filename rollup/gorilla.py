@@ -0,0 +1,257 @@
+"""Compression of (time, value) sequences as in Facebook's Gorilla: the timestamps are encoded
+as the difference between their consecutive deltas (delta of delta) and the values as the XOR
+with the previous value, both in variable length bit fields.
+
+An encoded sequence looks like:
+    header: format, flags, number of points, first timestamp, first delta
+    length of the timestamps in bytes (not present if FLAG_REGULAR)
+    timestamps: delta of delta of each point after the first one
+    values: first value in 64 bits, then the XOR with the previous value of each point
+
+Both streams are written as the points are added and read as the points are decoded. When all
+the points are at the same interval (a point per second) the timestamps are left out: they are
+the first timestamp plus the first delta times the position of the point"""
+import struct
+
+CODEC_FORMAT = 1
+# All the points are at the same interval, there are no timestamps
+FLAG_REGULAR = 1
+HEADER = struct.Struct('>BBIqq')
+TIMES_LENGTH = struct.Struct('>I')
+# (prefix, bits of the prefix, bits of the delta of delta) of the buckets of the delta of delta
+# of the timestamps. A zero takes the single bit '0'
+DOD_BUCKETS = [
+    (0b10, 2, 7),
+    (0b110, 3, 9),
+    (0b1110, 4, 12),
+]
+DOD_LARGE = (0b1111, 4, 64)
+DOUBLE = struct.Struct('>d')
+LONG = struct.Struct('>Q')
+# Leading zeros of a XOR are stored in 5 bits
+MAX_LEADING = 31
+
+
+def float_bits(value):
+    """Bits of a double as an integer"""
+    return LONG.unpack(DOUBLE.pack(value))[0]
+
+
+def bits_float(bits):
+    """Double of the bits returned by float_bits"""
+    return DOUBLE.unpack(LONG.pack(bits))[0]
+
+
+class BitWriter(object):
+    """Appends bit fields to a byte array, most significant bit first"""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.pending = 0
+        self.pending_bits = 0
+
+    def write(self, value, bits):
+        """Append the lowest bits of a non negative value"""
+        self.pending = (self.pending << bits) | (value & ((1 << bits) - 1))
+        self.pending_bits += bits
+        while self.pending_bits >= 8:
+            self.pending_bits -= 8
+            self.data.append((self.pending >> self.pending_bits) & 0xFF)
+        self.pending &= (1 << self.pending_bits) - 1
+
+    def getvalue(self):
+        """The bytes written so far, the last one padded with zeros"""
+        if not self.pending_bits:
+            return bytes(self.data)
+        return bytes(self.data) + chr((self.pending << (8 - self.pending_bits)) & 0xFF)
+
+
+class BitReader(object):
+    """Reads the bit fields written by BitWriter from data[offset:end]"""
+
+    def __init__(self, data, offset=0, end=None):
+        self.data = bytearray(data)
+        self.position = offset
+        self.end = len(self.data) if end is None else end
+        self.pending = 0
+        self.pending_bits = 0
+
+    def read(self, bits):
+        """Read an unsigned field of bits"""
+        while self.pending_bits < bits:
+            if self.position >= self.end:
+                raise ValueError('Truncated data')
+            self.pending = (self.pending << 8) | self.data[self.position]
+            self.position += 1
+            self.pending_bits += 8
+        self.pending_bits -= bits
+        value = self.pending >> self.pending_bits
+        self.pending &= (1 << self.pending_bits) - 1
+        return value
+
+    def read_prefix(self, max_bits):
+        """Number of ones before a zero, at most max_bits"""
+        ones = 0
+        while ones < max_bits and self.read(1):
+            ones += 1
+        return ones
+
+
+def to_signed(value, bits):
+    """Signed integer of a field of bits in two's complement"""
+    if value >= 1 << (bits - 1):
+        return value - (1 << bits)
+    return value
+
+
+class Encoder(object):
+    """Streaming encoder: the points are added one by one, in any order of time, and
+    getvalue returns the encoded sequence of the points added so far"""
+
+    def __init__(self):
+        self.times = BitWriter()
+        self.values = BitWriter()
+        self.count = 0
+        self.first_time = 0
+        self.first_delta = 0
+        self.regular = True
+        self.previous_time = None
+        self.previous_delta = 0
+        self.previous_value = 0
+        self.leading = None
+        self.trailing = 0
+
+    def add(self, timestamp, value):
+        """Add a point, timestamp is an integer (epoch seconds) and value a number"""
+        timestamp = long(timestamp)
+        if self.count == 0:
+            self.first_time = timestamp
+        else:
+            self.add_time(timestamp)
+        self.previous_time = timestamp
+        self.add_value(float_bits(float(value)))
+        self.count += 1
+
+    def add_time(self, timestamp):
+        delta = timestamp - self.previous_time
+        if self.count == 1:
+            self.first_delta = delta
+        elif self.regular and delta != self.first_delta:
+            # The timestamps are not written while they are regular: the first delta and no
+            # change after it
+            self.regular = False
+            self.write_dod(self.first_delta)
+            for __ in xrange(self.count - 2):
+                self.times.write(0, 1)
+        if not self.regular:
+            self.write_dod(delta - self.previous_delta)
+        self.previous_delta = delta
+
+    def write_dod(self, dod):
+        if dod == 0:
+            self.times.write(0, 1)
+            return
+        for prefix, prefix_bits, bits in DOD_BUCKETS:
+            if -(1 << (bits - 1)) <= dod < (1 << (bits - 1)):
+                self.times.write(prefix, prefix_bits)
+                self.times.write(dod, bits)
+                return
+        prefix, prefix_bits, bits = DOD_LARGE
+        if not -(1 << (bits - 1)) <= dod < (1 << (bits - 1)):
+            raise ValueError('Timestamps too far apart')
+        self.times.write(prefix, prefix_bits)
+        self.times.write(dod, bits)
+
+    def add_value(self, bits):
+        if self.count == 0:
+            self.values.write(bits, 64)
+            self.previous_value = bits
+            return
+        xor = bits ^ self.previous_value
+        self.previous_value = bits
+        if xor == 0:
+            self.values.write(0, 1)
+            return
+        leading = min(64 - xor.bit_length(), MAX_LEADING)
+        trailing = (xor & -xor).bit_length() - 1
+        if self.leading is not None and leading >= self.leading and trailing >= self.trailing:
+            # The meaningful bits fit in the window of the previous value
+            self.values.write(0b10, 2)
+            self.values.write(xor >> self.trailing, 64 - self.leading - self.trailing)
+            return
+        self.leading = leading
+        self.trailing = trailing
+        length = 64 - leading - trailing
+        self.values.write(0b11, 2)
+        self.values.write(leading, 5)
+        # A length of 64 is stored as 0
+        self.values.write(length & 0x3F, 6)
+        self.values.write(xor >> trailing, length)
+
+    def getvalue(self):
+        """Encoded sequence of the points added so far"""
+        flags = FLAG_REGULAR if self.regular else 0
+        header = HEADER.pack(CODEC_FORMAT, flags, self.count, self.first_time, self.first_delta)
+        if self.regular:
+            return header + self.values.getvalue()
+        times = self.times.getvalue()
+        return header + TIMES_LENGTH.pack(len(times)) + times + self.values.getvalue()
+
+
+def encode(points):
+    """Encode a sequence of (time, value) points"""
+    encoder = Encoder()
+    for timestamp, value in points:
+        encoder.add(timestamp, value)
+    return encoder.getvalue()
+
+
+def decode(data):
+    """Generator of the (time, value) points of an encoded sequence, decoded as they are read"""
+    if len(data) < HEADER.size:
+        raise ValueError('Truncated data')
+    codec_format, flags, count, first_time, first_delta = HEADER.unpack_from(data, 0)
+    if codec_format != CODEC_FORMAT:
+        raise ValueError('Unknown codec format %s' % codec_format)
+    offset = HEADER.size
+    times = None
+    if not flags & FLAG_REGULAR:
+        times_length, = TIMES_LENGTH.unpack_from(data, offset)
+        offset += TIMES_LENGTH.size
+        times = BitReader(data, offset, offset + times_length)
+        offset += times_length
+    values = BitReader(data, offset)
+
+    if not count:
+        return
+    timestamp = first_time
+    bits = values.read(64)
+    yield timestamp, bits_float(bits)
+
+    delta = 0
+    leading = trailing = 0
+    for position in xrange(1, count):
+        if times is None:
+            timestamp = first_time + first_delta * position
+        else:
+            timestamp, delta = read_time(times, timestamp, delta)
+
+        if values.read(1):
+            if values.read(1):
+                leading = values.read(5)
+                length = values.read(6) or 64
+                trailing = 64 - leading - length
+            bits ^= values.read(64 - leading - trailing) << trailing
+        yield timestamp, bits_float(bits)
+
+
+def read_time(times, previous_time, previous_delta):
+    """Read the delta of delta of a timestamp. Returns the timestamp and its delta"""
+    bucket = times.read_prefix(len(DOD_BUCKETS) + 1)
+    if bucket == 0:
+        dod = 0
+    else:
+        bits = DOD_BUCKETS[bucket - 1][2] if bucket <= len(DOD_BUCKETS) else DOD_LARGE[2]
+        dod = to_signed(times.read(bits), bits)
+    delta = previous_delta + dod
+    return previous_time + delta, delta
@@ -2,10 +2,18 @@
 import logging
 import os
 import datetime
+import threading
+from array import array
+from bisect import bisect_right
 from dateutil import tz
 import calendar
 import constants
-from dateutil.relativedelta import relativedelta
+
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional, it's only used by the bulk conversions
+    numpy = None
 
 LOGGER = logging.getLogger(__name__)
 
@@ -57,50 +65,6 @@ RETENTIONS_GRANULARITY = {
 DEFAULT_TIMEZONE = 'Europe/Madrid'
 
 
-def get_interval(gran_value, start, timezone=None):
-    """Given a granularity compute the start and end instants for a unit period. For
-    instance if gran_value = 1 (minute) and start = 1513608098, this will return [
-    1513608098, 1513608098 + 60] = [1513608098, 1513608158]. For some granularity
-    timezone might be required"""
-
-    gran_text = GRANULARITY_VALUE_TEXT[gran_value]
-
-    LOGGER.debug('Passed granularity value %s -> %s', gran_value, gran_text)
-    LOGGER.debug('start %s with timezone %s', start, timezone)
-
-    if gran_text == MINUTE:
-        return [start, start + SECONDS_IN_MINUTE]
-    if gran_text == HOUR:
-        return [start, start + SECONDS_IN_HOUR]
-    if gran_text == DAY:
-        return [start, start + SECONDS_IN_DAY]
-    elif gran_text == MONTH:
-        # compute start of month
-        # compute end of month
-        gmt_date = datetime.datetime.utcfromtimestamp(long(start))
-        gmt_date = gmt_date.replace(tzinfo=tz.gettz('UTC'))
-        start_date = replace_date(gmt_date, day=1, hour=0, minute=0, second=0,
-                                  microsecond=0, tzinfo=tz.gettz(timezone))
-        end_date = start_date + relativedelta(months=1) - relativedelta(microsecond=1)
-        start = calendar.timegm(start_date.utctimetuple())
-        end = calendar.timegm(end_date.utctimetuple())
-        return [start, end]
-    elif gran_text == YEAR:
-        # compute start of year
-        # compute end of year
-        gmt_date = datetime.datetime.utcfromtimestamp(long(start))
-        gmt_date = gmt_date.replace(tzinfo=tz.gettz('UTC'))
-        start_date = replace_date(gmt_date, month=1, day=1, hour=0, minute=0, second=0,
-                                  microsecond=0, tzinfo=tz.gettz(timezone))
-        end_date = start_date + relativedelta(years=1) - relativedelta(microsecond=1)
-        start = calendar.timegm(start_date.utctimetuple())
-        end = calendar.timegm(end_date.utctimetuple())
-        return [start, end]
-
-    else:
-        raise NotImplementedError('Not implemented')
-
-
 def get_granularity_table(granularity_value):
     """Get granularity table from granularity value"""
     gran_text = GRANULARITY_VALUE_TEXT.get(granularity_value, None)
@@ -132,50 +96,129 @@ def seconds_to_hour(seconds, __tz):
     return (int(seconds) / SECONDS_IN_HOUR) * SECONDS_IN_HOUR
 
 
-def replace_date(gmt_date, hour=None, minute=None, second=None, microsecond=None,
-                 tzinfo=None, day=None, month=None):
-    """Replace the date"""
-    tz_date = gmt_date
-    # Convert to local timezone to make calculus
-    if tzinfo is not None:
-        tz_date = tz_date.astimezone(tzinfo)
-
-    if hour is not None:
-        tz_date = tz_date.replace(hour=hour)
-    if minute is not None:
-        tz_date = tz_date.replace(minute=minute)
-    if second is not None:
-        tz_date = tz_date.replace(second=second)
-    if microsecond is not None:
-        tz_date = tz_date.replace(microsecond=microsecond)
-    if day is not None:
-        tz_date = tz_date.replace(day=day)
-    if month is not None:
-        tz_date = tz_date.replace(month=month)
-
-    return tz_date
+class TimezoneBoundaries(object):
+    """Sorted epochs of the local day, month and year starts of a timezone, so the start
+    of the bucket of an instant is a binary search instead of timezone calculus"""
+
+    def __init__(self, timezone):
+        self.tzinfo = tz.gettz(timezone)
+        if self.tzinfo is None:
+            raise ValueError('Unknown timezone %s' % timezone)
+        # Serializes the extensions of the period, the readers don't take it
+        self.lock = threading.Lock()
+        # (first year, last year, boundaries of each granularity, NumPy copies of the
+        # boundaries for the bulk conversions). It's replaced as a whole when the period is
+        # extended, so a reader that took it never sees a half computed period
+        self.covered = (None, None, {DAY: [], MONTH: [], YEAR: []}, {})
+
+    def cover(self, first_year, last_year):
+        """Compute the boundaries from the start of first_year to the start of the year
+        after last_year"""
+        days = []
+        months = []
+        years = []
+        one_day = datetime.timedelta(days=1)
+        date = datetime.date(first_year, 1, 1)
+        end_date = datetime.date(last_year + 1, 1, 1)
+        previous_offset = None
+        while date <= end_date:
+            local_start = datetime.datetime(date.year, date.month, date.day, tzinfo=self.tzinfo)
+            offset = local_start.utcoffset()
+            if offset != previous_offset:
+                # When the DST change is at midnight the day starts at the end of the gap
+                local_start = tz.resolve_imaginary(local_start)
+                previous_offset = local_start.utcoffset()
+            # Very important to use utc time tuple because timegm is timezone naive
+            epoch = calendar.timegm(local_start.utctimetuple())
+            days.append(epoch)
+            if date.day == 1:
+                months.append(epoch)
+                if date.month == 1:
+                    years.append(epoch)
+            date += one_day
+        LOGGER.debug('Computed %d day boundaries for %s [%s, %s]', len(days), self.tzinfo,
+                     first_year, last_year)
+        self.covered = (first_year, last_year, {DAY: days, MONTH: months, YEAR: years}, {})
+
+    def _covering(self, granularity, first_seconds, last_seconds):
+        """Boundaries and NumPy copies of a period that contains the instants from first_seconds
+        to last_seconds. Out of the computed period, it's extended up to their years"""
+        covered = self.covered
+        if self._contains(covered, granularity, first_seconds, last_seconds):
+            return covered[2][granularity], covered[3]
+        with self.lock:
+            # Another thread may have extended it while waiting for the lock
+            covered = self.covered
+            if not self._contains(covered, granularity, first_seconds, last_seconds):
+                first_year, last_year = covered[:2]
+                first = datetime.datetime.utcfromtimestamp(first_seconds).year - 1
+                last = datetime.datetime.utcfromtimestamp(last_seconds).year + 1
+                self.cover(first if first_year is None else min(first_year, first),
+                           last if last_year is None else max(last_year, last))
+                covered = self.covered
+        return covered[2][granularity], covered[3]
+
+    @staticmethod
+    def _contains(covered, granularity, first_seconds, last_seconds):
+        boundaries = covered[2][granularity]
+        return boundaries and boundaries[0] <= first_seconds and last_seconds < boundaries[-1]
+
+    def _index(self, granularity, seconds):
+        """Index of the boundary where the bucket of seconds starts"""
+        boundaries, __ = self._covering(granularity, seconds, seconds)
+        return bisect_right(boundaries, seconds) - 1, boundaries
+
+    def start(self, granularity, seconds):
+        """Start of the bucket of the given granularity that contains seconds"""
+        index, boundaries = self._index(granularity, long(seconds))
+        return boundaries[index]
+
+    def starts(self, granularity, time_values):
+        """Bulk version of start. time_values is a NumPy array or an array('l')"""
+        if not len(time_values):
+            return time_values[:0]
+        is_numpy = numpy is not None and isinstance(time_values, numpy.ndarray)
+        # Make sure that the boundaries cover all the instants
+        if is_numpy:
+            boundaries, arrays = self._covering(granularity, long(time_values.min()),
+                                                long(time_values.max()))
+        else:
+            boundaries, arrays = self._covering(granularity, long(min(time_values)),
+                                                long(max(time_values)))
+
+        if is_numpy:
+            boundaries_array = arrays.get(granularity, None)
+            if boundaries_array is None:
+                boundaries_array = numpy.array(boundaries, dtype=numpy.int64)
+                arrays[granularity] = boundaries_array
+            indexes = numpy.searchsorted(boundaries_array, time_values, side='right') - 1
+            return boundaries_array[indexes]
+        return array('l', [boundaries[bisect_right(boundaries, time_value) - 1]
+                            for time_value in time_values])
+
+# Boundaries of each timezone, computed the first time the timezone is used
+TIMEZONE_BOUNDARIES = {}
+TIMEZONE_BOUNDARIES_LOCK = threading.Lock()
+# Years covered when computing the boundaries of a timezone, enough for the max retention
+BOUNDARIES_YEARS = max(RETENTIONS_GRANULARITY.values()) / (365 * SECONDS_IN_DAY) + 1
+
+
+def get_timezone_boundaries(timezone):
+    """Get the boundaries of the timezone, computing them if needed"""
+    with TIMEZONE_BOUNDARIES_LOCK:
+        boundaries = TIMEZONE_BOUNDARIES.get(timezone, None)
+        if boundaries is None:
+            boundaries = TimezoneBoundaries(timezone)
+            current_year = datetime.datetime.utcnow().year
+            boundaries.cover(current_year - BOUNDARIES_YEARS, current_year + 1)
+            TIMEZONE_BOUNDARIES[timezone] = boundaries
+        return boundaries
 
 
 def convert_with_timezone(seconds, timezone, granularity):
     """Generic method to convert """
-    gmt_date = datetime.datetime.utcfromtimestamp(long(seconds))
-    gmt_date = gmt_date.replace(tzinfo=tz.gettz('UTC'))
-    LOGGER.debug('%s -> %s', seconds, gmt_date)
-    tz_date = None
-    if granularity == DAY:
-        tz_date = replace_date(gmt_date, hour=0, minute=0, second=0, microsecond=0,
-                               tzinfo=tz.gettz(timezone))
-    if granularity == MONTH:
-        tz_date = replace_date(gmt_date, hour=0, minute=0, second=0, microsecond=0, day=1,
-                               tzinfo=tz.gettz(timezone))
-    if granularity == YEAR:
-        tz_date = replace_date(gmt_date, hour=0, minute=0, second=0, microsecond=0,
-                               day=1, month=1, tzinfo=tz.gettz(timezone))
-    LOGGER.debug('%s -> %s', gmt_date, tz_date)
-
-    # Very important to use utc time tuple because timegm is timezone naive
-    new_time = calendar.timegm(tz_date.utctimetuple())
-    LOGGER.debug('%s -> %s', tz_date, new_time)
+    new_time = get_timezone_boundaries(timezone).start(granularity, seconds)
+    LOGGER.debug('%s -> %s', seconds, new_time)
     return new_time
 
 
@@ -217,6 +260,37 @@ GRANULARITY_GET_TIME_FUNC_DICT = {
 }
 
 
+def convert_times(time_values, timezone=None, granularities=None):
+    """Bulk version of convert_time. Converts a NumPy array (or an array('l')) of epoch
+    seconds to the bucket starts of every granularity. Returns a dict
+    {granularity: array of bucket starts}"""
+    if granularities is None:
+        granularities = GRANULARITIES
+    is_numpy = numpy is not None and isinstance(time_values, numpy.ndarray)
+    if is_numpy:
+        time_values = time_values.astype(numpy.int64, copy=False)
+    elif not isinstance(time_values, array):
+        time_values = array('l', [long(time_value) for time_value in time_values])
+
+    converted = {}
+    for granularity in granularities:
+        if granularity == SECOND:
+            converted[granularity] = time_values
+        elif granularity in (MINUTE, HOUR):
+            unit = SECONDS_IN_MINUTE if granularity == MINUTE else SECONDS_IN_HOUR
+            if is_numpy:
+                converted[granularity] = (time_values // unit) * unit
+            else:
+                converted[granularity] = array('l', [(time_value // unit) * unit
+                                                     for time_value in time_values])
+        elif granularity in (DAY, MONTH, YEAR):
+            converted[granularity] = get_timezone_boundaries(timezone).starts(granularity,
+                                                                              time_values)
+        else:
+            raise ValueError('No function associated to %s', granularity)
+    return converted
+
+
 def enable_all_granularities():
     """Enables all the granularities (for testing purposes)"""
     global GRANULARITIES
@@ -1,23 +1,32 @@
 """Lambda to rollup"""
+import base64
 import logging
 import os
 from decimal import Decimal
 import json
+import threading
 import time
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
 from urllib import unquote
 
 import boto3
+from botocore.config import Config
 from boto3.dynamodb.conditions import Key
 
 import aggregations
+import blocks
 import constants
 import granularities
+import stream_records
 import timeserie_configuration
 
 LOGGER = logging.getLogger(__name__)
 DDB = None
 KIN = None
 SECONDS_HOUR = 3600
+# Response header with the cursor to continue a query that has been limited
+CURSOR_HEADER = 'X-Next-Cursor'
 
 
 def configure_logging():
@@ -29,34 +38,64 @@ def configure_logging():
         LOGGER.setLevel(logging.INFO)
 
 
+def max_pool_connections():
+    """Size of the connection pool of the clients. The concurrent queries share the connection
+    pool of the client, so it has to be big enough to hold one connection per query"""
+    return max(constants.QUERY_CONCURRENCY, constants.MAX_POOL_CONNECTIONS)
+
+
+def client_config():
+    """Configuration of the boto3 clients"""
+    options = {'max_pool_connections': max_pool_connections()}
+    # Keep the idle connections alive between warm invocations (recent botocore only)
+    if 'tcp_keepalive' in Config.OPTION_DEFAULTS:
+        options['tcp_keepalive'] = constants.TCP_KEEPALIVE
+    return Config(**options)
+
+
 def configure_dynamodb():
-    """Configure DynamoDB connection"""
+    """Configure DynamoDB connection. The resource is created only once, so the connection
+    pool is reused across warm invocations"""
     global DDB
+    if DDB is not None:
+        return DDB
     if constants.DDB_LOCAL_ENV_VAR in os.environ:
         LOGGER.info('Connecting to local dynamo DB')
         DDB = boto3.resource('dynamodb',
                              endpoint_url=os.environ[constants.DDB_LOCAL_ENV_VAR],
                              aws_access_key_id='foobar', aws_secret_access_key='foobar',
-                             aws_session_token='foobar', region_name='us-west-2')
+                             aws_session_token='foobar', region_name='us-west-2',
+                             config=client_config())
     else:
-        DDB = boto3.resource('dynamodb')
+        DDB = boto3.resource('dynamodb', config=client_config())
     return DDB
 
 
 def configure_kinesis():
-    """Configure kinesis connection"""
+    """Configure kinesis connection. The client is created only once, so the connection
+    pool is reused across warm invocations"""
     global KIN
+    if KIN is not None:
+        return KIN
     if constants.KIN_LOCAL_ENV_VAR in os.environ:
         LOGGER.info('Connecting to local kinesis')
         KIN = boto3.client('kinesis',
                            endpoint_url=os.environ[constants.KIN_LOCAL_ENV_VAR],
                            aws_access_key_id='foobar', aws_secret_access_key='foobar',
-                           aws_session_token='foobar', region_name='us-west-2')
+                           aws_session_token='foobar', region_name='us-west-2',
+                           config=client_config())
     else:
-        KIN = boto3.client('kinesis')
+        KIN = boto3.client('kinesis', config=client_config())
     return KIN
 
 
+def reset_connections():
+    """Discard the DynamoDB and Kinesis clients, the next configure call creates new ones"""
+    global DDB, KIN
+    DDB = None
+    KIN = None
+
+
 class InsertItem(object):
     """Class that define an inserted item"""
 
@@ -120,6 +159,9 @@ class QueryItem(object):
         self.end = end
         self.granularity = granularity
         self.last = None
+        self.limit = None
+        self.cursor = None
+        self.concurrency = constants.QUERY_CONCURRENCY
 
     def __str__(self):
         return " ".join((str(self.timeseries), str(self.start), str(self.end), self.granularity))
@@ -128,50 +170,152 @@ class QueryItem(object):
         return self.__str__()
 
 
+def items_to_points(items, start=None, end=None):
+    """Convert the items returned by DynamoDB to (time, value) points. A block item holds many
+    points, only the ones in [start, end] are returned"""
+    points = []
+    for item in items:
+        if blocks.POINTS_ATTR in item:
+            points.extend((timestamp, float(value))
+                          for timestamp, value in blocks.item_points(item)
+                          if (start is None or timestamp >= start) and
+                          (end is None or timestamp <= end))
+            continue
+        item_value = aggregations.get_item_value(item)
+        if item_value is not None:
+            points.append((long(item['time']), item_value))
+    return points
+
+
+def encode_cursor(key):
+    """Encode the timeserie and the time of the last returned point as an opaque cursor"""
+    return base64.urlsafe_b64encode(json.dumps(key))
+
+
+def decode_cursor(cursor):
+    """Decode a cursor generated by encode_cursor"""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        return {'timeserie': key['timeserie'], 'time': key['time']}
+    except (TypeError, ValueError, KeyError):
+        raise ValueError('Invalid cursor')
+
+
+def query_start(granularity, start):
+    """First time of the items to query. The block that holds the start of the query starts
+    before it"""
+    if blocks.is_blocked(granularity):
+        return blocks.block_start(granularity, start)
+    return start
+
+
+def query_timeserie(table, timeserie, query_item):
+    """Query the points of a single timeserie"""
+    if not query_item.last:
+        # Request timed values
+        points = []
+        for items in aggregations.query_pages(table, timeserie,
+                                              query_start(query_item.granularity,
+                                                          query_item.start),
+                                              query_item.end):
+            points.extend(items_to_points(items, long(query_item.start), long(query_item.end)))
+        return points
+
+    # Request last values
+    response = table.query(KeyConditionExpression=Key('timeserie').eq(timeserie),
+                           Limit=1, ScanIndexForward=False)
+    LOGGER.debug('Response has %d items', response['Count'])
+    # The last item can be a block, its last point is the last one
+    return items_to_points(response['Items'])[-1:]
+
+
 def dynamo_db_query(query_item):
     """Performs the query to DynamoDB"""
 
     LOGGER.info("Querying ... %s", query_item)
 
-    table = DDB.Table(granularities.get_granularity_table_text(query_item.granularity))
+    table_name = granularities.get_granularity_table_text(query_item.granularity)
 
-    data = {}
+    # timeseries has to be a list
+    timeseries = query_item.timeseries
+    # More threads than connections would wait for a connection of the pool
+    concurrency = min(query_item.concurrency, len(timeseries), max_pool_connections())
 
-    last_query = query_item.last
+    if concurrency <= 1:
+        table = DDB.Table(table_name)
+        results = [query_timeserie(table, timeserie, query_item) for timeserie in timeseries]
+    else:
+        # Query the timeseries at the same time. The resources of boto3 are not thread safe,
+        # so each thread queries with its own Table, created here. The Tables share the low
+        # level client, which is thread safe, and its connection pool
+        tables = Queue()
+        for __ in range(concurrency):
+            tables.put(DDB.Table(table_name))
+        worker = threading.local()
 
-    # timeseries has to be a list
-    for timeserie in query_item.timeseries:
+        def take_table():
+            worker.table = tables.get()
 
-        if not last_query:
-            # Request timed values
-            response = table.query(
-                KeyConditionExpression=Key('timeserie').eq(timeserie) & Key('time').between(
-                    str(query_item.start), str(query_item.end))
-            )
-        else:
-            # Request last values
-            response = table.query(KeyConditionExpression=Key('timeserie').eq(timeserie),
-                                   Limit=1, ScanIndexForward=False)
-
-        LOGGER.debug('Response has %d items', response['Count'])
-        items = response['Items']
-        if items:
-            for item in items:
-                timeserie = item['timeserie']
-                item_time = long(item['time'])
-                item_value = float(item['value'])
-
-                item_tuple = (item_time, item_value)
-
-                if timeserie in data:
-                    data[timeserie].append(item_tuple)
-                else:
-                    item_data = [item_tuple]
-                    data[timeserie] = item_data
-        else:
-            data[timeserie] = []
+        pool = ThreadPool(concurrency, take_table)
+        try:
+            results = pool.map(
+                lambda timeserie: query_timeserie(worker.table, timeserie, query_item),
+                timeseries)
+        finally:
+            pool.close()
+            pool.join()
+
+    return dict(zip(timeseries, results))
 
-    return data
+
+def dynamo_db_query_page(query_item):
+    """Performs a query to DynamoDB returning at most query_item.limit points. Returns the data
+    and the cursor to continue the query, None if there is no more data"""
+
+    LOGGER.info("Querying page ... %s", query_item)
+
+    table = DDB.Table(granularities.get_granularity_table_text(query_item.granularity))
+
+    timeseries = query_item.timeseries
+    start = long(query_item.start)
+    if query_item.cursor:
+        last_key = decode_cursor(query_item.cursor)
+        if last_key['timeserie'] not in timeseries:
+            raise ValueError('Invalid cursor')
+        # Continue from the point after the last one of the previous page, which can be in
+        # the middle of a block
+        timeseries = timeseries[timeseries.index(last_key['timeserie']):]
+        start = long(last_key['time']) + 1
+
+    data = {}
+    remaining = query_item.limit
+    last_key = None
+    for timeserie in timeseries:
+        if remaining <= 0:
+            return data, encode_cursor(last_key)
+
+        # A block holds many points, so the items are read in pages of the remaining points
+        # until there are enough of them
+        data[timeserie] = []
+        if start > long(query_item.end):
+            # The previous page stopped at the end of this timeserie
+            start = long(query_item.start)
+            continue
+        for items in aggregations.query_pages(table, timeserie,
+                                              query_start(query_item.granularity, start),
+                                              query_item.end, page_size=remaining):
+            points = items_to_points(items, start, long(query_item.end))[:remaining]
+            data[timeserie].extend(points)
+            remaining -= len(points)
+            if points:
+                last_key = {'timeserie': timeserie, 'time': str(points[-1][0])}
+            if remaining <= 0:
+                break
+        start = long(query_item.start)
+
+    if remaining <= 0:
+        return data, encode_cursor(last_key)
+    return data, None
 
 
 def dynamo_db_insert(insert_items):
@@ -182,11 +326,12 @@ def dynamo_db_insert(insert_items):
     # Enable batch put item to enhance the speed
     items = []
 
+    series_configuration = timeserie_configuration.get_timeseries_configurations(
+        DDB, [item.seriename for item in insert_items])
     for item in insert_items:
         LOGGER.debug('Insert item %s', item)
 
-        configuration = timeserie_configuration.get_timeserie_configure(DDB,
-                                                                        item.seriename)
+        configuration = series_configuration[item.seriename]
 
         cur_tz = configuration.timezone
         item.timestamp = granularities.convert_time(start_granularity, item.timestamp,
@@ -207,9 +352,10 @@ def dynamo_db_insert(insert_items):
 
 def insert_stream(kinesis_records):
     """Insert the prepared records in the kinesis stream"""
-    if kinesis_records:
-        LOGGER.debug('Insert items %s on kinesis stream %s', kinesis_records, constants.get_kinesis_stream())
-        put_record_result = KIN.put_records(StreamName=constants.get_kinesis_stream(), Records=kinesis_records)
+    # Split them in batches that fit in a PutRecords request
+    for batch in stream_records.split_put_records(kinesis_records, constants.BATCH_SIZE):
+        LOGGER.debug('Insert items %s on kinesis stream %s', batch, constants.get_kinesis_stream())
+        put_record_result = KIN.put_records(StreamName=constants.get_kinesis_stream(), Records=batch)
         LOGGER.debug('Kinesis response: %s', put_record_result)
         # We are forced to wait between insertions
         time.sleep(0.01)
@@ -225,11 +371,8 @@ def kinesis_insert(insert_items):
     items = []
 
     # Only get configuration once per serie. This will decrease a lot the number of reads for configuration
-    series_configuration = {}
-    for item in insert_items:
-        if item.seriename not in series_configuration:
-            configuration = timeserie_configuration.get_timeserie_configure(DDB, item.seriename)
-            series_configuration[item.seriename] = configuration
+    series_configuration = timeserie_configuration.get_timeseries_configurations(
+        DDB, [item.seriename for item in insert_items])
 
     for item in insert_items:
         configuration = series_configuration.get(item.seriename)
@@ -240,20 +383,13 @@ def kinesis_insert(insert_items):
         LOGGER.debug('Insert item %s', item)
         items.append(item)
 
-    # The kinesis stream is partitioned in shards by table; so pass the value of the table as the partition key
-    kinesis_records = []
-    i = 0
+    # Many points are packed in each kinesis record
+    packer = stream_records.new_packer()
     for item in items:
-        data = json.dumps({'granularity': granularity, 'data': item.to_dict()})
-        record = {'Data': data, 'PartitionKey': str(hash(granularity))}
-        kinesis_records.append(record)
-        i += 1
-        if i % constants.BATCH_SIZE == 0:
-            insert_stream(kinesis_records)
-            kinesis_records = []
+        packer.add(stream_records.partition_key(item.seriename, granularity), granularity,
+                   item.to_dict())
 
-    if len(kinesis_records) <= constants.BATCH_SIZE:
-        insert_stream(kinesis_records)
+    insert_stream(packer.flush())
 
 
 def process_write_batch(table, items):
@@ -293,6 +429,23 @@ def parse_ddb_stream_record(record):
         return None
 
 
+def parse_ddb_block_record(record):
+    """Parse the record of a block write to get the points that it added or changed"""
+    try:
+        images = record['dynamodb']
+        seriename = images['NewImage']['timeserie']['S']
+        insert_items = []
+        for timestamp, value, old_value in blocks.changed_points(images.get('OldImage', None),
+                                                                 images['NewImage']):
+            item = InsertItem(str(timestamp), seriename, value)
+            item.old_value = old_value
+            insert_items.append(item)
+        return insert_items
+    except (KeyError, TypeError, ValueError), err:
+        LOGGER.error(err)
+        return None
+
+
 def parse_insert_item(event):
     """Parse the input for inserting items"""
     # Need to perform Float -> Decimal conversion to work with dynamoDB
@@ -324,7 +477,15 @@ def parse_query_item(event, mandatory_time=True):
         if granularity not in granularities.GRANULARITIES:
             raise ValueError("Invalid granularity")
 
-        return QueryItem(timeseries, start, end, granularity)
+        query_item = QueryItem(timeseries, start, end, granularity)
+        if event.get('concurrency') is not None:
+            query_item.concurrency = int(event['concurrency'])
+        if event.get('limit') is not None:
+            query_item.limit = int(event['limit'])
+            if query_item.limit <= 0:
+                raise ValueError("Invalid limit")
+            query_item.cursor = event.get('cursor')
+        return query_item
     else:
         LOGGER.error("Mandatory fields not present")
         raise KeyError('Missing mandatory fields: ' + ",".join(mandatory_fields))
@@ -349,6 +510,14 @@ def process_stream_event(event, __context):
 
                 if event_name in ['INSERT', 'MODIFY']:
                     LOGGER.debug('Processing record %s', record)
+                    if blocks.POINTS_ATTR in record['dynamodb'].get('NewImage', {}):
+                        # A block write, with many points
+                        block_items = parse_ddb_block_record(record)
+                        if block_items is not None:
+                            insert_items.extend(block_items)
+                        else:
+                            LOGGER.error('Cannot perform rollup aggregations')
+                        continue
                     insert_item = parse_ddb_stream_record(record)
                     if insert_item:
                         insert_items.append(insert_item)
@@ -360,41 +529,33 @@ def process_stream_event(event, __context):
                 LOGGER.error('Exception raised while processing records from DynamoDB')
                 LOGGER.error(e)
 
-    kinesis_records = []
-    i = 0
-    series_configuration = {}
-    for insert_item in insert_items:
-        if insert_item.seriename not in series_configuration:
-            ts_conf = timeserie_configuration.get_timeserie_configure(DDB, insert_item.seriename)
-            series_configuration[insert_item.seriename] = ts_conf
+    packer = stream_records.new_packer()
+    series_configuration = timeserie_configuration.get_timeseries_configurations(
+        DDB, [insert_item.seriename for insert_item in insert_items])
 
     for insert_item in insert_items:
         item_conf = series_configuration[insert_item.seriename]
+        agg = None
         if constants.AGG_IN_SERIE in os.environ:
             try:
                 agg = insert_item.seriename.split(constants.CHAR_AGG)[1]
-                item_conf.aggregation_method = agg
             except IndexError:
                 pass
-
-        for granularity in granularities.GRANULARITIES[1:]:
+        # The records only carry the version of the configuration, the consumer reads it
+        item_conf_reference = item_conf.to_reference(agg)
+        rollup_granularities = granularities.GRANULARITIES[1:]
+        if constants.ROLLUP_MODE == aggregations.ROLLUP_CASCADE:
+            # The consumer carries the changes of the minutes to the upper granularities
+            item_conf_reference['cascade'] = True
+            rollup_granularities = rollup_granularities[:1]
+
+        for granularity in rollup_granularities:
             # Delegate the aggregation on the kinesis consumer instead of
-            # performing it here
-            data = {'granularity': granularity,
-                    'data': insert_item.to_dict(),
-                    'aggregation': item_conf.to_dict()
-                    }
-            data = json.dumps(data)
-            record = {'Data': data, 'PartitionKey': str(hash(granularity))}
-            kinesis_records.append(record)
-            # Write to kinesis on batches
-            i += 1
-            if i % constants.BATCH_SIZE == 0:
-                insert_stream(kinesis_records)
-                kinesis_records = []
-    # Just in the case some batch is not full
-    if len(kinesis_records) <= constants.BATCH_SIZE:
-        insert_stream(kinesis_records)
+            # performing it here. Many points are packed in each kinesis record
+            packer.add(stream_records.partition_key(insert_item.seriename, granularity),
+                       granularity, insert_item.to_dict(), item_conf_reference)
+
+    insert_stream(packer.flush())
 
 
 def last(event, __context__):
@@ -402,7 +563,8 @@ def last(event, __context__):
     # Expected event format:
     # event = {
     #        'timeseries': [timeserie1, timeserie2],
-    #        'granularity': constants.SECOND
+    #        'granularity': constants.SECOND,
+    #        'concurrency': 10 (optional)
     # }
     #
 
@@ -427,7 +589,8 @@ def query(event, __context):
     #        'timeseries': [timeserie1, timeserie2],
     #        'start': start,
     #        'end': end,
-    #        'granularity': constants.SECOND
+    #        'granularity': constants.SECOND,
+    #        'concurrency': 10 (optional)
     # }
     #
 
@@ -443,6 +606,32 @@ def query(event, __context):
         raise e
 
 
+def query_page(event, __context):
+    """Query a page of the data from DynamoDB timeseries database"""
+
+    # Expected event format:
+    # event = {
+    #        'timeseries': [timeserie1, timeserie2],
+    #        'start': start,
+    #        'end': end,
+    #        'granularity': constants.SECOND,
+    #        'limit': 1000,
+    #        'cursor': cursor returned by the previous page (optional)
+    # }
+    #
+
+    configure_logging()
+    configure_dynamodb()
+
+    try:
+        query_item = parse_query_item(event)
+        return dynamo_db_query_page(query_item)
+    except KeyError, e:
+        raise e
+    except ValueError, e:
+        raise e
+
+
 def put_items(event, __context):
     """Put items in DynamoDB"""
 
@@ -477,12 +666,17 @@ def payload_from_api_get_event(event):
     start = event['queryStringParameters']['start']
     end = event['queryStringParameters']['end']
     granularity = event['pathParameters']['granularity']  
-    return {
+    payload = {
         'timeseries':timeseries,
         'start':start,
         'end':end,
         'granularity':granularity
     }
+    # Optional pagination of the query
+    if 'limit' in event['queryStringParameters']:
+        payload['limit'] = event['queryStringParameters']['limit']
+        payload['cursor'] = event['queryStringParameters'].get('cursor')
+    return payload
 
 def payload_from_api_post_event(event):
     """Maps an API event to the expected payload"""
@@ -521,6 +715,16 @@ def handler(event, __context__):
         if operation == "get":
             if is_api_request:
                 payload = payload_from_api_get_event(event)
+            if 'limit' in payload:
+                response, cursor = query_page(payload, __context__)
+                if is_api_request:
+                    headers = {"Access-Control-Allow-Origin" : "*",
+                               "Access-Control-Expose-Headers" : CURSOR_HEADER}
+                    if cursor:
+                        headers[CURSOR_HEADER] = cursor
+                    return {"statusCode": 200, "body": json.dumps(response), "headers": headers}
+                else:
+                    return {'data': response, 'cursor': cursor}
             response = query(payload, __context__)
             if is_api_request:
                 return {"statusCode": 200, "body": json.dumps(response), "headers": {"Access-Control-Allow-Origin" : "*"}}
@@ -0,0 +1,420 @@
+"""Module that packs and unpacks the records of the Kinesis stream"""
+import hashlib
+import json
+import logging
+import struct
+
+import constants
+
+LOGGER = logging.getLogger(__name__)
+
+PARTITION_BY_SERIE = 'serie'
+PARTITION_BY_SERIE_GRANULARITY = 'serie_granularity'
+PARTITION_BY_GRANULARITY = 'granularity'
+# Max length of a Kinesis partition key, the longer ones are hashed
+MAX_PARTITION_KEY_LENGTH = 256
+
+# Version of the packed record format. The records without version are single point records
+PACKED_VERSION = 1
+# Max size of the data of a Kinesis record (1 MB including the partition key), with some margin
+MAX_RECORD_BYTES = 1024 * 1024 - 1024
+# Binary records start with a zero byte, which cannot start a JSON document
+BINARY_MAGIC = '\x00TS'
+BINARY_VERSION = 4
+# Flags of the configurations in the binary records
+FLAG_FULL_CONFIGURATION = 1
+FLAG_CASCADE = 2
+FORMAT_JSON = 'json'
+FORMAT_BINARY = 'binary'
+# Types of the values of the points in the binary records
+TAG_NONE, TAG_INT, TAG_FLOAT, TAG_STRING, TAG_BIG_INT = range(5)
+NO_STRING = 0xFFFFFFFF
+MAX_INT = 2 ** 63
+# Max number of records and size of a PutRecords request
+MAX_PUT_RECORDS = 500
+MAX_PUT_BYTES = 5 * 1024 * 1024
+
+
+def partition_key(timeserie, granularity, strategy=None):
+    """Partition key of a point. Kinesis keeps the order of the records with the same
+    partition key, so all the strategies keep the order of a timeserie in a granularity"""
+    if strategy is None:
+        strategy = constants.PARTITION_STRATEGY
+    if strategy == PARTITION_BY_SERIE:
+        key = timeserie
+    elif strategy == PARTITION_BY_SERIE_GRANULARITY:
+        key = timeserie + constants.CHAR_AGG + granularity
+    elif strategy == PARTITION_BY_GRANULARITY:
+        key = str(hash(granularity))
+    else:
+        raise ValueError('Invalid partition strategy %s' % strategy)
+    if len(key) > MAX_PARTITION_KEY_LENGTH:
+        key = hashlib.md5(key.encode('utf-8')).hexdigest()
+    return key
+
+
+class RecordPacker(object):
+    """Packs many points in each Kinesis record, up to the max record size.
+
+    A packed record looks like:
+    {
+        'version': 1,
+        'configurations': {timeserie: configuration dict or reference {timeserie, version}
+                           (with 'cascade' if its changes are carried to the upper
+                           granularities by the consumer)},
+        'records': [{'granularity': granularity, 'data': InsertItem dict}, ...]
+    }
+    The records whose timeserie has a configuration have to be aggregated"""
+
+    def __init__(self):
+        self.packs = {}
+        self.records = []
+        self.points = 0
+
+    def add(self, partition_key, granularity, data, configuration=None):
+        """Add a point to the record of the partition key"""
+        record = json.dumps({'granularity': granularity, 'data': data})
+        conf = None
+        pack = self.packs.get(partition_key, None)
+        if configuration is not None and \
+                (pack is None or data['timeserie'] not in pack['configurations']):
+            conf = json.dumps(configuration)
+        size = len(record) + len(data['timeserie']) + len(conf or '') + 8
+
+        if pack is not None and pack['size'] + size > MAX_RECORD_BYTES:
+            self._close(partition_key)
+            pack = None
+            if configuration is not None:
+                conf = json.dumps(configuration)
+                size = len(record) + len(data['timeserie']) + len(conf) + 8
+        if pack is None:
+            pack = {'configurations': {}, 'records': [], 'size': 64}
+            self.packs[partition_key] = pack
+
+        pack['records'].append(record)
+        if conf is not None:
+            pack['configurations'][data['timeserie']] = conf
+        pack['size'] += size
+        self.points += 1
+
+    def _close(self, partition_key):
+        """Serialize the record of the partition key"""
+        pack = self.packs.pop(partition_key)
+        # The records are already serialized, so just join them
+        configurations = ','.join(json.dumps(timeserie) + ':' + conf for timeserie, conf in
+                                  pack['configurations'].iteritems())
+        data = '{"version":%d,"configurations":{%s},"records":[%s]}' % (
+            PACKED_VERSION, configurations, ','.join(pack['records']))
+        self.records.append({'Data': data, 'PartitionKey': partition_key})
+
+    def flush(self):
+        """Return the Kinesis records with all the points added so far"""
+        for partition_key in self.packs.keys():
+            self._close(partition_key)
+        records = self.records
+        if records:
+            LOGGER.info('Packed %d points in %d records (%.1f points per record)',
+                        self.points, len(records), self.points / float(len(records)))
+        self.records = []
+        self.points = 0
+        return records
+
+
+class BinaryRecordPacker(RecordPacker):
+    """Packs many points in each Kinesis record in a compact binary format. The strings (series
+    names, granularities, timezones, aggregations) are interned in a table at the start of the
+    record, the configuration of each serie is written once and the points are stored by
+    columns:
+
+    header        magic, version
+    strings       count, lengths, utf-8 bytes
+    configs       count, per configuration: serie, version, name, aggregation, flags (full,
+                  cascade) and if it is a full configuration and not a reference:
+                  timezone, default, retentions count, retention granularities and seconds
+    points        count, granularities, series, value tags (4 per point: time, value, ttl,
+                  old value), ints, floats, string lengths and bytes
+
+    All the integers are big endian. The values keep their type (int, float, string or None),
+    so they decode to the same dicts as the JSON records"""
+
+    def add(self, partition_key, granularity, data, configuration=None):
+        """Add a point to the record of the partition key"""
+        pack = self.packs.get(partition_key, None)
+        if pack is not None and pack.size + pack.point_size(granularity, data, configuration) > \
+                MAX_RECORD_BYTES:
+            self._close(partition_key)
+            pack = None
+        if pack is None:
+            pack = _BinaryPack()
+            self.packs[partition_key] = pack
+        pack.add(granularity, data, configuration)
+        self.points += 1
+
+    def _close(self, partition_key):
+        """Serialize the record of the partition key"""
+        pack = self.packs.pop(partition_key)
+        self.records.append({'Data': pack.encode(), 'PartitionKey': partition_key})
+
+
+class _BinaryPack(object):
+    """Points of a binary record being built"""
+
+    def __init__(self):
+        self.strings = {}
+        self.string_list = []
+        self.configurations = {}
+        self.granularities = []
+        self.series = []
+        self.tags = bytearray()
+        self.ints = []
+        self.floats = []
+        self.texts = []
+        self.size = 32
+
+    def string_id(self, text):
+        """Id of a string in the table of the record"""
+        if text is None:
+            return NO_STRING
+        string_id = self.strings.get(text, None)
+        if string_id is None:
+            string_id = len(self.string_list)
+            self.strings[text] = string_id
+            self.string_list.append(text)
+            self.size += 4 + len(_utf8(text))
+        return string_id
+
+    def point_size(self, granularity, data, configuration):
+        """Upper bound of the bytes that the point adds to the record"""
+        size = 12 + 4 * 8
+        for text in (granularity, data['timeserie']):
+            if text not in self.strings:
+                size += 4 + len(_utf8(text))
+        for value in (data['time'], data['value'], data.get('ttl'), data.get('old_value')):
+            if _value_tag(value) in (TAG_STRING, TAG_BIG_INT):
+                size += 4 + len(_utf8(value))
+        if configuration is not None and \
+                self.strings.get(data['timeserie']) not in self.configurations:
+            size += len(json.dumps(configuration)) + 64
+        return size
+
+    def add(self, granularity, data, configuration):
+        serie_id = self.string_id(data['timeserie'])
+        self.granularities.append(self.string_id(granularity))
+        self.series.append(serie_id)
+        self.size += 12
+        for value in (data['time'], data['value'], data.get('ttl'), data.get('old_value')):
+            tag = _value_tag(value)
+            self.tags.append(tag)
+            if tag == TAG_INT:
+                self.ints.append(value)
+                self.size += 8
+            elif tag == TAG_FLOAT:
+                self.floats.append(value)
+                self.size += 8
+            elif tag != TAG_NONE:
+                text = _utf8(value)
+                self.texts.append(text)
+                self.size += 4 + len(text)
+        if configuration is not None and serie_id not in self.configurations:
+            full = None
+            if 'timezone' in configuration:
+                retentions = sorted(configuration['retentions'].iteritems())
+                full = (self.string_id(configuration['timezone']),
+                        1 if configuration.get('default') else 0,
+                        [self.string_id(retention_granularity)
+                         for retention_granularity, __ in retentions],
+                        [int(seconds) for __, seconds in retentions])
+                self.size += 6 + 12 * len(retentions)
+            self.configurations[serie_id] = (
+                int(configuration.get('version', 0)),
+                self.string_id(configuration.get('timeserie')),
+                self.string_id(configuration.get('aggregation')),
+                FLAG_CASCADE if configuration.get('cascade') else 0,
+                full)
+            self.size += 21
+
+    def encode(self):
+        strings = [_utf8(text) for text in self.string_list]
+        parts = [struct.pack('>3sB', BINARY_MAGIC, BINARY_VERSION),
+                 _pack_blobs(strings),
+                 struct.pack('>I', len(self.configurations))]
+        for serie_id, (version, name_id, aggregation_id, flags, full) in \
+                self.configurations.iteritems():
+            if full is not None:
+                flags |= FLAG_FULL_CONFIGURATION
+            parts.append(struct.pack('>IqIIB', serie_id, version, name_id, aggregation_id,
+                                     flags))
+            if full is not None:
+                timezone_id, default, retention_ids, retention_seconds = full
+                parts.append(struct.pack('>IBB%dI%dq' % (len(retention_ids), len(retention_ids)),
+                                         timezone_id, default, len(retention_ids),
+                                         *(retention_ids + retention_seconds)))
+        points = len(self.series)
+        parts.append(struct.pack('>I%dI%dI' % (points, points), points,
+                                 *(self.granularities + self.series)))
+        parts.append(str(self.tags))
+        parts.append(struct.pack('>I%dq' % len(self.ints), len(self.ints), *self.ints))
+        parts.append(struct.pack('>I%dd' % len(self.floats), len(self.floats), *self.floats))
+        parts.append(_pack_blobs(self.texts))
+        return ''.join(parts)
+
+
+def _utf8(text):
+    return text.encode('utf-8') if isinstance(text, unicode) else str(text)
+
+
+def _value_tag(value):
+    if value is None:
+        return TAG_NONE
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        # The ints that don't fit in 64 bits are written as text
+        return TAG_INT if -MAX_INT <= value < MAX_INT else TAG_BIG_INT
+    if isinstance(value, float):
+        return TAG_FLOAT
+    return TAG_STRING
+
+
+def _pack_blobs(blobs):
+    """Count, lengths and bytes of a list of strings"""
+    return struct.pack('>I%dI' % len(blobs), len(blobs), *[len(blob) for blob in blobs]) + \
+        ''.join(blobs)
+
+
+def _unpack_blobs(data, offset):
+    """Read the strings packed by _pack_blobs. Returns them and the new offset"""
+    count, = struct.unpack_from('>I', data, offset)
+    offset += 4
+    lengths = struct.unpack_from('>%dI' % count, data, offset)
+    offset += 4 * count
+    blobs = []
+    for length in lengths:
+        blobs.append(data[offset:offset + length].decode('utf-8'))
+        offset += length
+    return blobs, offset
+
+
+def new_packer(record_format=None):
+    """Record packer of the configured format"""
+    if record_format is None:
+        record_format = constants.RECORD_FORMAT
+    if record_format == FORMAT_BINARY:
+        return BinaryRecordPacker()
+    if record_format == FORMAT_JSON:
+        return RecordPacker()
+    raise ValueError('Invalid record format %s' % record_format)
+
+
+def split_put_records(kinesis_records, max_records=MAX_PUT_RECORDS):
+    """Split the records in groups that fit in a PutRecords request"""
+    groups = []
+    group = []
+    group_bytes = 0
+    for record in kinesis_records:
+        record_bytes = len(record['Data']) + len(record['PartitionKey'])
+        if group and (len(group) >= max_records or group_bytes + record_bytes > MAX_PUT_BYTES):
+            groups.append(group)
+            group = []
+            group_bytes = 0
+        group.append(record)
+        group_bytes += record_bytes
+    if group:
+        groups.append(group)
+    return groups
+
+
+def unpack(data):
+    """Get the points of a Kinesis record as a list of dicts {'granularity', 'data' and
+    'aggregation' if the point has to be aggregated}. Supports binary, packed and single point
+    records"""
+    if data[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+        return unpack_binary(data)
+    decoded = json.loads(data)
+    if 'version' not in decoded:
+        return [decoded]
+    if decoded['version'] != PACKED_VERSION:
+        raise ValueError('Unknown record version %s' % decoded['version'])
+
+    configurations = decoded['configurations']
+    items = decoded['records']
+    for item in items:
+        configuration = configurations.get(item['data']['timeserie'], None)
+        if configuration is not None:
+            item['aggregation'] = configuration
+    return items
+
+
+def unpack_binary(data):
+    """Get the points of a binary record"""
+    __, version = struct.unpack_from('>3sB', data, 0)
+    if version != BINARY_VERSION:
+        raise ValueError('Unknown record version %s' % version)
+    strings, offset = _unpack_blobs(data, 4)
+    strings.append(None)
+
+    def string(string_id):
+        return strings[string_id if string_id != NO_STRING else -1]
+
+    configuration_count, = struct.unpack_from('>I', data, offset)
+    offset += 4
+    configurations = {}
+    for __ in range(configuration_count):
+        serie_id, configuration_version, name_id, aggregation_id, flags = \
+            struct.unpack_from('>IqIIB', data, offset)
+        offset += 21
+        configuration = {'timeserie': string(name_id), 'version': configuration_version}
+        if aggregation_id != NO_STRING:
+            configuration['aggregation'] = string(aggregation_id)
+        if flags & FLAG_CASCADE:
+            configuration['cascade'] = True
+        if not flags & FLAG_FULL_CONFIGURATION:
+            # A reference to the configuration
+            configurations[serie_id] = configuration
+            continue
+        timezone_id, default, retention_count = struct.unpack_from('>IBB', data, offset)
+        offset += 6
+        retentions = struct.unpack_from('>%dI%dq' % (retention_count, retention_count), data,
+                                        offset)
+        offset += 12 * retention_count
+        configuration.update({
+            'timezone': string(timezone_id),
+            'aggregation': string(aggregation_id),
+            'retentions': dict((string(retentions[index]), retentions[retention_count + index])
+                               for index in range(retention_count)),
+            'default': bool(default),
+            'timeserie': string(name_id),
+        })
+        configurations[serie_id] = configuration
+
+    points, = struct.unpack_from('>I', data, offset)
+    offset += 4
+    ids = struct.unpack_from('>%dI%dI' % (points, points), data, offset)
+    offset += 8 * points
+    tags = bytearray(data[offset:offset + 4 * points])
+    offset += 4 * points
+    int_count, = struct.unpack_from('>I', data, offset)
+    ints = struct.unpack_from('>%dq' % int_count, data, offset + 4)
+    offset += 4 + 8 * int_count
+    float_count, = struct.unpack_from('>I', data, offset)
+    floats = struct.unpack_from('>%dd' % float_count, data, offset + 4)
+    offset += 4 + 8 * float_count
+    texts, offset = _unpack_blobs(data, offset)
+
+    # Read the values in order from the column of their type
+    next_text = iter(texts).next
+    readers = [lambda: None, iter(ints).next, iter(floats).next, next_text,
+               lambda: long(next_text())]
+    items = []
+    for index in xrange(points):
+        tag = 4 * index
+        serie_id = ids[points + index]
+        item = {'granularity': strings[ids[index]],
+                'data': {'timeserie': strings[serie_id],
+                         'time': readers[tags[tag]](),
+                         'value': readers[tags[tag + 1]](),
+                         'ttl': readers[tags[tag + 2]](),
+                         'old_value': readers[tags[tag + 3]]()}}
+        configuration = configurations.get(serie_id, None)
+        if configuration is not None:
+            item['aggregation'] = configuration
+        items.append(item)
+    return items
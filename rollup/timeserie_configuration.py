@@ -2,7 +2,10 @@
 
 import logging
 import os
-import boto3
+import random
+import threading
+import time
+from collections import OrderedDict
 import json
 from boto3.dynamodb.conditions import Key
 
@@ -11,6 +14,13 @@ import aggregations, granularities, constants
 LOGGER = logging.getLogger()
 DDB = None
 SECONDS_HOUR = 3600
+# Max number of keys of a BatchGetItem request
+BATCH_GET_MAX_KEYS = 100
+# Retries of a BatchGetItem request that fails or leaves unprocessed keys, with exponential
+# backoff (seconds)
+BATCH_GET_MAX_RETRIES = 8
+BATCH_GET_BASE_BACKOFF = 0.05
+BATCH_GET_MAX_BACKOFF = 5.0
 
 
 def configure_logging():
@@ -23,16 +33,14 @@ def configure_logging():
 
 
 def configure_dynamodb():
-    """Configure DynamoDB connection"""
+    """Configure DynamoDB connection. The resource of lambda_database is shared, so it has the
+    same client configuration and its connection pool is reused across warm invocations"""
     global DDB
-    if constants.DDB_LOCAL_ENV_VAR in os.environ:
-        LOGGER.info('Connecting to local dynamo DB')
-        DDB = boto3.resource('dynamodb',
-                             endpoint_url=os.environ[constants.DDB_LOCAL_ENV_VAR],
-                             aws_access_key_id='foobar', aws_secret_access_key='foobar',
-                             aws_session_token='foobar', region_name='us-west-2')
-    else:
-        DDB = boto3.resource('dynamodb')
+    if DDB is not None:
+        return
+    # Imported here, lambda_database imports this module
+    import lambda_database
+    DDB = lambda_database.configure_dynamodb()
 
 
 class Configuration(object):
@@ -44,6 +52,8 @@ class Configuration(object):
         self.retentions = {}
         self.default = False
         self.timeserie = None
+        # Incremented on each update of the configuration
+        self.version = 0
 
         for k, v in retentions.iteritems():
             self.retentions[k] = int(v)
@@ -60,6 +70,7 @@ class Configuration(object):
         conf = Configuration(item_tz, item_agg, item_ret)
         conf.default = item_default
         conf.timeserie = item_serie_name
+        conf.version = int(item.get('version', 0))
         return conf
 
     @classmethod
@@ -72,16 +83,234 @@ class Configuration(object):
             'aggregation': self.aggregation_method,
             'retentions': self.retentions,
             'default': self.default,
-            'timeserie': self.timeserie
+            'timeserie': self.timeserie,
+            'version': self.version
         }
 
+    def to_reference(self, aggregation_method=None):
+        """Reference to this version of the configuration, to send it in the stream records
+        instead of the whole configuration. The aggregation can be overridden"""
+        reference = {'timeserie': self.timeserie, 'version': self.version}
+        if aggregation_method is not None and aggregation_method != self.aggregation_method:
+            reference['aggregation'] = aggregation_method
+        return reference
+
+    def with_aggregation(self, aggregation_method):
+        """Copy of the configuration with another aggregation"""
+        conf = Configuration(self.timezone, aggregation_method, self.retentions)
+        conf.default = self.default
+        conf.timeserie = self.timeserie
+        conf.version = self.version
+        return conf
+
+
+def is_deleted(item):
+    """True if the item of the table is the tombstone of a deleted configuration"""
+    return bool(item.get('deleted', False))
+
+
+def is_reference(conf_dict):
+    """True if the configuration of a stream record is a reference (timeserie, version)"""
+    return 'timezone' not in conf_dict
+
+
+class ConfigurationCache(object):
+    """LRU cache of the timeserie configurations whose entries expire after ttl seconds.
+    It lives at module level, so it survives across warm Lambda invocations"""
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, timeserie_name):
+        """Returns a tuple (found, configuration). The configuration can be None if it's
+        known that the timeserie has no configuration"""
+        with self.lock:
+            entry = self.entries.pop(timeserie_name, None)
+            if entry is None:
+                return False, None
+            expiration, configuration = entry
+            if expiration < time.time():
+                return False, None
+            # Move it to the end, it's the most recently used
+            self.entries[timeserie_name] = entry
+            return True, configuration
+
+    def put(self, timeserie_name, configuration):
+        """Store the configuration of the timeserie"""
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries.pop(timeserie_name, None)
+            self.entries[timeserie_name] = (time.time() + self.ttl, configuration)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, timeseries=None):
+        """Remove the given timeseries from the cache, all of them if None"""
+        with self.lock:
+            if timeseries is None:
+                self.entries.clear()
+            else:
+                for timeserie_name in timeseries:
+                    self.entries.pop(timeserie_name, None)
+
+
+class VersionedConfigurationCache(object):
+    """LRU cache of the configurations by (timeserie, version). A version of a configuration
+    never changes, so the entries don't expire"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, timeserie_name, version):
+        """Returns a tuple (found, configuration)"""
+        key = (timeserie_name, version)
+        with self.lock:
+            if key not in self.entries:
+                return False, None
+            configuration = self.entries.pop(key)
+            self.entries[key] = configuration
+            return True, configuration
+
+    def put(self, timeserie_name, version, configuration):
+        """Store the configuration of a version of the timeserie"""
+        if self.max_size <= 0:
+            return
+        key = (timeserie_name, version)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = configuration
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+CONFIGURATION_CACHE = ConfigurationCache(constants.CONFIGURATION_CACHE_TTL,
+                                         constants.CONFIGURATION_CACHE_SIZE)
+VERSIONED_CACHE = VersionedConfigurationCache(constants.CONFIGURATION_CACHE_SIZE)
+
 
 def get_timeserie_configure(dynamo_cli, timeserie_name):
+    """Get the configuration of the timeserie from the cache or from the table
+    timeserie_configuration. If it's not there, it inserts the default values"""
+    found, configuration = CONFIGURATION_CACHE.get(timeserie_name)
+    if not found:
+        configuration = query_timeserie_configure(dynamo_cli, timeserie_name)
+        CONFIGURATION_CACHE.put(timeserie_name, configuration)
+    return configuration
+
+
+def get_timeseries_configurations(dynamo_cli, timeseries):
+    """Get the configuration of several timeseries as a dict {timeserie: configuration}.
+    The ones that are not cached are read with BatchGetItem"""
+    configurations = {}
+    missing = []
+    for timeserie_name in timeseries:
+        if timeserie_name in configurations or timeserie_name in missing:
+            continue
+        found, configuration = CONFIGURATION_CACHE.get(timeserie_name)
+        if found:
+            configurations[timeserie_name] = configuration
+        else:
+            missing.append(timeserie_name)
+
+    for configuration in batch_get_configurations(dynamo_cli, missing):
+        configurations[configuration.timeserie] = configuration
+        CONFIGURATION_CACHE.put(configuration.timeserie, configuration)
+
+    # The ones that are not in the table get the default configuration (if enabled)
+    for timeserie_name in missing:
+        if timeserie_name not in configurations:
+            configurations[timeserie_name] = get_timeserie_configure(dynamo_cli,
+                                                                     timeserie_name)
+    return configurations
+
+
+def batch_get_backoff(attempt):
+    """Sleep with exponential backoff and full jitter before retrying a BatchGetItem"""
+    time.sleep(random.uniform(0, min(BATCH_GET_MAX_BACKOFF,
+                                     BATCH_GET_BASE_BACKOFF * 2 ** attempt)))
+
+
+def batch_get_configurations(dynamo_cli, timeseries, consistent_read=False):
+    """Read the configurations of the timeseries that are in the table with BatchGetItem. The
+    errors and the unprocessed keys are retried with backoff, then the error is raised"""
+    configurations = []
+    table_name = constants.get_configuration_table()
+    for i in range(0, len(timeseries), BATCH_GET_MAX_KEYS):
+        request_items = {
+            table_name: {'Keys': [{'timeserie': timeserie_name} for timeserie_name in
+                                  timeseries[i:i + BATCH_GET_MAX_KEYS]],
+                         'ConsistentRead': consistent_read}
+        }
+        attempt = 0
+        while request_items:
+            try:
+                response = dynamo_cli.batch_get_item(RequestItems=request_items)
+            except Exception, err:
+                if attempt >= BATCH_GET_MAX_RETRIES:
+                    raise
+                LOGGER.warning('Cannot read the configurations, retrying: %s', err)
+                batch_get_backoff(attempt)
+                attempt += 1
+                continue
+            for item in response['Responses'].get(table_name, []):
+                if not is_deleted(item):
+                    configurations.append(Configuration.from_ddb(item))
+            request_items = response.get('UnprocessedKeys')
+            if request_items:
+                if attempt >= BATCH_GET_MAX_RETRIES:
+                    raise IOError('Cannot read %d configurations after %d retries' % (
+                        len(request_items[table_name]['Keys']), attempt))
+                batch_get_backoff(attempt)
+                attempt += 1
+    return configurations
+
+
+def resolve_configurations(dynamo_cli, references):
+    """Configurations of the references (timeserie, version) of the stream records, as a dict
+    {(timeserie, version): configuration}. Each version is read from the table only once.
+
+    Only the last version of a configuration is stored, so the references to an older version
+    get the last one. The configurations that were deleted are None, and are not cached in case
+    they are created again"""
+    resolved = {}
+    missing = []
+    for timeserie_name, version in references:
+        found, configuration = VERSIONED_CACHE.get(timeserie_name, version)
+        if found:
+            resolved[(timeserie_name, version)] = configuration
+        else:
+            missing.append((timeserie_name, version))
+    if not missing:
+        return resolved
+
+    # The reference was written after the configuration was, so it's read consistently to get
+    # at least that version
+    latest = dict((configuration.timeserie, configuration) for configuration in
+                  batch_get_configurations(dynamo_cli, sorted(set(timeserie_name for
+                                                                  timeserie_name, __ in missing)),
+                                           consistent_read=True))
+    for timeserie_name, version in missing:
+        configuration = latest.get(timeserie_name, None)
+        if configuration is not None:
+            VERSIONED_CACHE.put(timeserie_name, configuration.version, configuration)
+            if configuration.version > version:
+                VERSIONED_CACHE.put(timeserie_name, version, configuration)
+        resolved[(timeserie_name, version)] = configuration
+    return resolved
+
+
+def query_timeserie_configure(dynamo_cli, timeserie_name):
     """Query the table timeserie_configuration for the timeserie, if it's not there,
     it inserts the default values"""
     table = dynamo_cli.Table(constants.get_configuration_table())
     response = table.query(KeyConditionExpression=Key('timeserie').eq(timeserie_name))
-    items = response['Items']
+    items = [item for item in response['Items'] if not is_deleted(item)]
     if items:
         configuration_item = items[0]
         return Configuration.from_ddb(configuration_item)
@@ -115,7 +344,6 @@ def update_timeserie_configuration(dynamo_cli, timeserie_name, tz, agg, retentio
         table = dynamo_cli.Table(constants.get_configuration_table())
 
     configuration = {
-        'timeserie': timeserie_name,
         'timezone': str(tz),
         'aggregation': str(agg),
         'retentions': retentions,
@@ -124,8 +352,20 @@ def update_timeserie_configuration(dynamo_cli, timeserie_name, tz, agg, retentio
 
     LOGGER.info('Setting configuration %s for %s ', configuration, timeserie_name)
 
-    response = table.put_item(Item=configuration)
+    # The version is incremented atomically, so the stream records can reference it. It
+    # continues the version of the tombstone if the configuration was deleted
+    names = dict(('#' + attribute, attribute) for attribute in configuration)
+    values = dict((':' + attribute, value) for attribute, value in configuration.iteritems())
+    values[':one'] = 1
+    response = table.update_item(
+        Key={'timeserie': timeserie_name},
+        UpdateExpression='SET ' + ', '.join('#%s = :%s' % (attribute, attribute) for attribute
+                                            in sorted(configuration)) +
+        ' REMOVE #deleted ADD #version :one',
+        ExpressionAttributeNames=dict(names, **{'#version': 'version', '#deleted': 'deleted'}),
+        ExpressionAttributeValues=values)
     LOGGER.debug(response)
+    CONFIGURATION_CACHE.invalidate([timeserie_name])
 
 
 def get_all_configurations(dynamo_cli):
@@ -138,20 +378,34 @@ def get_all_configurations(dynamo_cli):
         response = table.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
         configuration_data.extend(response['Items'])
 
-    return [Configuration.from_ddb(conf) for conf in configuration_data]
+    configurations = [Configuration.from_ddb(conf) for conf in configuration_data
+                      if not is_deleted(conf)]
+    for configuration in configurations:
+        CONFIGURATION_CACHE.put(configuration.timeserie, configuration)
+    return configurations
 
 
 def delete_configurations(dynamo_cli, timeseries):
-    """Delete configurations"""
+    """Delete configurations. A tombstone with the last version is kept instead of the item,
+    so a configuration created again doesn't reuse the versions cached by the consumers"""
     table = dynamo_cli.Table(constants.get_configuration_table())
     LOGGER.info("Deleting configuration %s", timeseries)
     for timeserie in timeseries:
-        response = table.delete_item(
+        response = table.update_item(
             Key={
                 'timeserie': timeserie
-            }
+            },
+            UpdateExpression='SET #deleted = :deleted '
+                             'REMOVE #timezone, #aggregation, #retentions, #default '
+                             'ADD #version :one',
+            ExpressionAttributeNames={'#deleted': 'deleted', '#timezone': 'timezone',
+                                      '#aggregation': 'aggregation',
+                                      '#retentions': 'retentions', '#default': 'default',
+                                      '#version': 'version'},
+            ExpressionAttributeValues={':deleted': True, ':one': 1}
         )
         LOGGER.debug(response)
+    CONFIGURATION_CACHE.invalidate(timeseries)
 
 
 def get_configuration_handler(event, __context):
@@ -168,8 +422,9 @@ def get_configuration_handler(event, __context):
 
     try:
         if timeseries is not None:
+            series_configuration = get_timeseries_configurations(DDB, timeseries)
             for ts in timeseries:
-                conf = get_timeserie_configure(DDB, ts)
+                conf = series_configuration[ts]
                 if conf:
                     configurations.append(conf)
         else:
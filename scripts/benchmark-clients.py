@@ -0,0 +1,54 @@
+"""Compare the cost of creating the boto3 clients on every invocation (cold) against
+reusing them across warm invocations"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'rollup'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-1')
+
+import lambda_database
+
+
+def invocation(send_request):
+    """What a handler does with the clients on each invocation"""
+    ddb = lambda_database.configure_dynamodb()
+    kin = lambda_database.configure_kinesis()
+    if send_request:
+        ddb.meta.client.list_tables(Limit=1)
+        kin.list_streams(Limit=1)
+
+
+def benchmark(iterations, send_request, warm):
+    """Time the invocations. On cold mode the clients are discarded before each one"""
+    lambda_database.reset_connections()
+    timings = []
+    for __ in range(iterations):
+        if not warm:
+            lambda_database.reset_connections()
+        start = time.time()
+        invocation(send_request)
+        timings.append(time.time() - start)
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    print('%s: mean %.2f ms, p50 %.2f ms, p99 %.2f ms, min %.2f ms' % (
+        name, 1000 * sum(timings) / len(timings), 1000 * timings[len(timings) / 2],
+        1000 * timings[int(len(timings) * 0.99)], 1000 * timings[0]))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark cold vs warm boto3 clients')
+    parser.add_argument('--iterations', type=int, default=50, help='Invocations to time')
+    parser.add_argument('--request', action='store_true',
+                        help='Send a request with each client (needs AWS credentials or '
+                             'DYNAMO_DB_LOCAL_ENDPOINT and KINESIS_LOCAL_ENDPOINT)')
+
+    args = parser.parse_args()
+
+    report('cold', benchmark(args.iterations, args.request, warm=False))
+    report('warm', benchmark(args.iterations, args.request, warm=True))
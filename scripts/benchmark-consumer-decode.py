@@ -0,0 +1,97 @@
+"""Measure how the decoding of the consumer (unpacking the records, building the items and
+merging the rollups) scales with the number of processes of its decoder pool"""
+import argparse
+import os
+import random
+import sys
+import time
+from multiprocessing import cpu_count
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'kinesisconsumer'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-1')
+
+from rollup import stream_records
+from rollup.timeserie_configuration import Configuration
+import prepare
+
+# Same series as generate-timeseries.py
+SERIES = {
+    "living_room/temperature": ("average", lambda: random.uniform(18, 25)),
+    "emergency_exit/presence": ("count", lambda: 1),
+    "web/customers": ("sum", lambda: random.uniform(200, 400)),
+}
+ROLLUP_GRANULARITIES = ['minute', 'hour', 'day', 'month', 'year']
+
+
+def build_records(seconds, timezone, record_format):
+    """Kinesis record data of the points of the series during some seconds: the raw points
+    and the rollups of the upper granularities"""
+    packer = stream_records.new_packer(record_format)
+    start = int(time.time()) - seconds
+    for timeserie, (aggregation, generate) in sorted(SERIES.items()):
+        configuration = Configuration(timezone, aggregation,
+                                      dict((granularity, 86400) for granularity in
+                                           ['second'] + ROLLUP_GRANULARITIES))
+        configuration.timeserie = timeserie
+        configuration = configuration.to_dict()
+        for timestamp in range(start, start + seconds):
+            data = {'timeserie': timeserie, 'time': timestamp, 'value': generate(),
+                    'ttl': timestamp + 86400, 'old_value': None}
+            packer.add(timeserie, 'second', data)
+            for granularity in ROLLUP_GRANULARITIES:
+                packer.add(timeserie + granularity, granularity, data, configuration)
+    return [record['Data'] for record in packer.flush()]
+
+
+def benchmark(datas, processes, repeat):
+    """Best time to decode the records with a number of processes. A first pass that is not
+    timed warms up each process, which computes its timezone boundaries on first use"""
+    decoder = prepare.DecoderPool(processes, min_chunk_records=1) if processes > 1 else None
+    decode = prepare.decode_records if decoder is None else decoder.decode
+    decode(datas)
+    timings = []
+    for __ in range(repeat):
+        start = time.time()
+        batch = decode(datas)
+        timings.append(time.time() - start)
+    if decoder is not None:
+        decoder.stop()
+    return min(timings), batch.points
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the consumer decoding against the '
+                                                 'number of processes')
+    parser.add_argument('--seconds', type=int, default=3600,
+                        help='Seconds of data of each serie (6 points per second and serie)')
+    parser.add_argument('--timezone', default='Europe/Madrid', help='Timezone of the series')
+    parser.add_argument('--processes', default=None,
+                        help='Comma separated process counts (default: 1, 2, 4... up to the '
+                             'number of cores)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each process count')
+    parser.add_argument('--format', default='binary', choices=['binary', 'json'],
+                        help='Format of the records')
+
+    args = parser.parse_args()
+
+    if args.processes:
+        process_counts = [int(count) for count in args.processes.split(',')]
+    else:
+        process_counts = [1]
+        while process_counts[-1] * 2 <= cpu_count():
+            process_counts.append(process_counts[-1] * 2)
+        if process_counts[-1] != cpu_count():
+            process_counts.append(cpu_count())
+
+    datas = build_records(args.seconds, args.timezone, args.format)
+    print('%d %s records (%d bytes), %d cores' % (len(datas), args.format,
+                                                  sum(len(data) for data in datas), cpu_count()))
+    base = None
+    for processes in process_counts:
+        seconds, points = benchmark(datas, processes, args.repeat)
+        base = base or seconds
+        print('%2d processes: %.2f s, %d points/s, speedup %.2fx' % (
+            processes, seconds, points / seconds, base / seconds))
@@ -0,0 +1,110 @@
+"""Measure the compression ratio and the encoding and decoding throughput of the Gorilla codec
+on series like the ones of generate-timeseries.py, compared with the compressed blocks of the
+second table"""
+import argparse
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from rollup import blocks, gorilla
+
+# Bytes of a point without compression: a timestamp and a double
+RAW_POINT_SIZE = 16
+
+
+def living_room_temperature(seconds, start):
+    return [(timestamp, random.uniform(18, 25)) for timestamp in range(start, start + seconds)]
+
+
+def emergency_exit_presence(seconds, start):
+    # Only the seconds with presence have a point
+    return [(timestamp, 1) for timestamp in range(start, start + seconds) if random.random() < 0.1]
+
+
+def web_customers(seconds, start):
+    return [(timestamp, random.uniform(200, 400)) for timestamp in range(start, start + seconds)]
+
+
+# Same series as generate-timeseries.py
+SERIES = [
+    ("living_room/temperature", living_room_temperature),
+    ("emergency_exit/presence", emergency_exit_presence),
+    ("web/customers", web_customers),
+]
+
+
+def best_time(function, repeat):
+    """Best time of some runs of a function and its result"""
+    timings = []
+    for __ in range(repeat):
+        start = time.time()
+        result = function()
+        timings.append(time.time() - start)
+    return min(timings), result
+
+
+def benchmark(points, block_seconds, repeat):
+    """Size, encoding and decoding times of the points in blocks with each codec"""
+    chunks = []
+    for timestamp, value in points:
+        start = timestamp - timestamp % block_seconds
+        if not chunks or chunks[-1][0] != start:
+            chunks.append((start, []))
+        chunks[-1][1].append((timestamp, value))
+
+    codecs = [
+        # The blocks keep the decimal text of the values
+        ('zlib block', lambda start, chunk: blocks.encode_points(
+            start, [(timestamp, repr(float(value))) for timestamp, value in chunk]),
+         blocks.decode_points),
+        ('gorilla', lambda start, chunk: gorilla.encode(chunk),
+         lambda start, data: list(gorilla.decode(data))),
+    ]
+    results = []
+    for name, encode, decode in codecs:
+        encode_time, encoded = best_time(
+            lambda: [(start, encode(start, chunk)) for start, chunk in chunks], repeat)
+        decode_time, decoded = best_time(
+            lambda: [decode(start, data) for start, data in encoded], repeat)
+        if [(timestamp, float(value)) for chunk in decoded for timestamp, value in chunk] != \
+                [(timestamp, float(value)) for timestamp, value in points]:
+            raise AssertionError('%s does not decode the points that it encoded' % name)
+        results.append((name, sum(len(data) for __, data in encoded), encode_time,
+                        decode_time))
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the Gorilla codec against the '
+                                                 'compressed blocks')
+    parser.add_argument('--seconds', type=int, default=86400, help='Seconds of data of each serie')
+    parser.add_argument('--block-seconds', type=int, default=3600,
+                        help='Seconds of the points encoded together')
+    parser.add_argument('--decimals', type=int, default=None,
+                        help='Round the values like a sensor with this precision (default: '
+                             'full precision, like generate-timeseries.py)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each codec')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the random values')
+
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    start_time = int(time.time()) - args.seconds
+    for timeserie, generate in SERIES:
+        points = generate(args.seconds, start_time)
+        if args.decimals is not None:
+            points = [(timestamp, round(value, args.decimals)) for timestamp, value in points]
+        print('%s: %d points, %d bytes raw' % (timeserie, len(points),
+                                               len(points) * RAW_POINT_SIZE))
+        for name, size, encode_time, decode_time in benchmark(points, args.block_seconds,
+                                                              args.repeat):
+            print('  %-10s %9d bytes, %5.2f bytes/point, ratio %5.2fx, encode %8d points/s, '
+                  'decode %8d points/s' % (
+                      name, size, size / float(len(points)),
+                      len(points) * RAW_POINT_SIZE / float(size), len(points) / encode_time,
+                      len(points) / decode_time))
@@ -54,3 +54,20 @@ resource "aws_dynamodb_table" "timeseries_configuration" {
     app       = "dynamodb-timeseries"
   }
 }
+
+resource "aws_dynamodb_table" "consumer_leases" {
+
+  name         = "${var.app-prefix}_consumer_leases"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "shard_id"
+
+  attribute {
+    name = "shard_id"
+    type = "S"
+  }
+
+  tags = {
+    terraform = "yes"
+    app       = "dynamodb-timeseries"
+  }
+}
@@ -120,7 +120,25 @@ resource "aws_iam_role_policy" "ecs_task_iam_role_policy" {
           "${aws_dynamodb_table.timeseries["YEAR"].arn}"
         ],
         "Effect": "Allow"
-      } 
+      },
+      {
+        "Action": [
+          "dynamodb:BatchGetItem"
+        ],
+        "Resource": "${aws_dynamodb_table.timeseries_configuration.arn}",
+        "Effect": "Allow"
+      },
+      {
+        "Action": [
+          "dynamodb:GetItem",
+          "dynamodb:PutItem",
+          "dynamodb:UpdateItem",
+          "dynamodb:DeleteItem",
+          "dynamodb:Scan"
+        ],
+        "Resource": "${aws_dynamodb_table.consumer_leases.arn}",
+        "Effect": "Allow"
+      }
   ]
 }
 POLICY
@@ -149,7 +167,8 @@ resource "aws_ecs_task_definition" "consumer_task_definition" {
       }
     },
     "environment" : [
-      { "name" : "TABLE_PREFIX", "value" : "${var.app-prefix}" }
+      { "name" : "TABLE_PREFIX", "value" : "${var.app-prefix}" },
+      { "name" : "LEASE_TABLE", "value" : "${aws_dynamodb_table.consumer_leases.name}" }
     ]
   }
 ]
@@ -86,6 +86,7 @@ resource "aws_iam_role_policy" "rollup_lambda_iam_role_policy" {
           "dynamodb:GetRecords",
           "dynamodb:PutItem",
           "dynamodb:UpdateItem",
+          "dynamodb:BatchGetItem",
           "dynamodb:Query"
         ],
         "Resource": "${aws_dynamodb_table.timeseries_configuration.arn}",
@@ -125,6 +126,7 @@ resource "aws_iam_role_policy" "conf_lambda_iam_role_policy" {
           "dynamodb:GetRecords",
           "dynamodb:PutItem",
           "dynamodb:UpdateItem",
+          "dynamodb:BatchGetItem",
           "dynamodb:Query",
           "dynamodb:Scan"
         ],
@@ -178,6 +180,7 @@ resource "aws_iam_role_policy" "db_lambda_iam_role_policy" {
           "dynamodb:GetRecords",
           "dynamodb:PutItem",
           "dynamodb:UpdateItem",
+          "dynamodb:BatchGetItem",
           "dynamodb:Query"
         ],
         "Resource": "${aws_dynamodb_table.timeseries_configuration.arn}",
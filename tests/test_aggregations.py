@@ -0,0 +1,226 @@
+"""Tests of the conditional updates of the aggregations and of the merge of the points of a
+batch into a single write per bucket"""
+import os
+import random
+import re
+import sys
+import unittest
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from botocore.exceptions import ClientError
+
+from rollup import aggregations, granularities
+from rollup.lambda_database import InsertItem
+from rollup.timeserie_configuration import Configuration
+
+START = 1700000000
+
+
+class Missing(object):
+    """Value of a missing attribute, the comparisons with it are false like in DynamoDB"""
+    __lt__ = __le__ = __gt__ = __ge__ = __eq__ = lambda self, other: False
+
+
+MISSING = Missing()
+
+
+class ExpressionTable(object):
+    """Table that evaluates the condition and update expressions of the aggregations. The
+    update_item calls in failing_calls (counted from 1) fail with error"""
+
+    def __init__(self, failing_calls=(), error='InternalServerError'):
+        self.items = {}
+        self.calls = 0
+        self.failing_calls = set(failing_calls)
+        self.error = error
+
+    @staticmethod
+    def evaluate(expression, item, names, values):
+        """Evaluate a condition or the operand of a SET as a Python expression"""
+
+        def translate(match):
+            function, argument, default, name, value = match.groups()
+            if function == 'attribute_not_exists':
+                return '(%r not in item)' % names[argument]
+            if function == 'attribute_exists':
+                return '(%r in item)' % names[argument]
+            if function == 'if_not_exists':
+                return 'item.get(%r, values[%r])' % (names[argument], default)
+            if name is not None:
+                return 'item.get(%r, MISSING)' % names[name]
+            return 'values[%r]' % value
+
+        expression = re.sub(r'(\w+)\((#\w+)(?:, (:\w+))?\)|(#\w+)|(:\w+)', translate,
+                            expression)
+        return eval(expression, {'item': item, 'values': values, 'MISSING': MISSING})
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames,
+                    ExpressionAttributeValues, ConditionExpression=None, ReturnValues=None):
+        names, values = ExpressionAttributeNames, ExpressionAttributeValues
+        self.calls += 1
+        if self.calls in self.failing_calls:
+            raise ClientError({'Error': {'Code': self.error}}, 'UpdateItem')
+        key = (Key['timeserie'], Key['time'])
+        item = dict(self.items.get(key, {}))
+        if ConditionExpression and not self.evaluate(ConditionExpression, item, names, values):
+            raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}},
+                              'UpdateItem')
+        parts = re.split(r'\b(SET|ADD|REMOVE)\b', UpdateExpression)
+        updated = dict(item)
+        for action, clauses in zip(parts[1::2], parts[2::2]):
+            for clause in re.split(r',(?![^(]*\))', clauses):
+                if action == 'SET':
+                    name, operand = [token.strip() for token in clause.split('=', 1)]
+                    updated[names[name]] = self.evaluate(operand, item, names, values)
+                elif action == 'ADD':
+                    name, value = clause.split()
+                    updated[names[name]] = item.get(names[name], 0) + values[value]
+                else:
+                    updated.pop(names[clause.strip()], None)
+        self.items[key] = updated
+        return {}
+
+
+class ExpressionDynamo(object):
+    """DynamoDB with an ExpressionTable per granularity"""
+
+    def __init__(self):
+        self.tables = {}
+
+    def Table(self, name):
+        return self.tables.setdefault(name, ExpressionTable())
+
+    def values(self):
+        """Values of the stored buckets as {(table, timeserie, time): value}"""
+        return dict(((name, timeserie, item_time), aggregations.get_item_value(item))
+                    for name, table in self.tables.iteritems()
+                    for (timeserie, item_time), item in table.items.iteritems())
+
+
+def aggregation_of(table, value, old_value=None, time_original=START):
+    aggregation = aggregations.Aggregation(table, 'serie', START, value, START + 3600, 'UTC')
+    aggregation.old_value = old_value
+    aggregation.time_original = time_original
+    return aggregation
+
+
+class ConditionalUpdateTest(unittest.TestCase):
+
+    def update(self, table, value):
+        return aggregations.conditional_update(
+            aggregation_of(table, value),
+            UpdateExpression='SET #value = :value',
+            ConditionExpression='attribute_not_exists(#value) or :value > #value',
+            ExpressionAttributeNames={'#value': 'value'},
+            ExpressionAttributeValues={':value': Decimal(value)})
+
+    def test_update_when_the_condition_holds(self):
+        table = ExpressionTable()
+        self.assertTrue(self.update(table, 5))
+        self.assertTrue(self.update(table, 7))
+        self.assertEqual(table.items[('serie', str(START))]['value'], 7)
+
+    def test_no_change_when_the_condition_fails(self):
+        table = ExpressionTable()
+        self.update(table, 5)
+        self.assertFalse(self.update(table, 3))
+        self.assertEqual(table.items[('serie', str(START))]['value'], 5)
+
+    def test_other_errors_are_raised(self):
+        table = ExpressionTable(failing_calls=[1])
+        with self.assertRaises(ClientError):
+            self.update(table, 5)
+        self.assertEqual(table.items, {})
+
+
+class SetAbsValueTest(unittest.TestCase):
+
+    def values(self, function, points, stored=None):
+        """Values of the bucket after each point, starting from the stored item"""
+        table = ExpressionTable()
+        if stored is not None:
+            table.items[('serie', str(START))] = dict(stored)
+        results = []
+        for value in points:
+            written = function(aggregation_of(table, value))
+            item = table.items[('serie', str(START))]
+            results.append((written, item['value']))
+        return results
+
+    def test_abs_max(self):
+        self.assertEqual(self.values(aggregations.set_max_value_abs, [-3, 2, -5, 5, 7]),
+                         [(True, -3), (False, -3), (True, -5), (False, -5), (True, 7)])
+
+    def test_abs_min(self):
+        self.assertEqual(self.values(aggregations.set_min_value_abs, [-3, 4, 2, -2, -1]),
+                         [(True, -3), (False, -3), (True, 2), (False, 2), (True, -1)])
+
+    def test_abs_value_is_kept(self):
+        table = ExpressionTable()
+        aggregations.set_max_value_abs(aggregation_of(table, -4))
+        self.assertEqual(table.items[('serie', str(START))][aggregations.ABS_VALUE_ATTR], 4)
+
+    def test_legacy_buckets_without_abs_value(self):
+        # The buckets written before the absolute value was kept only have the value
+        legacy = {'value': Decimal(-5)}
+        self.assertEqual(self.values(aggregations.set_max_value_abs, [3, -5, 6, -4], legacy),
+                         [(False, -5), (False, -5), (True, 6), (False, 6)])
+        self.assertEqual(self.values(aggregations.set_min_value_abs, [6, -5, 3, 4], legacy),
+                         [(False, -5), (False, -5), (True, 3), (False, 3)])
+
+
+class MergeTest(unittest.TestCase):
+
+    def points(self, count, seed):
+        """Points of a serie in a few minutes, some of them updates of the previous ones"""
+        randomizer = random.Random(seed)
+        points = []
+        last_values = {}
+        for __ in range(count):
+            timestamp = START + randomizer.randint(0, 179)
+            item = InsertItem(str(timestamp), 'serie',
+                              randomizer.choice([0, 0.5, -2.25, 3, 7.75, -11, 13]))
+            if timestamp in last_values:
+                item.old_value = last_values[timestamp]
+            if item.value:
+                last_values[timestamp] = item.value
+            points.append(item)
+        return points
+
+    def test_merged_buckets_are_written_like_the_points(self):
+        for aggregation in sorted(aggregations.MERGE_FUNC_DICT):
+            configuration = Configuration('UTC', aggregation,
+                                          dict((granularity, 86400) for granularity in
+                                               granularities.GRANULARITIES[1:]))
+            points = self.points(60, aggregation)
+
+            one_by_one = ExpressionDynamo()
+            combined = ExpressionDynamo()
+            combiner = aggregations.RollupCombiner()
+            for item in points:
+                for granularity in granularities.GRANULARITIES[1:]:
+                    aggregations.rollup(one_by_one, granularity, item, configuration)
+                    self.assertTrue(combiner.add(granularity, item, configuration))
+            combiner.flush(combined)
+            expected = one_by_one.values()
+            self.assertEqual(combined.values(), expected, aggregation)
+            self.assertTrue(expected, aggregation)
+
+    def test_merge_of_combiners(self):
+        configuration = Configuration('UTC', aggregations.AGGREGATION_AVG, {'minute': 86400})
+        points = self.points(40, 'combiners')
+        first, second, whole = [aggregations.RollupCombiner() for __ in range(3)]
+        for index, item in enumerate(points):
+            (first if index < 20 else second).add('minute', item, configuration)
+            whole.add('minute', item, configuration)
+        first.merge(second)
+        merged, expected = ExpressionDynamo(), ExpressionDynamo()
+        first.flush(merged)
+        whole.flush(expected)
+        self.assertEqual(merged.values(), expected.values())
+
+
+if __name__ == '__main__':
+    unittest.main()
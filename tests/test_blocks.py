@@ -0,0 +1,77 @@
+"""Tests of the points stored in blocks, from the block write to the rollups of its points"""
+import base64
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from boto3.dynamodb.types import TypeSerializer
+
+from rollup import aggregations, blocks, lambda_database
+from rollup.timeserie_configuration import Configuration
+
+START = 1700002800
+
+
+class SerializingTable(object):
+    """Table that serializes the values of the updates like boto3 does before sending them"""
+
+    def __init__(self):
+        self.updates = []
+
+    def update_item(self, **kwargs):
+        serializer = TypeSerializer()
+        self.updates.append(dict((name, serializer.serialize(value)) for name, value in
+                                 kwargs['ExpressionAttributeValues'].iteritems()))
+        return {}
+
+
+class SerializingDynamo(object):
+
+    def __init__(self):
+        self.table = SerializingTable()
+
+    def Table(self, __name):
+        return self.table
+
+
+def block_image(points):
+    """Stream image of a block with the points (time, value)"""
+    return {'timeserie': {'S': 'serie'}, 'time': {'S': str(START)},
+            'points': {'B': base64.b64encode(blocks.encode_points(START, points))}}
+
+
+class BlockRecordTest(unittest.TestCase):
+
+    def parse(self, old_points, new_points):
+        record = {'dynamodb': {'NewImage': block_image(new_points)}}
+        if old_points is not None:
+            record['dynamodb']['OldImage'] = block_image(old_points)
+        return lambda_database.parse_ddb_block_record(record)
+
+    def test_decimal_text_is_kept(self):
+        items = self.parse([(START, '0.0')], [(START, '23.7'), (START + 1, '-12.35')])
+        self.assertEqual([(item.timestamp, item.value, item.old_value) for item in items],
+                         [(str(START), '23.7', '0.0'), (str(START + 1), '-12.35', None)])
+
+    def test_unchanged_points_are_not_sent(self):
+        items = self.parse([(START, '1.50')], [(START, '1.5'), (START + 1, '2')])
+        self.assertEqual([item.timestamp for item in items], [str(START + 1)])
+
+    def test_rollups_of_non_integer_values(self):
+        for method in ('max', 'min', 'last', 'abs_max', 'abs_min', 'sum', 'average', 'count'):
+            configuration = Configuration('UTC', method, {'minute': 3600})
+            dynamo = SerializingDynamo()
+            for item in self.parse([(START, '0.0')], [(START, '23.7')]):
+                self.assertIsNotNone(aggregations.rollup(dynamo, 'minute', item, configuration),
+                                     method)
+            if method == 'count':
+                # An update of a point is not counted again
+                self.assertEqual(dynamo.table.updates, [])
+            else:
+                self.assertEqual(len(dynamo.table.updates), 1, method)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,274 @@
+"""Tests of the consumer against local stand-ins of Kinesis and DynamoDB: the leases, the
+checkpoints and the batches that are read again after a failed write"""
+import os
+import re
+import sys
+import threading
+import time
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'kinesisconsumer'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-1')
+
+from botocore.exceptions import ClientError
+from botocore.hooks import HierarchicalEmitter
+
+from rollup import stream_records
+from rollup.timeserie_configuration import Configuration
+import consumer
+from leases import LeaseManager
+
+SHARD_ID = 'shardId-000000000000'
+START = 1700000000
+# Seconds to wait for the consumer to process the stream
+TIMEOUT = 20
+
+
+def conditional_check_failed():
+    return ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+
+
+class Meta(object):
+    """The client metadata of a boto3 resource, only its events"""
+
+    def __init__(self):
+        self.client = self
+        self.meta = self
+        self.events = HierarchicalEmitter()
+
+
+class LocalKinesis(object):
+    """Kinesis stream with a single shard whose sequence numbers are the positions of its
+    records"""
+
+    def __init__(self):
+        self.records = []
+        # Time of the raw point of each record, None for the records of rollups
+        self.times = []
+
+    def put(self, records):
+        for data, point_time in records:
+            self.records.append({'Data': data, 'SequenceNumber': str(len(self.records))})
+            self.times.append(point_time)
+
+    def describe_stream(self, StreamName, **__kwargs):
+        return {'StreamDescription': {'Shards': [{'ShardId': SHARD_ID}],
+                                      'HasMoreShards': False}}
+
+    def get_shard_iterator(self, StreamName, ShardId, ShardIteratorType,
+                           StartingSequenceNumber=None, **__kwargs):
+        position = {
+            'TRIM_HORIZON': lambda: 0,
+            'LATEST': lambda: len(self.records),
+            'AT_SEQUENCE_NUMBER': lambda: int(StartingSequenceNumber),
+            'AFTER_SEQUENCE_NUMBER': lambda: int(StartingSequenceNumber) + 1,
+        }[ShardIteratorType]()
+        return {'ShardIterator': str(position)}
+
+    def get_records(self, ShardIterator, Limit):
+        position = int(ShardIterator)
+        records = self.records[position:position + Limit]
+        return {'Records': records, 'NextShardIterator': str(position + len(records)),
+                'MillisBehindLatest': 0}
+
+
+class LeaseTable(object):
+    """Lease table that evaluates the expressions of the lease manager. It keeps the history of
+    the checkpoints"""
+
+    def __init__(self, on_checkpoint=None):
+        self.items = {}
+        self.lock = threading.Lock()
+        self.on_checkpoint = on_checkpoint
+
+    @staticmethod
+    def check(item, condition, names, values):
+        if condition.startswith('attribute_not_exists'):
+            holds = item is None
+        else:
+            name, value = condition.split(' = ')
+            holds = item is not None and item.get(names[name]) == values[value]
+        if not holds:
+            raise conditional_check_failed()
+
+    def put_item(self, Item, ConditionExpression):
+        with self.lock:
+            self.check(self.items.get(Item['shard_id']), ConditionExpression, {}, {})
+            self.items[Item['shard_id']] = dict(Item)
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression, ExpressionAttributeNames,
+                    ExpressionAttributeValues):
+        names, values = ExpressionAttributeNames, ExpressionAttributeValues
+        with self.lock:
+            item = self.items.get(Key['shard_id'])
+            self.check(item, ConditionExpression, names, values)
+            parts = re.split(r'\b(SET|ADD|REMOVE)\b', UpdateExpression)
+            for action, clauses in zip(parts[1::2], parts[2::2]):
+                for clause in clauses.split(','):
+                    if action == 'SET':
+                        name, value = [token.strip() for token in clause.split('=')]
+                        item[names[name]] = values[value]
+                    elif action == 'ADD':
+                        name, value = clause.split()
+                        item[names[name]] = item.get(names[name], 0) + values[value]
+                    else:
+                        item.pop(names[clause.strip()], None)
+            if ':checkpoint' in values and self.on_checkpoint is not None:
+                self.on_checkpoint(values[':checkpoint'])
+
+    def delete_item(self, Key, ConditionExpression, ExpressionAttributeNames,
+                    ExpressionAttributeValues):
+        with self.lock:
+            self.check(self.items.get(Key['shard_id']), ConditionExpression,
+                       ExpressionAttributeNames, ExpressionAttributeValues)
+            del self.items[Key['shard_id']]
+
+    def scan(self, **__kwargs):
+        with self.lock:
+            return {'Items': [dict(item) for item in self.items.itervalues()]}
+
+    def get_item(self, Key, **__kwargs):
+        with self.lock:
+            item = self.items.get(Key['shard_id'])
+            return {'Item': dict(item)} if item is not None else {}
+
+
+class RollupTable(object):
+    """Table of a granularity that adds the increments of the sum rollups"""
+
+    def __init__(self, dynamo):
+        self.dynamo = dynamo
+
+    def update_item(self, Key, ExpressionAttributeValues, **__kwargs):
+        key = (Key['timeserie'], long(Key['time']))
+        with self.dynamo.lock:
+            self.dynamo.sums[key] = self.dynamo.sums.get(key, 0) + \
+                ExpressionAttributeValues[':increment']
+        return {}
+
+
+class LocalDynamo(object):
+    """DynamoDB with the raw points, the sums of the rollups and the lease table. The
+    BatchWriteItem calls in failing_calls (counted from 1) fail"""
+
+    def __init__(self, failing_calls=()):
+        self.meta = Meta()
+        self.lock = threading.Lock()
+        self.failing_calls = set(failing_calls)
+        self.calls = 0
+        self.points = {}
+        self.sums = {}
+        self.leases = LeaseTable(self.on_checkpoint)
+        # (checkpoint, times of the points written when it was stored)
+        self.checkpoints = []
+
+    def batch_write_item(self, RequestItems):
+        with self.lock:
+            self.calls += 1
+            if self.calls in self.failing_calls:
+                raise ClientError({'Error': {'Code': 'InternalServerError'}}, 'BatchWriteItem')
+            for requests in RequestItems.itervalues():
+                for request in requests:
+                    item = request['PutRequest']['Item']
+                    self.points[(item['timeserie'], long(item['time']))] = item['value']
+        return {'UnprocessedItems': {}}
+
+    def Table(self, name):
+        if name == 'leases':
+            return self.leases
+        return RollupTable(self)
+
+    def on_checkpoint(self, sequence_number):
+        with self.lock:
+            self.checkpoints.append((sequence_number, set(time for __, time in self.points)))
+
+
+def stream_records_of(first, count):
+    """Records of a point per second from the second first and of their rollups in minutes,
+    as (data, time of the raw point or None)"""
+    configuration = Configuration('UTC', 'sum', {'second': 86400, 'minute': 86400})
+    configuration.timeserie = 'serie'
+    configuration = configuration.to_dict()
+    packer = stream_records.new_packer('json')
+    records = []
+    for second in range(first, first + count):
+        data = {'timeserie': 'serie', 'time': START + second, 'value': second, 'ttl': None,
+                'old_value': None}
+        packer.add('serie', 'second', data)
+        records.append((packer.flush()[0]['Data'], START + second))
+        packer.add('serieminute', 'minute', data, configuration)
+        records.append((packer.flush()[0]['Data'], None))
+    return records
+
+
+class LeasedConsumerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.kinesis = LocalKinesis()
+        self.configure = consumer.configure_kinesis, consumer.configure_dynamodb
+
+    def tearDown(self):
+        consumer.configure_kinesis, consumer.configure_dynamodb = self.configure
+
+    def consume(self, dynamo, rollup_lanes=0):
+        """Run a consumer until it has checkpointed all the records of the stream, then stop
+        it"""
+        consumer.configure_kinesis = lambda: self.kinesis
+        consumer.configure_dynamodb = lambda: dynamo
+        kinesis_consumer = consumer.KinesisDynamoConsumer(
+            'stream', sleep_time=0, start_position='TRIM_HORIZON',
+            leases=LeaseManager(dynamo, 'leases'), lease_interval=0.05,
+            rollup_lanes=rollup_lanes)
+        thread = threading.Thread(target=kinesis_consumer.start)
+        thread.daemon = True
+        thread.start()
+        last_sequence = self.kinesis.records[-1]['SequenceNumber']
+        deadline = time.time() + TIMEOUT
+        while time.time() < deadline and \
+                dynamo.leases.items.get(SHARD_ID, {}).get('checkpoint') != last_sequence:
+            time.sleep(0.05)
+        kinesis_consumer.stop()
+        thread.join(TIMEOUT)
+        self.assertEqual(dynamo.leases.items[SHARD_ID].get('checkpoint'), last_sequence)
+
+    def assert_stream_written(self, dynamo, seconds):
+        self.assertEqual(sorted(time for __, time in dynamo.points),
+                         range(START, START + seconds))
+        sums = {}
+        for second in range(seconds):
+            minute = (START + second) / 60 * 60
+            sums[('serie', minute)] = sums.get(('serie', minute), 0) + second
+        self.assertEqual(dynamo.sums, sums)
+
+    def assert_checkpoints_written(self, dynamo):
+        for sequence_number, written in dynamo.checkpoints:
+            self.assertTrue(all(point_time in written for point_time in
+                                self.kinesis.times[:int(sequence_number) + 1] if point_time),
+                            'Checkpoint %s of a record not written' % sequence_number)
+
+    def test_failed_batches_are_read_again(self):
+        self.kinesis.put(stream_records_of(0, 120))
+        for rollup_lanes in (0, 4):
+            dynamo = LocalDynamo(failing_calls=(2, 3, 7))
+            self.consume(dynamo, rollup_lanes)
+            # The sums are not added twice for the batches that are read again
+            self.assert_stream_written(dynamo, 120)
+            self.assert_checkpoints_written(dynamo)
+
+    def test_next_consumer_starts_after_the_checkpoint(self):
+        dynamo = LocalDynamo()
+        self.kinesis.put(stream_records_of(0, 60))
+        self.consume(dynamo)
+        # The lease is released on stop, so the next consumer takes it at once
+        self.assertNotIn('owner', dynamo.leases.items[SHARD_ID])
+
+        self.kinesis.put(stream_records_of(60, 60))
+        self.consume(dynamo)
+        self.assert_stream_written(dynamo, 120)
+        self.assert_checkpoints_written(dynamo)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+"""Tests of the bulk conversion of the times to the buckets of the granularities"""
+import os
+import random
+import sys
+import unittest
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from rollup import granularities
+from rollup.granularities import convert_time, convert_times, numpy
+
+# Around the DST changes of Europe/Madrid in 2023 (26 March and 29 October)
+DST_STARTS = [1679792400, 1698541200]
+TIMEZONES = ['UTC', 'Europe/Madrid', 'America/New_York', 'Asia/Kolkata']
+
+
+def sample_times(count=500, seed=1):
+    """Times in the last years, some of them next to the DST changes and the new year"""
+    randomizer = random.Random(seed)
+    times = [randomizer.randint(1500000000, 1750000000) for __ in range(count)]
+    for boundary in DST_STARTS + [1672531200]:
+        times.extend(boundary + offset for offset in (-7201, -3600, -1, 0, 1, 3599, 3600))
+    return times
+
+
+class ConvertTimesTest(unittest.TestCase):
+
+    def assert_like_convert_time(self, time_values, times):
+        for timezone in TIMEZONES:
+            converted = convert_times(time_values, timezone)
+            self.assertEqual(sorted(converted), sorted(granularities.GRANULARITIES))
+            for granularity in granularities.GRANULARITIES:
+                self.assertEqual([long(time_converted) for time_converted in
+                                  converted[granularity]],
+                                 [long(convert_time(granularity, time_value, timezone))
+                                  for time_value in times], (granularity, timezone))
+
+    def test_list(self):
+        times = sample_times()
+        self.assert_like_convert_time(times, times)
+
+    def test_array(self):
+        times = sample_times()
+        self.assert_like_convert_time(array('l', times), times)
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_numpy(self):
+        times = sample_times()
+        self.assert_like_convert_time(numpy.array(times, dtype=numpy.int64), times)
+
+    def test_text_times(self):
+        # The times of the stream records can be text
+        times = sample_times(50)
+        self.assert_like_convert_time([str(time_value) for time_value in times], times)
+
+    def test_some_granularities(self):
+        converted = convert_times([1700000123], 'UTC', [granularities.MINUTE])
+        self.assertEqual(converted.keys(), [granularities.MINUTE])
+        self.assertEqual(list(converted[granularities.MINUTE]), [1700000100])
+
+    def test_empty(self):
+        for time_values in ([], array('l')):
+            converted = convert_times(time_values, 'Europe/Madrid')
+            self.assertTrue(all(len(converted[granularity]) == 0
+                                for granularity in granularities.GRANULARITIES))
+
+
+if __name__ == '__main__':
+    unittest.main()